@@ -0,0 +1,257 @@
+"""Registro eventi append-only: chi ha fatto cosa e quando.
+
+Ogni evento è una riga JSON compatta in ``AUDIT_PATH``::
+
+  {"t":1700000000.123,"k":"cmd","d":"dsp","a":"mute_all","o":"ok","u":"op@10.0.0.5","ms":41.2}
+
+``k`` tipo (``cmd`` comando driver, ``scene``, ``login``), ``d`` dispositivo,
+``a`` azione, ``o`` esito, ``u`` chi (``op@ip`` operatore, ``ip`` chiosco,
+``system`` per i task di background), ``ms`` durata; eventuali altri campi
+in ``x``.
+
+``record`` non tocca il disco: aggiunge l'evento all'indice in memoria e a
+una coda; ``run_writer`` scrive la coda ogni ``FLUSH_S`` secondi con una sola
+scrittura e un solo ``fsync`` (la SD ringrazia). Oltre ``MAX_BYTES`` il file
+ruota (``audit.log.1`` ... ``.KEEP``).
+
+L'indice tiene gli ultimi ``INDEX_SIZE`` eventi in ordine di tempo, con una
+lista per dispositivo; all'avvio ``load`` lo ricostruisce dai file. Lo
+interroga ``GET /api/diag/audit`` (app/diag.py).
+
+I comandi driver arrivano dagli span di app/tracing.py (uno per operazione,
+non per ogni pacchetto); i controlli periodici del monitor di salute sono
+esclusi con ``quiet``.
+"""
+from __future__ import annotations
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from app import metrics
+from app.config import DATA_DIR
+
+AUDIT_PATH = Path(os.environ.get("ROOMCTL_AUDIT_LOG", str(DATA_DIR / "audit.log")))
+MAX_BYTES = 512 * 1024
+KEEP = 4
+FLUSH_S = 5.0
+INDEX_SIZE = 5000
+# oltre questo numero di eventi non ancora scritti si scartano i più vecchi
+MAX_PENDING = 10000
+
+_KEYS = {"t": "time", "k": "kind", "d": "device", "a": "action", "o": "outcome", "u": "actor", "ms": "duration_ms", "x": "extra"}
+
+log = logging.getLogger(__name__)
+
+_actor: contextvars.ContextVar[str | None] = contextvars.ContextVar("roomctl_actor", default=None)
+_quiet: contextvars.ContextVar[bool] = contextvars.ContextVar("roomctl_audit_quiet", default=False)
+
+
+class _Index:
+    """Eventi ordinati per tempo, con una vista per dispositivo; ricerca per
+    intervallo con ``bisect`` e potatura ammortizzata oltre ``size``."""
+
+    def __init__(self, size: int = INDEX_SIZE):
+        self.size = size
+        self.times: list[float] = []
+        self.events: list[dict] = []
+        self.by_device: dict[str, tuple[list[float], list[dict]]] = {}
+
+    def add(self, ev: dict) -> None:
+        t = ev["t"]
+        # gli eventi arrivano quasi sempre in ordine; altrimenti inserimento ordinato
+        pos = len(self.times) if not self.times or self.times[-1] <= t else bisect.bisect_right(self.times, t)
+        self.times.insert(pos, t)
+        self.events.insert(pos, ev)
+        dev = ev.get("d")
+        if dev:
+            times, events = self.by_device.setdefault(dev, ([], []))
+            pos = len(times) if not times or times[-1] <= t else bisect.bisect_right(times, t)
+            times.insert(pos, t)
+            events.insert(pos, ev)
+        if len(self.events) > 2 * self.size:
+            self._trim()
+
+    def _trim(self) -> None:
+        cut = len(self.events) - self.size
+        oldest = self.times[cut]
+        del self.times[:cut], self.events[:cut]
+        for dev, (times, events) in list(self.by_device.items()):
+            n = bisect.bisect_left(times, oldest)
+            del times[:n], events[:n]
+            if not events:
+                del self.by_device[dev]
+
+    def query(self, since: float | None, until: float | None, device: str | None) -> list[dict]:
+        if device:
+            times, events = self.by_device.get(device, ([], []))
+        else:
+            times, events = self.times, self.events
+        lo = bisect.bisect_left(times, since) if since is not None else 0
+        hi = bisect.bisect_right(times, until) if until is not None else len(times)
+        return events[lo:hi]
+
+
+class AuditLog:
+    def __init__(self, path: Path = AUDIT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = _Index()
+        self._pending: list[str] = []
+        self.dropped = 0
+
+    # -------------------------------------------------------------- scrittura
+
+    def record(self, kind: str, *, device: str | None = None, action: str | None = None,
+               outcome: str = "ok", duration_s: float | None = None, actor: str | None = None, **extra) -> None:
+        """Registra un evento; chiamabile da qualunque thread, non blocca."""
+
+        ev: dict = {"t": round(time.time(), 3), "k": kind}
+        if device:
+            ev["d"] = device
+        if action:
+            ev["a"] = action
+        ev["o"] = outcome
+        ev["u"] = actor or _actor.get() or "system"
+        if duration_s is not None:
+            ev["ms"] = round(duration_s * 1000, 1)
+        if extra:
+            ev["x"] = extra
+        line = json.dumps(ev, separators=(",", ":"), ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._index.add(ev)
+            self._pending.append(line)
+            if len(self._pending) > MAX_PENDING:
+                drop = len(self._pending) - MAX_PENDING
+                del self._pending[:drop]
+                self.dropped += drop
+
+    def flush(self) -> None:
+        """Scrive gli eventi in coda (una scrittura, un fsync); bloccante."""
+
+        with self._lock:
+            lines, self._pending = self._pending, []
+        if not lines:
+            return
+        data = "".join(lines).encode("utf-8")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.path.exists() and self.path.stat().st_size + len(data) > MAX_BYTES:
+                self._rotate()
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            with self._lock:
+                # si riprova al prossimo giro, senza superare il limite
+                self._pending[:0] = lines[-MAX_PENDING:]
+            raise
+
+    def _rotate(self) -> None:
+        for i in range(KEEP - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{i}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+
+    async def run_writer(self) -> None:
+        """Task di background: scrive la coda ogni ``FLUSH_S`` secondi."""
+
+        while True:
+            await asyncio.sleep(FLUSH_S)
+            try:
+                await asyncio.to_thread(self.flush)
+            except OSError as exc:
+                log.error("Impossibile scrivere il registro eventi %s: %s", self.path, exc)
+
+    # -------------------------------------------------------------- lettura
+
+    def load(self) -> int:
+        """Ricostruisce l'indice dai file su disco (dal più vecchio); bloccante."""
+
+        files = [self.path.with_name(f"{self.path.name}.{i}") for i in range(KEEP, 0, -1)] + [self.path]
+        loaded = 0
+        index = _Index()
+        for path in files:
+            try:
+                with path.open("r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            ev = json.loads(line)
+                            float(ev["t"])
+                        except (ValueError, KeyError, TypeError):
+                            # riga troncata da un'interruzione di corrente
+                            continue
+                        index.add(ev)
+                        loaded += 1
+            except FileNotFoundError:
+                continue
+            except OSError as exc:
+                log.error("Registro eventi %s non leggibile: %s", path, exc)
+        with self._lock:
+            # eventi registrati nel frattempo dopo quelli su disco
+            for ev in self._index.events:
+                index.add(ev)
+            self._index = index
+        return loaded
+
+    def query(self, *, since: float | None = None, until: float | None = None, device: str | None = None,
+              kind: str | None = None, actor: str | None = None, outcome: str | None = None,
+              limit: int = 100) -> list[dict]:
+        """Eventi filtrati, i più recenti per primi."""
+
+        with self._lock:
+            events = self._index.query(since, until, device)
+        out = []
+        for ev in reversed(events):
+            if kind and ev.get("k") != kind:
+                continue
+            if actor and ev.get("u") != actor:
+                continue
+            if outcome and not str(ev.get("o", "")).startswith(outcome):
+                continue
+            out.append({_KEYS.get(k, k): v for k, v in ev.items()})
+            if len(out) >= limit:
+                break
+        return out
+
+
+audit = AuditLog()
+
+metrics.Gauge("roomctl_audit_events_dropped", "Eventi del registro scartati a coda piena.", fn=lambda: audit.dropped)
+
+
+def record(kind: str, **fields) -> None:
+    if not _quiet.get():
+        audit.record(kind, **fields)
+
+
+def bind_actor(actor: str | None) -> contextvars.Token:
+    """Imposta chi sta agendo per la richiesta corrente (middleware HTTP)."""
+
+    return _actor.set(actor)
+
+
+def reset_actor(token: contextvars.Token) -> None:
+    _actor.reset(token)
+
+
+@contextmanager
+def quiet() -> Iterator[None]:
+    """Nessun evento registrato nel blocco (controlli periodici)."""
+
+    token = _quiet.set(True)
+    try:
+        yield
+    finally:
+        _quiet.reset(token)
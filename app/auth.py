@@ -1,46 +1,141 @@
-import os,secrets,yaml
+import asyncio,heapq,hmac,logging,secrets,threading,time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from fastapi import Request,Response,HTTPException
+from app import audit, config
 
 try:
  from argon2 import PasswordHasher
+ from argon2.exceptions import InvalidHashError,VerificationError
  _ph=PasswordHasher()
 except Exception:
  _ph=None
-_VALID_TOKENS=set(); CONFIG_MAIN=os.environ.get('ROOMCTL_CONFIG','/opt/roomctl/config/config.yaml')
 
-def _load_config():
- try:
-  import yaml
-  with open(CONFIG_MAIN,'r',encoding='utf-8') as f: return yaml.safe_load(f) or {}
- except FileNotFoundError:
-  return {}
- except Exception:
-  return {}
+log=logging.getLogger(__name__)
+
+# sessioni operatore: scadenza per token, al più MAX_TOKENS contemporanee
+TOKEN_TTL_S=12*3600
+MAX_TOKENS=64
+# tentativi PIN per client: oltre LOGIN_MAX_FAILS errori in LOGIN_WINDOW_S il client resta bloccato LOGIN_LOCK_S
+# (i tentativi ancora in verifica contano già come errori)
+LOGIN_MAX_FAILS=5; LOGIN_WINDOW_S=300; LOGIN_LOCK_S=60
+# il kiosk in aula posta da loopback: il blocco vale per tutti quelli davanti allo schermo, quindi è breve
+# (a mano dal touch screen non si va comunque oltre pochi tentativi al minuto)
+LOCAL_CLIENTS=('127.0.0.1','::1'); LOGIN_LOCK_LOCAL_S=15
+# verifiche Argon2 fuori dall'event loop, al più PIN_WORKERS insieme e PIN_QUEUE in attesa
+PIN_WORKERS=2; PIN_QUEUE=8
+
+_TOKENS:dict[str,float]={}          # token -> scadenza (epoch)
+_EXPIRY:list[tuple[float,str]]=[]   # indice per scadenza (heap), pulito in modo pigro
+_tokens_lock=threading.Lock()
+_fails:dict[str,list[float]]={}     # client -> istanti degli ultimi errori
+_locked_until:dict[str,float]={}
+_inflight:dict[str,int]={}          # client -> verifiche PIN in corso
+_executor=ThreadPoolExecutor(max_workers=PIN_WORKERS,thread_name_prefix='pin')
+_pending=0
+# hash del PIN già validato, per snapshot di configurazione
+_pin_cache:tuple=(None,None)
+
+def _pin_conf():
+ global _pin_cache
+ auth=config.auth_config()
+ cached,pin_hash=_pin_cache
+ if cached is auth: return auth,pin_hash
+ pin_hash=auth.pin_hash
+ if pin_hash and _ph:
+  try: _ph.check_needs_rehash(pin_hash)
+  except InvalidHashError:
+   log.error('pin_hash in config.yaml non è un hash Argon2 valido'); pin_hash=None
+ _pin_cache=(auth,pin_hash)
+ return auth,pin_hash
 
 def _check_pin(pin:str)->bool:
- cfg=_load_config(); auth=cfg.get('auth',{}); pin_plain=str(auth.get('pin_plain') or ''); pin_hash=auth.get('pin_hash')
+ # bloccante (lettura config, Argon2): gira nell'executor
+ auth,pin_hash=_pin_conf()
  if pin_hash and _ph:
-  try: _ph.verify(pin_hash,pin); return True
-  except Exception: return False
- return (pin_plain!='' and pin==pin_plain)
+  try: return _ph.verify(pin_hash,pin)
+  except (VerificationError,InvalidHashError): return False
+ return auth.pin_plain!='' and hmac.compare_digest(pin.encode(),auth.pin_plain.encode())
+
+async def _verify(pin:str)->bool:
+ global _pending
+ if _pending>=PIN_QUEUE+PIN_WORKERS: raise HTTPException(status_code=429,detail='Troppe verifiche PIN in corso')
+ _pending+=1
+ try: return await asyncio.get_running_loop().run_in_executor(_executor,_check_pin,pin)
+ finally: _pending-=1
+
+def _prune(now:float):
+ while _EXPIRY and _EXPIRY[0][0]<=now:
+  exp,t=heapq.heappop(_EXPIRY)
+  if _TOKENS.get(t)==exp: del _TOKENS[t]
 
 def issue_token()->str:
- import secrets
- t=secrets.token_urlsafe(32); _VALID_TOKENS.add(t); return t
+ t=secrets.token_urlsafe(32); now=time.time(); exp=now+TOKEN_TTL_S
+ with _tokens_lock:
+  _prune(now)
+  while len(_TOKENS)>=MAX_TOKENS:
+   # oltre il limite cade la sessione più vecchia
+   old_exp,old=heapq.heappop(_EXPIRY)
+   if _TOKENS.get(old)==old_exp: del _TOKENS[old]
+  _TOKENS[t]=exp; heapq.heappush(_EXPIRY,(exp,t))
+ return t
+
+def _valid(t:Optional[str])->bool:
+ if not t: return False
+ exp=_TOKENS.get(t)
+ return exp is not None and exp>time.time()
 
 def get_token_from_cookie(request:Request)->Optional[str]:
  return request.cookies.get('rtoken')
 
 async def require_operator(request:Request):
- t=get_token_from_cookie(request)
- if not t or t not in _VALID_TOKENS: raise HTTPException(status_code=302,detail='Redirect',headers={'Location':'/'})
+ if not _valid(get_token_from_cookie(request)): raise HTTPException(status_code=302,detail='Redirect',headers={'Location':'/'})
  return True
 
-async def login_with_pin(pin:str)->Optional[str]:
+def is_operator(request:Request)->bool:
+ return _valid(get_token_from_cookie(request))
+
+def _locked(client:str,now:float)->bool:
+ until=_locked_until.get(client)
+ if until is None: return False
+ if until>now: return True
+ del _locked_until[client]; return False
+
+def _recent_fails(client:str,now:float)->list[float]:
+ return [t for t in _fails.get(client,()) if now-t<LOGIN_WINDOW_S]
+
+def _note_fail(client:str,now:float):
+ if len(_fails)>256:
+  for c in [c for c,ts in _fails.items() if now-ts[-1]>=LOGIN_WINDOW_S]: del _fails[c]
+ recent=_recent_fails(client,now)+[now]
+ if len(recent)>=LOGIN_MAX_FAILS:
+  lock=LOGIN_LOCK_LOCAL_S if client in LOCAL_CLIENTS else LOGIN_LOCK_S
+  _locked_until[client]=now+lock; recent=[]
+  log.warning('Troppi PIN errati da %s: bloccato per %d s',client,lock)
+ if recent: _fails[client]=recent
+ else: _fails.pop(client,None)
+
+async def login_with_pin(pin:str,client:str='?')->Optional[str]:
  if not pin: return None
- if _check_pin(pin): return issue_token()
+ now=time.time()
+ # il tentativo conta prima della verifica: N richieste parallele non arrivano tutte ad Argon2
+ if _locked(client,now) or len(_recent_fails(client,now))+_inflight.get(client,0)>=LOGIN_MAX_FAILS:
+  audit.record('login',action='pin',outcome='fail: troppi tentativi'); return None
+ _inflight[client]=_inflight.get(client,0)+1
+ try: ok=await _verify(pin)
+ finally:
+  n=_inflight.pop(client)-1
+  if n: _inflight[client]=n
+ if ok:
+  _fails.pop(client,None)
+  audit.record('login',action='pin'); return issue_token()
+ _note_fail(client,time.time())
+ audit.record('login',action='pin',outcome='fail')
  return None
 
-def logout(resp:Response):
- resp.delete_cookie('rtoken'); _VALID_TOKENS.clear()
+def logout(resp:Response,token:Optional[str]=None):
+ # chiude solo la sessione di chi esce
+ resp.delete_cookie('rtoken')
+ with _tokens_lock:
+  if token: _TOKENS.pop(token,None)
+ audit.record('login',action='logout')
@@ -0,0 +1,303 @@
+"""Diffusione dello stato pubblico ai websocket (``/ws``).
+
+Un solo task (``pump``) segue le versioni di app/state.py: a ogni modifica
+divide la differenza JSON Patch per argomento e codifica ogni messaggio una
+volta sola (``orjson`` se installato), qualunque sia il numero di client.
+I byte arrivano ai client tramite code limitate, una per client: se un client
+lento riempie la sua coda i messaggi accodati vengono scartati e al loro
+posto riceve lo stato completo aggiornato (drop-to-latest).
+
+Argomenti: ``projector``, ``dsp`` (anche ``volume_preset``), ``shelly``,
+``health`` (monitor dei dispositivi, app/health.py) e ``jobs`` (messaggio di
+stato, lezione in corso, tutto il resto). Il client li sceglie con
+``/ws?topics=projector,jobs``; senza parametro li riceve tutti.
+
+Messaggi: ``{"v": N, "state": {...}}`` (completo, filtrato per argomento) e
+``{"v": N, "topic": "...", "patch": [...]}``.
+
+Per i browser su Wi-Fi instabile ci sono anche:
+
+- ``/events``: Server-Sent Events con ``id`` uguale alla versione dello stato
+  (crescente anche fra un riavvio e l'altro); il browser si riconnette da solo
+  e con ``Last-Event-ID`` riprende dalle differenze ancora in memoria
+  (``state.HISTORY``), altrimenti riceve lo stato completo;
+- ``/state/poll``: long-poll che attende fino a ``wait`` secondi una versione
+  successiva a ``v`` (o all'``ETag`` in ``If-None-Match``) e risponde
+  ``304 Not Modified`` se non cambia nulla.
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from typing import Any, Iterable
+
+from fastapi import Request, Response, WebSocket
+from fastapi.responses import StreamingResponse
+
+from app import metrics, state
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dipende dall'installazione
+    orjson = None
+
+TOPICS: dict[str, tuple[str, ...]] = {
+    "projector": ("projector",),
+    "dsp": ("dsp", "volume_preset"),
+    "shelly": ("shelly",),
+    "jobs": ("text", "current_lesson"),
+    "health": ("health",),
+}
+QUEUE_SIZE = 16
+SSE_RETRY_MS = 2000
+SSE_KEEPALIVE_S = 15.0
+POLL_MAX_WAIT_S = 30.0
+
+log = logging.getLogger(__name__)
+
+_TOPIC_OF = {key: topic for topic, keys in TOPICS.items() for key in keys}
+_RESYNC = object()
+
+
+def encode(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def topic_of(key: str) -> str:
+    return _TOPIC_OF.get(key, "jobs")
+
+
+def parse_topics(raw: str | None) -> frozenset[str]:
+    if not raw:
+        return frozenset(TOPICS)
+    topics = frozenset(t.strip() for t in raw.split(",") if t.strip() in TOPICS)
+    return topics or frozenset(TOPICS)
+
+
+def _parse_version(raw: str | None) -> int:
+    try:
+        return int(str(raw).strip().strip('"'))
+    except (TypeError, ValueError):
+        return -1
+
+
+def _for_topics(ops: Iterable[dict], topics: frozenset[str]) -> list[dict]:
+    return [op for op in ops if topic_of(op["path"].split("/", 2)[1]) in topics]
+
+
+def _split(ops: Iterable[dict]) -> dict[str, list[dict]]:
+    by_topic: dict[str, list[dict]] = {}
+    for op in ops:
+        key = op["path"].split("/", 2)[1]
+        by_topic.setdefault(topic_of(key), []).append(op)
+    return by_topic
+
+
+class _Client:
+    def __init__(self, ws: WebSocket, topics: frozenset[str]):
+        self.ws = ws
+        self.topics = topics
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = 0
+
+    def offer(self, item: tuple[int, str, float] | object) -> None:
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # client lento: inutile recuperare i messaggi persi, basta lo stato attuale
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                self.dropped += 1
+            self.queue.put_nowait(_RESYNC)
+
+
+class Broadcaster:
+    def __init__(self):
+        self._clients: set[_Client] = set()
+        self._version: int | None = None
+        self._full: dict[frozenset[str], tuple[int, str]] = {}
+        self._task: asyncio.Task | None = None
+        self._sse_clients = 0
+
+    # -------------------------------------------------------------- codifica
+
+    def full_frame(self, topics: frozenset[str]) -> tuple[int, str]:
+        """Stato completo per un insieme di argomenti, codificato una volta per versione."""
+
+        cached = self._full.get(topics)
+        if cached is not None and cached[0] == state.version():
+            return cached
+        version, full = state.snapshot()
+        if topics != frozenset(TOPICS):
+            full = {k: v for k, v in full.items() if topic_of(k) in topics}
+        frame = (version, encode({"v": version, "state": full}))
+        self._full[topics] = frame
+        return frame
+
+    # -------------------------------------------------------------- diffusione
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._version = state.version()
+            # contesto vuoto: il task vive quanto l'applicazione
+            self._task = asyncio.create_task(self.pump(), context=contextvars.Context())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def pump(self) -> None:
+        while True:
+            await state.wait_change(self._version)
+            # più modifiche ravvicinate arrivano come un'unica differenza
+            version, ops = state.changes_since(self._version)
+            changed = state.changed_at()
+            self._version = version
+            if ops is None:
+                for client in list(self._clients):
+                    client.offer(_RESYNC)
+                continue
+            for topic, topic_ops in _split(ops).items():
+                frame = (version, encode({"v": version, "topic": topic, "patch": topic_ops}), changed)
+                for client in list(self._clients):
+                    if topic in client.topics:
+                        client.offer(frame)
+
+    # -------------------------------------------------------------- client
+
+    def client_count(self) -> int:
+        return len(self._clients)
+
+    def sse_count(self) -> int:
+        return self._sse_clients
+
+    async def serve(self, ws: WebSocket) -> None:
+        """Gestisce un websocket fino alla disconnessione."""
+
+        await ws.accept()
+        client = _Client(ws, parse_topics(ws.query_params.get("topics")))
+        # registrato prima di leggere lo stato: nessuna modifica va persa
+        self._clients.add(client)
+        sender = asyncio.create_task(self._send_loop(client))
+        try:
+            while (await ws.receive())["type"] != "websocket.disconnect":
+                pass
+        except Exception:
+            pass
+        finally:
+            self._clients.discard(client)
+            sender.cancel()
+            if client.dropped:
+                log.info("Websocket lento: %d messaggi sostituiti dallo stato completo", client.dropped)
+
+    async def _send_loop(self, client: _Client) -> None:
+        ws = client.ws
+        try:
+            since = int(ws.query_params.get("v", "-1"))
+        except ValueError:
+            since = -1
+        try:
+            version, ops = state.changes_since(since)
+            if ops is None:
+                version, frame = self.full_frame(client.topics)
+                await ws.send_text(frame)
+            else:
+                for topic, topic_ops in _split(ops).items():
+                    if topic in client.topics:
+                        await ws.send_text(encode({"v": version, "topic": topic, "patch": topic_ops}))
+            baseline = version
+            while True:
+                item = await client.queue.get()
+                if item is _RESYNC:
+                    baseline, frame = self.full_frame(client.topics)
+                    await ws.send_text(frame)
+                    continue
+                item_version, frame, changed = item
+                if item_version <= baseline:
+                    # già compreso nello stato completo inviato
+                    continue
+                await ws.send_text(frame)
+                metrics.BROADCAST_LAG_SECONDS.observe(time.monotonic() - changed)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # connessione chiusa: la disconnessione la gestisce serve()
+            pass
+
+    # -------------------------------------------------------------- HTTP
+
+    def changes(self, since: int, topics: frozenset[str]) -> tuple[int, dict | None]:
+        """Messaggio per un client alla versione ``since``: differenza, stato
+        completo se la storia non basta, ``None`` se non c'è nulla di nuovo."""
+
+        version, ops = state.changes_since(since)
+        if ops is None:
+            version, full = state.snapshot()
+            if topics != frozenset(TOPICS):
+                full = {k: v for k, v in full.items() if topic_of(k) in topics}
+            return version, {"v": version, "state": full}
+        ops = _for_topics(ops, topics)
+        return version, ({"v": version, "patch": ops} if ops else None)
+
+    def sse(self, request: Request) -> StreamingResponse:
+        topics = parse_topics(request.query_params.get("topics"))
+        since = _parse_version(request.headers.get("last-event-id") or request.query_params.get("v"))
+
+        async def _events():
+            nonlocal since
+            self._sse_clients += 1
+            try:
+                yield f"retry: {SSE_RETRY_MS}\n\n"
+                while True:
+                    version, msg = self.changes(since, topics)
+                    if msg is not None:
+                        kind = "state" if "state" in msg else "patch"
+                        yield f"id: {version}\nevent: {kind}\ndata: {encode(msg)}\n\n"
+                    elif version == since:
+                        # nessuna modifica: commento periodico per tenere viva la connessione
+                        if await state.wait_change(since, SSE_KEEPALIVE_S) == since:
+                            yield ": keepalive\n\n"
+                        continue
+                    since = version
+            finally:
+                self._sse_clients -= 1
+
+        return StreamingResponse(
+            _events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def poll(self, request: Request, wait: float) -> Response:
+        topics = parse_topics(request.query_params.get("topics"))
+        since = _parse_version(request.query_params.get("v") or request.headers.get("if-none-match"))
+        loop = asyncio.get_running_loop()
+        end = loop.time() + max(0.0, min(wait, POLL_MAX_WAIT_S))
+        while True:
+            version, msg = self.changes(since, topics)
+            if msg is not None:
+                return Response(encode(msg), media_type="application/json",
+                                headers={"ETag": f'"{version}"', "Cache-Control": "no-cache"})
+            remaining = end - loop.time()
+            if remaining <= 0:
+                return Response(status_code=304, headers={"ETag": f'"{version}"'})
+            # modifiche ad altri argomenti: si aggiorna la base e si continua ad aspettare
+            since = version
+            await state.wait_change(since, remaining)
+
+
+broadcaster = Broadcaster()
+
+metrics.Gauge(
+    "roomctl_stream_clients", "Client connessi allo stato in tempo reale.", ("transport",),
+    fn=lambda: {("ws",): broadcaster.client_count(), ("sse",): broadcaster.sse_count()},
+)
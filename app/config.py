@@ -1,11 +1,50 @@
+"""Configurazione dell'applicazione: un'unica cache dei file YAML.
+
+Ogni file è letto e validato una sola volta; ad ogni accesso si controlla
+(al più una volta al secondo) ``mtime``/dimensione e, se il file è cambiato,
+lo si rilegge: le modifiche a mano su ``devices.yaml`` valgono senza
+riavviare il servizio. Un file diventato non valido viene segnalato nei log e
+si continua con l'ultima versione buona.
+
+I moduli ricevono snapshot immutabili: ``devices()`` restituisce mapping in
+sola lettura, ``ui_config()`` e ``auth_config()`` dataclass congelate. Per
+modificare ``devices.yaml`` si usa ``update_devices``.
+
+Percorsi (override via env):
+  ROOMCTL_DEVICES    devices.yaml  (dispositivi, canali DSP, orario lezioni)
+  ROOMCTL_CONFIG     config.yaml   (PIN operatore)
+  ROOMCTL_UI_CONFIG  ui.yaml       (preferenze UI)
+"""
 from __future__ import annotations
+import copy
+import logging
 import os
+import threading
+import time
+from dataclasses import dataclass
 from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Callable, Generic, Mapping, TypeVar
+
 import yaml
-import logging
 
-# Percorso della YAML (puoi cambiarlo con env ROOMCTL_CONFIG)
-CONFIG_PATH = Path(os.environ.get("ROOMCTL_CONFIG", "/opt/roomctl/config/devices.yaml"))
+DEVICES_PATH = Path(os.environ.get("ROOMCTL_DEVICES", "/opt/roomctl/config/devices.yaml"))
+MAIN_CONFIG_PATH = Path(os.environ.get("ROOMCTL_CONFIG", "/opt/roomctl/config/config.yaml"))
+UI_CONFIG_PATH = Path(os.environ.get("ROOMCTL_UI_CONFIG", "/opt/roomctl/config/ui.yaml"))
+
+# compatibilità: nome storico del percorso di devices.yaml
+CONFIG_PATH = DEVICES_PATH
+
+# Dati runtime scritti dall'app (journal, snapshot...); esclusi dal deploy rsync
+DATA_DIR = Path(os.environ.get("ROOMCTL_DATA_DIR", "/opt/roomctl/data"))
+
+# intervallo minimo fra due controlli di mtime dello stesso file
+CHECK_INTERVAL_S = 1.0
+
+# scrittura differita (``ConfigFile.stage``): si attende una pausa di
+# WRITE_DEBOUNCE_S fra le modifiche, ma non oltre WRITE_MAX_DELAY_S dalla prima
+WRITE_DEBOUNCE_S = 2.0
+WRITE_MAX_DELAY_S = 10.0
 
 # Default ragionevoli: adatta gli IP ai tuoi
 DEFAULT_DEVICES: dict = {
@@ -18,6 +57,13 @@ DEFAULT_DEVICES: dict = {
         "pjlink_retries": 4,
         "post_power_on_delay_s": 1.5,
     },
+    "dsp": {
+        "host": "192.168.1.230",
+        "port": 4196,
+        "addr": 3,
+        "input": {"0": True, "1": False, "2": False, "3": False},
+        "output": {"0": True, "1": False, "2": False, "3": False, "4": True, "5": False, "6": False, "7": False},
+    },
     "shelly1": {
         "base": "http://192.168.1.10",  # mains: ch1 proiettore, ch2 DSP
         "ch1": 0,
@@ -33,6 +79,9 @@ DEFAULT_DEVICES: dict = {
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
 def _deep_merge(base: dict, override: dict) -> dict:
     out = dict(base)
     for k, v in (override or {}).items():
@@ -43,21 +92,266 @@ def _deep_merge(base: dict, override: dict) -> dict:
     return out
 
 
-def _load_yaml(path: Path) -> dict:
+def freeze(obj: Any) -> Any:
+    """Copia in sola lettura: dict -> mapping immutabile, liste -> tuple."""
+
+    if isinstance(obj, Mapping):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj: Any) -> Any:
+    """Inverso di ``freeze``: copia modificabile e serializzabile in YAML."""
+
+    if isinstance(obj, Mapping):
+        return {k: thaw(v) for k, v in obj.items()}
+    if isinstance(obj, tuple):
+        return [thaw(v) for v in obj]
+    return obj
+
+
+def _read_yaml(path: Path) -> dict:
     if not path.is_file():
         return {}
-    try:
-        with path.open("r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or {}
-    except (OSError, yaml.YAMLError) as exc:
-        log.error("Impossibile leggere config YAML %s: %s", path, exc)
-        return {}
+    with path.open("r", encoding="utf-8") as f:
+        data = yaml.safe_load(f) or {}
     if not isinstance(data, dict):
-        log.error("Config YAML non valida: %s", path)
-        return {}
+        raise ValueError("il contenuto non è una mappa YAML")
     return data
 
-# Carica YAML se esiste e fai il merge con i default
-_yaml = _load_yaml(CONFIG_PATH)
-devices: dict = _deep_merge(DEFAULT_DEVICES, _yaml)
 
+def _atomic_dump(path: Path, raw: dict) -> None:
+    """Scrive ``raw`` in YAML senza mai lasciare un file troncato: file
+    temporaneo, fsync, rename e fsync della directory."""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        yaml.safe_dump(raw, f, allow_unicode=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+_files: list["ConfigFile"] = []
+
+
+class ConfigFile(Generic[T]):
+    """Un file YAML in cache, con validazione e ricarica a caldo.
+
+    ``build`` trasforma il dizionario letto nello snapshot immutabile
+    restituito da ``get`` e solleva ``ValueError`` se il contenuto non è
+    valido.
+
+    Le modifiche passano da ``write`` (salvataggio immediato) o da ``stage``
+    (subito in memoria, su disco in differita da un thread a parte, così
+    raffiche di toggle diventano una sola scrittura sulla SD).
+    """
+
+    def __init__(self, path: Path, build: Callable[[dict], T]):
+        self.path = path
+        self._build = build
+        self._lock = threading.RLock()
+        self._key: tuple | None = None
+        self._checked = 0.0
+        self._raw: dict = {}
+        self._value: T | None = None
+        self._write_lock = threading.Lock()
+        self._dirty_since: float | None = None
+        self._timer: threading.Timer | None = None
+        _files.append(self)
+
+    def _stat_key(self) -> tuple | None:
+        try:
+            st = self.path.stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self, key: tuple | None) -> None:
+        try:
+            raw = _read_yaml(self.path)
+            value = self._build(raw)
+        except (OSError, yaml.YAMLError, ValueError, TypeError) as exc:
+            log.error("Config YAML non valida %s: %s", self.path, exc)
+            if self._value is None:
+                self._raw, self._value = {}, self._build({})
+            # altrimenti si resta sull'ultima versione valida
+            self._key = key
+            return
+        if self._value is not None:
+            log.info("Config %s ricaricata", self.path)
+        self._raw, self._value, self._key = raw, value, key
+
+    def get(self) -> T:
+        now = time.monotonic()
+        if self._value is not None and now - self._checked < CHECK_INTERVAL_S:
+            return self._value
+        with self._lock:
+            self._checked = now
+            key = self._stat_key()
+            # con modifiche non ancora salvate il file su disco è vecchio
+            if self._value is None or (key != self._key and self._dirty_since is None):
+                self._load(key)
+            return self._value
+
+    def raw(self) -> dict:
+        """Copia modificabile del contenuto del file (senza default)."""
+
+        self.get()
+        with self._lock:
+            return copy.deepcopy(self._raw)
+
+    def write(self, raw: dict) -> T:
+        """Valida e salva ``raw`` nel file; restituisce il nuovo snapshot."""
+
+        value = self._build(raw)
+        with self._write_lock:
+            _atomic_dump(self.path, raw)
+            with self._lock:
+                self._raw, self._value = copy.deepcopy(raw), value
+                self._key, self._checked = self._stat_key(), time.monotonic()
+                self._dirty_since = None
+        return value
+
+    def stage(self, raw: dict) -> T:
+        """Valida ``raw`` e lo rende subito attivo; il salvataggio su disco
+        avviene in differita (vedi ``WRITE_DEBOUNCE_S``)."""
+
+        value = self._build(raw)
+        with self._lock:
+            self._raw, self._value = copy.deepcopy(raw), value
+            now = time.monotonic()
+            if self._dirty_since is None:
+                self._dirty_since = now
+            self._schedule_flush(min(WRITE_DEBOUNCE_S, max(0.0, self._dirty_since + WRITE_MAX_DELAY_S - now)))
+        return value
+
+    def update(self, mutate: Callable[[dict], None]) -> T:
+        """``stage`` del contenuto corrente modificato da ``mutate``, in modo
+        atomico rispetto ad altre modifiche concorrenti."""
+
+        with self._lock:
+            raw = self.raw()
+            mutate(raw)
+            return self.stage(raw)
+
+    def _schedule_flush(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self) -> None:
+        """Scrive subito le modifiche in attesa (se ce ne sono)."""
+
+        with self._write_lock:
+            with self._lock:
+                if self._dirty_since is None:
+                    return
+                raw = copy.deepcopy(self._raw)
+                self._dirty_since = None
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            try:
+                _atomic_dump(self.path, raw)
+            except OSError as exc:
+                log.error("Impossibile salvare %s: %s", self.path, exc)
+                with self._lock:
+                    if self._dirty_since is None:
+                        self._dirty_since = time.monotonic()
+                    self._schedule_flush(WRITE_MAX_DELAY_S)
+                return
+            with self._lock:
+                self._key, self._checked = self._stat_key(), time.monotonic()
+
+
+def flush_all() -> None:
+    """Salva le modifiche differite di tutti i file (arresto del servizio)."""
+
+    for f in _files:
+        f.flush()
+
+
+# ---------------------------------------------------------------- devices.yaml
+
+def _build_devices(raw: dict) -> Mapping:
+    merged = _deep_merge(DEFAULT_DEVICES, raw)
+    for section in ("projector", "dsp", "shelly1", "shelly2"):
+        if not isinstance(merged.get(section), dict):
+            raise ValueError(f"sezione '{section}' mancante o non valida")
+    for section in ("projector", "dsp"):
+        conf = merged[section]
+        if not str(conf.get("host") or "").strip():
+            raise ValueError(f"{section}.host mancante")
+        conf["port"] = int(conf["port"])
+    for section in ("shelly1", "shelly2"):
+        base = str(merged[section].get("base") or "")
+        if not base.startswith(("http://", "https://")):
+            raise ValueError(f"{section}.base non valido: {base!r}")
+    return freeze(merged)
+
+
+devices_file: ConfigFile[Mapping] = ConfigFile(DEVICES_PATH, _build_devices)
+
+
+def devices() -> Mapping:
+    """Snapshot immutabile di ``devices.yaml`` fuso con i default."""
+
+    return devices_file.get()
+
+
+def update_devices(mutate: Callable[[dict], None]) -> Mapping:
+    """Applica ``mutate`` al contenuto di ``devices.yaml``: subito in memoria,
+    su disco con scrittura differita e atomica."""
+
+    return devices_file.update(mutate)
+
+
+# ---------------------------------------------------------------- ui.yaml
+
+@dataclass(frozen=True)
+class UIConfig:
+    show_combined: bool = True
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "UIConfig":
+        return cls(show_combined=bool(raw.get("show_combined", True)))
+
+
+ui_file: ConfigFile[UIConfig] = ConfigFile(UI_CONFIG_PATH, UIConfig.from_dict)
+
+
+def ui_config() -> UIConfig:
+    return ui_file.get()
+
+
+# ---------------------------------------------------------------- config.yaml
+
+@dataclass(frozen=True)
+class AuthConfig:
+    pin_plain: str = ""
+    pin_hash: str | None = None
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "AuthConfig":
+        auth = raw.get("auth") or {}
+        if not isinstance(auth, dict):
+            raise ValueError("sezione 'auth' non valida")
+        return cls(pin_plain=str(auth.get("pin_plain") or ""), pin_hash=auth.get("pin_hash") or None)
+
+
+main_file: ConfigFile[AuthConfig] = ConfigFile(MAIN_CONFIG_PATH, AuthConfig.from_dict)
+
+
+def auth_config() -> AuthConfig:
+    return main_file.get()
@@ -0,0 +1,114 @@
+"""Budget di tempo per richiesta, propagato fino ai driver.
+
+Il budget nasce all'ingresso (middleware HTTP, task di background) e viaggia
+in una ``ContextVar``: i driver PJLink, DSP e Shelly lo leggono per ridurre i
+propri timeout e per fallire subito quando il tempo rimasto non basta per il
+passo successivo. Il contesto è ereditato anche dai thread di
+``asyncio.to_thread``, quindi vale anche per il client RS232 sincrono.
+"""
+from __future__ import annotations
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Header con cui la UI comunica all'API il budget residuo (secondi)
+HEADER = "X-Roomctl-Budget"
+
+SCENE_BUDGET_S = float(os.environ.get("ROOMCTL_SCENE_BUDGET_S", "120"))
+# lo spegnimento aula include l'attesa del cooling del proiettore (fino a 90 s)
+SHUTDOWN_BUDGET_S = float(os.environ.get("ROOMCTL_SHUTDOWN_BUDGET_S", "240"))
+COMMAND_BUDGET_S = float(os.environ.get("ROOMCTL_COMMAND_BUDGET_S", "20"))
+
+# sotto questa soglia non ha senso aprire una connessione o inviare un comando
+MIN_STEP_S = 0.05
+
+# richieste lunghe per natura e senza comandi ai dispositivi: nessun budget
+UNBOUNDED_PATHS = ("/events", "/state/poll", "/api/diag/profile")
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "roomctl_deadline", default=None
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Il budget residuo non copre il passo successivo."""
+
+    def __init__(self, what: str, remaining: float):
+        self.what = what
+        self.remaining = remaining
+        super().__init__(
+            f"Tempo esaurito per {what}: budget residuo {max(remaining, 0.0):.1f}s"
+        )
+
+
+@contextmanager
+def budget(seconds: float | None, *, replace: bool = False) -> Iterator[float | None]:
+    """Apre un budget di ``seconds``; annidato non può superare quello esterno,
+    a meno di ``replace=True`` (task di background con vita propria).
+    ``None``: nessun budget nuovo, resta quello del contesto."""
+
+    if seconds is None:
+        yield _deadline.get()
+        return
+    new = time.monotonic() + max(0.0, seconds)
+    current = _deadline.get()
+    if current is not None and not replace:
+        new = min(new, current)
+    token = _deadline.set(new)
+    try:
+        yield new
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Secondi rimasti, o ``None`` se non c'è un budget attivo."""
+
+    dl = _deadline.get()
+    if dl is None:
+        return None
+    return dl - time.monotonic()
+
+
+def check(cost: float, what: str) -> None:
+    """Solleva ``DeadlineExceeded`` se il budget non copre ``cost`` secondi."""
+
+    rem = remaining()
+    if rem is not None and rem < max(cost, MIN_STEP_S):
+        raise DeadlineExceeded(what, rem)
+
+
+def timeout(default: float, what: str) -> float:
+    """Timeout effettivo di un'operazione: il minimo fra ``default`` e il budget."""
+
+    rem = remaining()
+    if rem is None:
+        return default
+    if rem < MIN_STEP_S:
+        raise DeadlineExceeded(what, rem)
+    return min(default, rem)
+
+
+def scene_budget(scene: str) -> float:
+    return SHUTDOWN_BUDGET_S if scene == "spegni_aula" else SCENE_BUDGET_S
+
+
+def budget_for(path: str, header: str | None) -> float | None:
+    """Budget di una richiesta HTTP: default per tipo di endpoint, ridotto dal
+    valore dell'header ``HEADER`` se il chiamante ne ha uno più stretto.
+    ``None`` per gli endpoint in ``UNBOUNDED_PATHS``."""
+
+    if path in UNBOUNDED_PATHS:
+        return None
+    if "/scene/" in path:
+        seconds = scene_budget(path.rstrip("/").rsplit("/", 1)[-1])
+    else:
+        seconds = COMMAND_BUDGET_S
+    if header:
+        try:
+            seconds = min(seconds, float(header))
+        except ValueError:
+            pass
+    return seconds
@@ -0,0 +1,318 @@
+"""Registro dei dispositivi dell'aula con driver di lunga durata.
+
+Prima ogni handler e ogni scena costruiva i propri driver (``PJLinkClient``,
+``DSP408Client``, ``ShellyHTTP``, ``ShellyHTTP_script``), anche più di uno per
+richiesta: socket del DSP e pool HTTP degli Shelly morivano con l'oggetto.
+Qui c'è un'istanza per dispositivo fisico, costruita da ``devices.yaml``
+all'avvio (``open``) e chiusa allo spegnimento (``close``).
+
+Ogni dispositivo ha una chiave con i soli parametri di connessione: quando la
+configurazione cambia (ricaricamento a caldo o modifica dalla UI, vedi
+app/config.py) si ricostruiscono solo i dispositivi la cui chiave è cambiata.
+I driver sostituiti vengono chiusi dopo ``RETIRE_GRACE_S`` secondi, per non
+interrompere i comandi ancora in corso.
+
+I driver si ottengono nei servizi (app/services/), chiamando le funzioni di
+accesso al momento del comando: ``devices.projector()``, ``devices.dsp()``,
+``devices.shelly(nome)``; gli handler di app/api.py e app/ui.py passano sempre
+dai servizi. Le funzioni senza argomenti vanno bene anche come dipendenze
+FastAPI, ma oggi solo app/diag.py ne usa una (``Depends(devices.get_registry)``).
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Mapping
+
+from fastapi import HTTPException
+
+from app import config
+from app.drivers.dsp408 import DSP408Client
+from app.drivers.pjlink import PJLinkClient
+from app.drivers.shelly_http import ShellyHTTP, ShellyHTTP_script
+
+RETIRE_GRACE_S = 30.0
+# ore lampada: cambiano lentamente, una sessione PJLink in più ogni tanto
+LAMP_EVERY_S = 600.0
+
+log = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------- tipi di dispositivo
+
+def _projector_key(conf: Mapping) -> tuple:
+    return (
+        str(conf["host"]),
+        int(conf.get("port", 4352)),
+        str(conf.get("password", "1234") or ""),
+        float(conf.get("pjlink_timeout_s", 8)),
+        int(conf.get("pjlink_retries", 4)),
+        bool(conf.get("pjlink_ping_check", True)),
+    )
+
+
+def _build_projector(key: tuple) -> dict[str, Any]:
+    host, port, password, timeout, retries, ping_check = key
+    return {"main": PJLinkClient(host=host, port=port, password=password, timeout=timeout,
+                                 retries=retries, ping_check=ping_check)}
+
+
+def _dsp_key(conf: Mapping) -> tuple:
+    return (str(conf["host"]), int(conf.get("port", 4196)), int(conf.get("addr", 3)))
+
+
+def _build_dsp(key: tuple) -> dict[str, Any]:
+    host, port, addr = key
+    return {"main": DSP408Client(host, port, addr=addr)}
+
+
+def _shelly_key(conf: Mapping) -> tuple:
+    return (str(conf["base"]),)
+
+
+def _build_shelly(key: tuple) -> dict[str, Any]:
+    # stesso Shelly, due driver: RPC dei relè (async) e script/cover (sincrono)
+    return {"main": ShellyHTTP(base=key[0]), "script": ShellyHTTP_script(key[0])}
+
+
+_KINDS: dict[str, tuple[Callable[[Mapping], tuple], Callable[[tuple], dict[str, Any]]]] = {
+    "projector": (_projector_key, _build_projector),
+    "dsp": (_dsp_key, _build_dsp),
+    "shelly1": (_shelly_key, _build_shelly),
+    "shelly2": (_shelly_key, _build_shelly),
+}
+
+
+def _shelly_readings(status: Mapping) -> dict[str, float]:
+    """Potenza (W) ed energia totale (Wh) per canale da ``Shelly.GetStatus``."""
+
+    out: dict[str, float] = {}
+    for key, val in status.items():
+        if not key.startswith("switch:") or not isinstance(val, Mapping):
+            continue
+        ch = key[len("switch:"):]
+        if isinstance(val.get("apower"), (int, float)):
+            out[f"apower.{ch}"] = val["apower"]
+        energy = val.get("aenergy")
+        if isinstance(energy, Mapping) and isinstance(energy.get("total"), (int, float)):
+            out[f"aenergy.{ch}"] = energy["total"]
+    return out
+
+
+# ---------------------------------------------------------------- registro
+
+@dataclass
+class Device:
+    """Un dispositivo fisico: driver, chiave di configurazione e salute."""
+
+    name: str
+    key: tuple
+    drivers: dict[str, Any]
+    created: float = field(default_factory=time.time)
+    online: bool | None = None
+    last_probe: float | None = None
+    last_error: str | None = None
+    last_seen: float | None = None
+    rtt_s: float | None = None
+    # stato in transizione (proiettore in warm-up/cooling): va ricontrollato presto
+    transitional: bool = False
+    # misure lette dall'ultimo controllo riuscito (storico, app/history.py)
+    readings: dict[str, float] = field(default_factory=dict)
+    lamp_read: float = 0.0
+
+    @property
+    def driver(self) -> Any:
+        return self.drivers["main"]
+
+    def busy(self) -> bool:
+        """True se il driver ha un comando in corso sulla sua connessione unica."""
+
+        busy = getattr(self.driver, "busy", None)
+        return bool(busy and busy())
+
+    async def probe(self) -> bool:
+        """Verifica di raggiungibilità con il controllo proprio del driver.
+
+        Un solo tentativo: i ritentativi sono compito di chi interroga di nuovo.
+        """
+
+        drv = self.driver
+        start = time.monotonic()
+        try:
+            if isinstance(drv, PJLinkClient):
+                power = await drv.get_power(retries=0)
+                ok = power is not None
+                # 2=cooling, 3=warm-up (PJLink POWR)
+                self.transitional = power in (2, 3)
+                if ok:
+                    self.readings["power"] = power
+                    if power == 1 and time.time() - self.lamp_read > LAMP_EVERY_S:
+                        await self._read_lamp(drv)
+            elif isinstance(drv, DSP408Client):
+                ok = await drv.check_status()
+            else:
+                status = await drv.get_status()
+                ok = status is not None
+                if ok:
+                    self.readings = _shelly_readings(status)
+            self.last_error = None if ok else "nessuna risposta"
+        except Exception as exc:
+            ok, self.last_error = False, str(exc) or type(exc).__name__
+        now = time.time()
+        self.online, self.last_probe = ok, now
+        if ok:
+            self.last_seen, self.rtt_s = now, time.monotonic() - start
+        else:
+            self.rtt_s, self.transitional = None, False
+        return ok
+
+    def assume_offline(self, reason: str) -> None:
+        """Esito negativo noto senza interrogare il dispositivo (alimentazione assente)."""
+
+        self.online, self.last_probe, self.last_error = False, time.time(), reason
+        self.rtt_s, self.transitional = None, False
+
+    async def _read_lamp(self, drv: PJLinkClient) -> None:
+        self.lamp_read = time.time()
+        try:
+            hours = await drv.get_lamp_hours(retries=0)
+        except Exception as exc:
+            log.debug("Ore lampada non lette: %s", exc)
+            return
+        if hours is not None:
+            self.readings["lamp_hours"] = hours
+
+    async def close(self) -> None:
+        for role, drv in self.drivers.items():
+            aclose = getattr(drv, "aclose", None)
+            if aclose is None:
+                continue
+            try:
+                await aclose()
+            except Exception as exc:
+                log.warning("Chiusura driver %s/%s fallita: %s", self.name, role, exc)
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "drivers": {role: type(drv).__name__ for role, drv in self.drivers.items()},
+            "created": self.created,
+            "online": self.online,
+            "last_probe": self.last_probe,
+            "last_error": self.last_error,
+            "last_seen": self.last_seen,
+            "rtt_ms": None if self.rtt_s is None else round(self.rtt_s * 1000, 1),
+        }
+
+
+class DeviceRegistry:
+    """Driver di lunga durata, sincronizzati con lo snapshot di ``devices.yaml``."""
+
+    def __init__(self, source: Callable[[], Mapping] = config.devices):
+        self._source = source
+        self._lock = threading.Lock()
+        self._conf: Mapping | None = None
+        self._devices: dict[str, Device] = {}
+        self._retiring: dict[asyncio.Task, Device] = {}
+
+    def sync(self) -> None:
+        """Allinea i driver alla configurazione corrente.
+
+        Lo snapshot di configurazione è immutabile e cambia identità solo a
+        un ricaricamento o a una modifica: nel caso comune è un confronto.
+        """
+
+        conf = self._source()
+        if conf is self._conf:
+            return
+        with self._lock:
+            if conf is self._conf:
+                return
+            for name, (key_of, build) in _KINDS.items():
+                old = self._devices.get(name)
+                try:
+                    key = key_of(conf[name])
+                except (KeyError, TypeError, ValueError) as exc:
+                    log.error("Configurazione dispositivo %s non valida: %s", name, exc)
+                    continue
+                if old is not None and old.key == key:
+                    continue
+                self._devices[name] = Device(name, key, build(key))
+                if old is not None:
+                    log.info("Dispositivo %s ricostruito (configurazione cambiata)", name)
+                    self._retire(old)
+            self._conf = conf
+
+    def get(self, name: str) -> Device:
+        self.sync()
+        dev = self._devices.get(name)
+        if dev is None:
+            raise HTTPException(status_code=503, detail=f"Dispositivo {name} non configurato")
+        return dev
+
+    def driver(self, name: str, role: str = "main") -> Any:
+        return self.get(name).drivers[role]
+
+    def all(self) -> list[Device]:
+        self.sync()
+        return list(self._devices.values())
+
+    def _retire(self, dev: Device) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # fuori dall'event loop: i driver si chiudono con il garbage collector
+            return
+
+        async def _later():
+            await asyncio.sleep(RETIRE_GRACE_S)
+            await dev.close()
+
+        task = loop.create_task(_later(), context=contextvars.Context())
+        self._retiring[task] = dev
+        task.add_done_callback(lambda t: self._retiring.pop(t, None))
+
+    async def open(self) -> None:
+        self.sync()
+        log.info("Registro dispositivi: %s", ", ".join(self._devices))
+
+    async def close(self) -> None:
+        """Chiude tutti i driver (anche quelli in dismissione)."""
+
+        retiring = list(self._retiring.items())
+        for task, _ in retiring:
+            task.cancel()
+        with self._lock:
+            devices, self._devices, self._conf = list(self._devices.values()), {}, None
+        devices += [dev for _, dev in retiring]
+        for dev in devices:
+            await dev.close()
+
+
+registry = DeviceRegistry()
+
+
+# ---------------------------------------------------------------- accesso ai driver
+# Funzioni senza parametri: utilizzabili direttamente con ``Depends``.
+
+def get_registry() -> DeviceRegistry:
+    return registry
+
+
+def projector() -> PJLinkClient:
+    return registry.driver("projector")
+
+
+def dsp() -> DSP408Client:
+    return registry.driver("dsp")
+
+
+def shelly(name: str) -> ShellyHTTP:
+    return registry.driver(name)
+
+
+def shelly_script(name: str) -> ShellyHTTP_script:
+    return registry.driver(name, "script")
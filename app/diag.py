@@ -0,0 +1,159 @@
+"""Endpoint diagnostici riservati all'operatore (tracce scene, percentili,
+registro dispositivi, registro eventi, storico delle misure, fase del
+proiettore da assorbimento, blocchi dell'event loop, profilazione CPU e
+memoria)."""
+from __future__ import annotations
+import asyncio
+import threading
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from app import audit, devices, history, loopwatch, powersig, profiler, tracing
+from app.auth import require_operator
+
+router = APIRouter(dependencies=[Depends(require_operator)])
+
+
+@router.get("/traces")
+async def get_traces(n: int = 10, all: bool = False):
+    """Ultime ``n`` tracce (solo scene, o anche chiamate singole con ``all=1``)
+    più i percentili di latenza aggregati per passo."""
+
+    traces = tracing.recent_traces(n, scenes_only=not all)
+    return {
+        "traces": [t.to_dict() for t in reversed(traces)],
+        "percentiles": tracing.step_percentiles(),
+    }
+
+
+@router.get("/traces/waterfall", response_class=PlainTextResponse)
+async def get_traces_waterfall(n: int = 5, all: bool = False):
+    """Vista waterfall testuale delle ultime ``n`` tracce."""
+
+    traces = tracing.recent_traces(n, scenes_only=not all)
+    if not traces:
+        return "Nessuna traccia registrata\n"
+    return "\n\n".join(tracing.waterfall(t) for t in reversed(traces)) + "\n"
+
+
+@router.get("/devices")
+async def get_devices(
+    probe: bool = False,
+    registry: devices.DeviceRegistry = Depends(devices.get_registry),
+):
+    """Driver attivi nel registro con l'ultimo esito di raggiungibilità;
+    con ``probe=1`` interroga prima tutti i dispositivi in parallelo."""
+
+    devs = registry.all()
+    if probe:
+        await asyncio.gather(*(d.probe() for d in devs))
+    return {"devices": [d.status() for d in devs]}
+
+
+@router.get("/audit")
+async def get_audit(
+    since: float | None = None,
+    until: float | None = None,
+    device: str | None = None,
+    kind: str | None = None,
+    actor: str | None = None,
+    outcome: str | None = None,
+    limit: int = Query(100, ge=1, le=5000),
+):
+    """Registro eventi (comandi, scene, accessi), i più recenti per primi;
+    ``since``/``until`` in secondi epoch, ``outcome=error`` per i soli errori."""
+
+    events = audit.audit.query(since=since, until=until, device=device, kind=kind,
+                               actor=actor, outcome=outcome, limit=limit)
+    return {"events": events, "dropped": audit.audit.dropped}
+
+
+@router.get("/history")
+async def get_history(
+    series: list[str] = Query(default=[]),
+    since: float | None = None,
+    until: float | None = None,
+    points: int = Query(120, ge=1, le=history.MAX_POINTS),
+):
+    """Serie storiche per i grafici: minimo, massimo e media per intervallo
+    (``points`` intervalli fra ``since`` e ``until``, default l'ultima ora).
+    Senza ``series`` elenca le serie disponibili."""
+
+    if not series:
+        return {"series": history.history.names()}
+    out = {}
+    for name in series:
+        data = history.history.query(name, since=since, until=until, points=points)
+        if data is None:
+            raise HTTPException(status_code=404, detail=f"Serie {name} non disponibile")
+        out[name] = data
+    return {"series": out}
+
+
+@router.get("/powersig")
+async def get_powersig():
+    """Fase del proiettore ricavata dall'assorbimento, livelli e soglie appresi."""
+
+    return powersig.signature.status()
+
+
+@router.get("/loop")
+async def get_loop_blocks():
+    """Blocchi dell'event loop oltre soglia, aggregati per punto di chiamata
+    (i più costosi per primi)."""
+
+    return {
+        "threshold_ms": round(loopwatch.watch.threshold_s * 1000, 1),
+        "sites": loopwatch.watch.report(),
+    }
+
+
+@router.delete("/loop")
+async def reset_loop_blocks():
+    """Azzera le statistiche dei blocchi (es. dopo un deploy)."""
+
+    loopwatch.watch.reset()
+    return {"ok": True}
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def get_profile(
+    seconds: float = Query(10.0, gt=0, le=profiler.MAX_SECONDS),
+    interval_ms: float = Query(5.0, ge=1, le=1000),
+    thread: str = Query("all", pattern="^(all|loop)$"),
+):
+    """Campiona gli stack per ``seconds`` secondi e restituisce gli stack
+    collassati (``flamegraph.pl``, speedscope); ``thread=loop`` solo l'event loop."""
+
+    loop_thread = threading.get_ident() if thread == "loop" else None
+    try:
+        return await asyncio.to_thread(profiler.sample, seconds, interval_ms / 1000, loop_thread)
+    except profiler.ProfilerBusy as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+
+
+@router.post("/memory/start")
+async def start_memory(frames: int = Query(10, ge=1, le=50)):
+    """Accende ``tracemalloc`` (``frames`` livelli di stack per allocazione)."""
+
+    profiler.memory_start(frames)
+    return {"tracing": True}
+
+
+@router.post("/memory/stop")
+async def stop_memory():
+    profiler.memory_stop()
+    return {"tracing": False}
+
+
+@router.get("/memory")
+async def get_memory(
+    top: int = Query(30, ge=1, le=500),
+    diff: bool = False,
+    key: str = Query("lineno", pattern="^(lineno|filename|traceback)$"),
+):
+    """Istantanea ``tracemalloc``: righe che allocano di più o, con ``diff=1``,
+    differenza rispetto all'istantanea precedente."""
+
+    return await asyncio.to_thread(profiler.memory_snapshot, top, diff, key)
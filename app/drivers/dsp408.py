@@ -1,9 +1,15 @@
 # app/drivers/dsp408.py
 from __future__ import annotations
 import asyncio
+import logging
 import socket
+import threading
 import time
 from typing import Tuple, Optional, Union, Dict
+from app import deadline, metrics
+from app.tracing import span, note_retry
+
+log = logging.getLogger(__name__)
 
 # === Stack di basso livello (TUO codice, con minimi ritocchi) ===
 
@@ -39,13 +45,17 @@ class RS232TCPClient:
 		self.timeout = timeout
 		self._sock: Optional[socket.socket] = None
 		self._last_send_ts = 0.0
+		self._connected_once = False
 		self.debug = debug
 
 	def connect(self):
 		if self._sock: return
-		s = socket.create_connection((self.host, self.port), timeout=self.timeout)
+		s = socket.create_connection((self.host, self.port), timeout=deadline.timeout(self.timeout, "connessione DSP"))
 		s.settimeout(self.timeout)
 		self._sock = s
+		if self._connected_once:
+			metrics.DRIVER_RECONNECTS.inc("dsp")
+		self._connected_once = True
 
 	def close(self):
 			if self._sock:
@@ -69,6 +79,7 @@ class RS232TCPClient:
 					)
 					return resp is not None
 			except Exception:
+					self.close()
 					return False
 
 	@staticmethod
@@ -100,7 +111,7 @@ class RS232TCPClient:
 			if not chunk:
 				raise ConnectionError("Connessione chiusa dal peer")
 			data.extend(chunk)
-		if self.debug: print(f"RX: {bytes(data)}")
+		if self.debug: log.debug("RX: %r", bytes(data))
 		return bytes(data)
 
 	CMDS_WITH_REPLY = {0x48, 0x49, 0x4A}
@@ -108,14 +119,28 @@ class RS232TCPClient:
 	def send_command(self, cmd: int, d1: int=0, d2: int=0, d3: int=0, answ_byte=1, *,
 					 expect_reply: Optional[bool]=None, expect_echo: bool=False,
 					 reply_timeout: Optional[float]=None) -> Union[Tuple[int, int], None]:
+		with span("rs232", device="dsp", command=self.CMD_NAMES.get(cmd, hex(cmd))):
+			return self._send_command(cmd, d1, d2, d3, answ_byte, expect_reply=expect_reply,
+									  expect_echo=expect_echo, reply_timeout=reply_timeout)
+
+	def _send_command(self, cmd: int, d1: int, d2: int, d3: int, answ_byte: int, *,
+					  expect_reply: Optional[bool], expect_echo: bool,
+					  reply_timeout: Optional[float]) -> Union[Tuple[int, int], None]:
 		self.connect()
 		now = time.monotonic()
 		delta = now - self._last_send_ts
 		if delta < self.min_step:
+			deadline.check(self.min_step - delta, "comando DSP")
 			time.sleep(self.min_step - delta)
 		pkt = self._build_packet(self.addr, cmd, d1, d2, d3)
-		if self.debug: print(f"TX: {pkt}")
-		self._sock.sendall(pkt)
+		if self.debug: log.debug("TX: %r", pkt)
+		try:
+			self._sock.sendall(pkt)
+		except OSError:
+			# socket rimasto aperto fra due comandi e chiuso dal convertitore: una riconnessione
+			self.close()
+			self.connect()
+			self._sock.sendall(pkt)
 		self._last_send_ts = time.monotonic()
 		if expect_reply is None:
 			expect_reply = (cmd in self.CMDS_WITH_REPLY)
@@ -123,6 +148,7 @@ class RS232TCPClient:
 			return None
 		time.sleep(0.02)
 		total_timeout = reply_timeout if reply_timeout is not None else max(self.timeout, 2.0)
+		total_timeout = deadline.timeout(total_timeout, "risposta DSP")
 		resp = self._read_reply_packet(sent_pkt=pkt, allow_echo=expect_echo, n_byte=answ_byte, total_timeout=total_timeout)
 		r_d2, r_d3 = self._parse_packet(resp)
 		return r_d2, r_d3
@@ -136,6 +162,12 @@ class RS232TCPClient:
 	CMD_GET_MUTE      = 0x49
 	CMD_GET_PRESET    = 0x4A
 
+	CMD_NAMES = {
+		CMD_GAIN: "GAIN", CMD_MUTE: "MUTE", CMD_LOAD_PRESET: "LOAD_PRESET",
+		CMD_INPUT_VOLUME: "INPUT_VOLUME", CMD_OUTPUT_VOLUME: "OUTPUT_VOLUME",
+		CMD_GET_GAIN: "GET_GAIN", CMD_GET_MUTE: "GET_MUTE", CMD_GET_PRESET: "GET_PRESET",
+	}
+
 	def _read_reply_packet(self, *, sent_pkt: bytes, allow_echo: bool, n_byte: int, total_timeout: float) -> bytes:
 		deadline = time.monotonic() + total_timeout
 		first = self._recv_exact(n_byte, deadline)
@@ -181,7 +213,7 @@ class RS232TCPClient:
 
 	def set_output_volume_db(self, channel: int, db: float) -> None:
 		code = db_to_code(db)
-		print('code:',code)
+		log.debug("set_output_volume_db ch=%d db=%.1f code=%d", channel, db, code)
 		hi = (code >> 8) & 0xFF; lo = code & 0xFF
 		self.send_command(self.CMD_OUTPUT_VOLUME, channel & 0xFF, hi, lo, expect_reply=False, expect_echo=False)
 
@@ -190,7 +222,10 @@ class RS232TCPClient:
 		ch = channel & 0xFF
 		try:
 			r_d2, r_d3 = self.send_command(self.CMD_GET_GAIN, d1, ch, 0x00, answ_byte=2, expect_reply=True, expect_echo=False, reply_timeout=3.0)
+		except deadline.DeadlineExceeded:
+			raise
 		except TimeoutError:
+			note_retry()
 			r_d2, r_d3 = self.send_command(self.CMD_GET_GAIN, d1, ch, 0x00, answ_byte=2, expect_reply=True, expect_echo=False, reply_timeout=3.0)
 		if r_d2 == 0 and r_d3 == 0:
 			return 0.0
@@ -198,7 +233,7 @@ class RS232TCPClient:
 		if code > 400 and r_d2 == 0:
 			code = r_d3
 		code = max(0, min(400, code))
-		print(code)
+		log.debug("get_gain_db out=%s ch=%d code=%d", is_output, channel, code)
 		return code_to_db(code)
 
 # === Wrapper Async “alto livello” ===
@@ -210,6 +245,8 @@ class DSP408Client:
 	def __init__(self, host: str, port: int = 4196, timeout: float = 3.0, addr: int = 3, min_step_ms: int = 50,
 				 bus_map: Optional[Dict[str, Tuple[bool,int]]] = None, debug: bool=False):
 		self._cli = RS232TCPClient(host=host, port=port, device_address=addr, min_step_ms=min_step_ms, timeout=timeout, debug=debug)
+		# istanza condivisa (app/devices.py): un solo thread alla volta sul socket
+		self._lock = threading.Lock()
 		# bus_map: 'in_a' -> (False, 0), 'out0' -> (True, 0) ...
 		self.bus_map = bus_map or {
 			"in_a": (False, 0),  # input A = canale 0
@@ -225,6 +262,21 @@ class DSP408Client:
 			"out6": (True, 6),
 			"out7": (True, 7),}
 
+	def _locked(self, fn):
+		with self._lock:
+			try:
+				return fn()
+			except (OSError, TimeoutError):
+				# stato del flusso incerto: il prossimo comando riapre la connessione
+				self._cli.close()
+				raise
+
+	async def _run(self, fn):
+		return await asyncio.to_thread(self._locked, fn)
+
+	async def aclose(self) -> None:
+		await self._run(self._cli.close)
+
 	def _resolve(self, bus: str) -> Tuple[bool, int]:
 		if bus not in self.bus_map:
 			raise ValueError(f"bus sconosciuto: {bus}")
@@ -236,8 +288,7 @@ class DSP408Client:
 		def _do():
 			in_map = used_inputs or {}
 			out_map = used_outputs or {}
-			print(in_map)
-			print("--",out_map)
+			log.debug("mute_all on=%s ingressi usati %s, uscite usate %s", on, in_map, out_map)
 
 			def _as_bool(val: object, default: bool = True) -> bool:
 				if val is None:
@@ -253,7 +304,7 @@ class DSP408Client:
 			for ch in (0, 1, 2, 3):
 				ch_s = str(ch)
 				if _is_enabled(in_map, ch_s):
-					print("mute-in(", ch_s, ")=", bool(on))
+					log.debug("mute in%s=%s", ch_s, bool(on), extra={"sample": 4})
 					self._cli.set_mute(is_output=False, channel=ch, mute=bool(on))
 				else:
 					self._cli.set_mute(is_output=False, channel=ch, mute=True)
@@ -270,7 +321,8 @@ class DSP408Client:
 				else:
 					self._cli.set_mute(is_output=True, channel=ch, mute=True)
 
-		await asyncio.to_thread(_do)
+		with span("dsp.mute_all", device="dsp", command="mute_all"):
+			await self._run(_do)
 
 	async def apply_gain_delta(self, bus: str, sign: int) -> float:
 		"""
@@ -278,15 +330,16 @@ class DSP408Client:
 		Qui uso step = 1.0 dB come “delta logico”.
 		"""
 		is_out, ch = self._resolve(bus)
-		print(bus,is_out,ch)
+		log.debug("gain_delta bus=%s out=%s ch=%d sign=%d", bus, is_out, ch, sign)
 		def _do() -> float:
 			cur = self._cli.get_gain_db(is_output=is_out, channel=ch)
-			print("curr",cur)
+			log.debug("gain %s attuale %.1f dB", bus, cur)
 			new = max(-60.0, min(+12.0, cur + (1.0 if sign > 0 else -1.0)))
-			print("new ",new)
+			log.debug("gain %s nuovo %.1f dB", bus, new)
 			self._cli.set_gain(is_out,ch, sign)
 			return new
-		return await asyncio.to_thread(_do)
+		with span("dsp.gain_delta", device="dsp", command=f"gain_delta {bus}"):
+			return await self._run(_do)
 
 	async def apply_volume_delta(self, bus: str, sign: int) -> float:
 		def _do() -> float:
@@ -312,12 +365,19 @@ class DSP408Client:
 			else:
 				idx = int(preset[1:])  # U01 -> 1
 				self._cli.recall_preset(user=True, preset_index=idx)
-		await asyncio.to_thread(_do)
+		with span("dsp.recall", device="dsp", command=f"recall {preset}"):
+			await self._run(_do)
+
+	def busy(self) -> bool:
+			"""True se un comando sta usando il socket RS232 (connessione unica)."""
+
+			return self._lock.locked()
 
 	async def check_status(self) -> bool:
 			"""Controlla rapidamente se il DSP è online."""
 
-			return await asyncio.to_thread(self._cli.check_connection)
+			with span("dsp.check", device="dsp", command="check_status"):
+				return await self._run(self._cli.check_connection)
 
 	async def read_levels(self) -> Dict[str, Dict[str, float]]:
 			def _do() -> Dict[str, Dict[str, float]]:
@@ -328,6 +388,7 @@ class DSP408Client:
 						g[bus] = val
 						v[bus] = val
 					return {"gain": g, "volume": v}
-			return await asyncio.to_thread(_do)
+			with span("dsp.read_levels", device="dsp", command="read_levels"):
+				return await self._run(_do)
 
 
@@ -1,6 +1,8 @@
 #app/drivers/pjlink.py
 import asyncio, hashlib, re
 from typing import Optional
+from app import deadline
+from app.tracing import span, note_retry
 
 class PJLinkError(RuntimeError):
     """Errore generico PJLink."""
@@ -38,6 +40,8 @@ class PJLinkClient:
         self.ping_check = ping_check
         # mappa sorgenti: adatta se il tuo modello usa codici diversi
         self.input_map = {"Computer1": "11","Computer2": "12", "HDMI1": "32", "HDMI2": "33", "HDBaseT": "56"}
+        # istanza condivisa (app/devices.py): una connessione alla volta verso il proiettore
+        self._lock: Optional[asyncio.Lock] = None
 
     async def _open(self):
         if self.ping_check and not await self._preflight_ping():
@@ -47,17 +51,18 @@ class PJLinkClient:
                 "Host non raggiungibile (ping fallito)",
                 ConnectionError("Ping fallito"),
             )
+        limit = deadline.timeout(self.timeout, "connessione PJLink")
         try:
             return await asyncio.wait_for(
                 asyncio.open_connection(self.host, self.port),
-                self.timeout,
+                limit,
             )
         except (asyncio.TimeoutError, OSError) as exc:
             raise PJLinkConnectionError(self.host, self.port, str(exc), exc) from exc
 
     async def _handshake(self, r: asyncio.StreamReader, w: asyncio.StreamWriter):
         # Legge il banner: "PJLINK 0" oppure "PJLINK 1 xxxxxxxx\r"
-        banner = await asyncio.wait_for(r.readuntil(b"\r"), self.timeout)
+        banner = await asyncio.wait_for(r.readuntil(b"\r"), deadline.timeout(self.timeout, "banner PJLink"))
         text = banner.decode(errors="ignore").strip()
         # print("PJLINK banner:", text)
         m = re.match(r"PJLINK\s+(\d)(?:\s+([0-9A-Fa-f]+))?", text)
@@ -67,54 +72,80 @@ class PJLinkClient:
         rand = m.group(2) or ""
         return need_auth, rand
 
-    async def _send_cmd(self, cmd: str) -> str:
+    async def _send_cmd(self, cmd: str, retries: Optional[int] = None) -> str:
+        with span("pjlink", device="projector", command=cmd):
+            return await self._send_cmd_retry(cmd, self.retries if retries is None else retries)
+
+    async def _send_cmd_retry(self, cmd: str, retries: int) -> str:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
         last_exc = None
-        for attempt in range(self.retries + 1):
+        for attempt in range(retries + 1):
+            if attempt:
+                note_retry()
+            deadline.check(deadline.MIN_STEP_S, f"comando PJLink {cmd}")
             try:
-                r, w = await self._open()
-                w.write(b"\r"); await w.drain()
-                need_auth, rand = await self._handshake(r, w)
-
-                # Comando in formato PJLink: %1<cmd>\r
-                payload = f"%1{cmd}\r"
-
-                if need_auth:
-                    if not self.password:
-                        w.close()
-                        await w.wait_closed()
-                        raise PJLinkError("PJLink richiede password ma non è configurata.")
-                    # MD5( rand + password + payload_senza_CR )
-                    to_hash = (rand + self.password).encode()
-                    auth = hashlib.md5(to_hash).hexdigest()
-                    payload = auth + payload  # prefisso con hash
-
-                w.write(payload.encode())
-                await w.drain()
-                # risposta termina con \r
-                resp = await asyncio.wait_for(r.readuntil(b"\r"), self.timeout)
-                w.close()
-                try:
-                    await w.wait_closed()
-                except Exception:
-                    pass
-                return resp.decode(errors="ignore").strip()
+                async with self._lock:
+                    return await self._exchange(cmd)
             except PJLinkConnectionError as exc:
                 last_exc = exc
                 # Se la rete non è raggiungibile (es. ENETUNREACH/113) non insistiamo
                 errno = getattr(exc.cause, "errno", None)
                 if errno in {101, 113}:  # network unreachable / no route to host
                     break
-                await asyncio.sleep(0.4 * (attempt + 1))  # backoff breve
+                await self._backoff(attempt, retries, cmd, exc)
+            except deadline.DeadlineExceeded:
+                raise
             except Exception as exc:
                 last_exc = exc
-                await asyncio.sleep(0.4 * (attempt + 1))  # backoff breve
+                await self._backoff(attempt, retries, cmd, exc)
         if isinstance(last_exc, PJLinkError):
             raise last_exc
         raise PJLinkError("Errore PJLink sconosciuto") from last_exc
 
+    async def _exchange(self, cmd: str) -> str:
+        r, w = await self._open()
+        w.write(b"\r"); await w.drain()
+        need_auth, rand = await self._handshake(r, w)
+
+        # Comando in formato PJLink: %1<cmd>\r
+        payload = f"%1{cmd}\r"
+
+        if need_auth:
+            if not self.password:
+                w.close()
+                await w.wait_closed()
+                raise PJLinkError("PJLink richiede password ma non è configurata.")
+            # MD5( rand + password + payload_senza_CR )
+            to_hash = (rand + self.password).encode()
+            auth = hashlib.md5(to_hash).hexdigest()
+            payload = auth + payload  # prefisso con hash
+
+        w.write(payload.encode())
+        await w.drain()
+        # risposta termina con \r
+        resp = await asyncio.wait_for(r.readuntil(b"\r"), deadline.timeout(self.timeout, f"risposta PJLink {cmd}"))
+        w.close()
+        try:
+            await w.wait_closed()
+        except Exception:
+            pass
+        return resp.decode(errors="ignore").strip()
+
+    async def _backoff(self, attempt: int, retries: int, cmd: str, exc: BaseException) -> None:
+        if attempt >= retries:
+            return
+        delay = 0.4 * (attempt + 1)  # backoff breve
+        # se dopo l'attesa non resta tempo per un tentativo, meglio fallire subito
+        rem = deadline.remaining()
+        if rem is not None and rem < delay + self.timeout / 4:
+            raise deadline.DeadlineExceeded(f"comando PJLink {cmd} (ultimo errore: {exc})", rem)
+        await asyncio.sleep(delay)
+
     async def _preflight_ping(self) -> bool:
         """Esegue un ping veloce (1 pacchetto, 1s) prima di aprire la connessione."""
 
+        limit = deadline.timeout(2, "ping proiettore")
         try:
             proc = await asyncio.create_subprocess_exec(
                 "ping",
@@ -127,7 +158,7 @@ class PJLinkClient:
                 stderr=asyncio.subprocess.DEVNULL,
             )
             try:
-                await asyncio.wait_for(proc.wait(), timeout=2)
+                await asyncio.wait_for(proc.wait(), timeout=limit)
             except asyncio.TimeoutError:
                 proc.kill()
                 return False
@@ -150,12 +181,23 @@ class PJLinkClient:
         resp = await self._send_cmd(f"INPT {code}")
         return "OK" in resp
 
-    async def get_power(self) -> Optional[int]:
-        resp = await self._send_cmd("POWR ?")
+    async def get_power(self, retries: Optional[int] = None) -> Optional[int]:
+        resp = await self._send_cmd("POWR ?", retries)
         # risposta tipica: %1POWR=0|1|2|3 oppure ERRA/ERRA
         m = re.search(r"POWR=(\d)", resp)
         return int(m.group(1)) if m else None
 
+    async def get_lamp_hours(self, retries: Optional[int] = None) -> Optional[int]:
+        resp = await self._send_cmd("LAMP ?", retries)
+        # risposta tipica: %1LAMP=1234 1 (ore, lampada accesa); più lampade in fila
+        m = re.search(r"LAMP=(\d+)", resp)
+        return int(m.group(1)) if m else None
+
+    def busy(self) -> bool:
+        """True se un comando sta usando la connessione (il proiettore ne accetta una)."""
+
+        return self._lock is not None and self._lock.locked()
+
     async def check_status(self) -> bool:
         """Verifica la raggiungibilità del proiettore interrogando lo stato."""
 
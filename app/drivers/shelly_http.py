@@ -5,6 +5,8 @@ from typing import Union
 import httpx
 import requests
 import logging
+from app import deadline
+from app.tracing import span
 
 class ShellyHTTP:
     """
@@ -20,14 +22,31 @@ class ShellyHTTP:
             raise ValueError("ShellyHTTP: specifica base/base_url o host")
         self.base = base_url.rstrip("/")
         self.timeout = timeout
+        self.name = f"shelly@{self.base.split('//', 1)[-1]}"
+        self._http: httpx.AsyncClient | None = None
+
+    def _client(self) -> httpx.AsyncClient:
+        # pool keep-alive condiviso dalle richieste (istanza di lunga durata, app/devices.py)
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            )
+        return self._http
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     async def set_relay(self, relay: Union[int, str], on: bool) -> bool:
         """Accendi/Spegni canale: /rpc/Switch.Set {id, on}"""
         url = f"{self.base}/rpc/Switch.Set"
         payload = {"id": int(relay), "on": bool(on)}
+        limit = deadline.timeout(self.timeout, f"comando Shelly {self.name}")
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as c:
-                r = await c.post(url, json=payload)
+            with span("shelly", device=self.name, command=f"Switch.Set {int(relay)}={bool(on)}"):
+                r = await self._client().post(url, json=payload, timeout=limit)
                 return r.status_code == 200
         except httpx.RequestError as exc:
             logging.getLogger(__name__).error("Errore comando Shelly %s: %s", url, exc)
@@ -35,29 +54,53 @@ class ShellyHTTP:
 
 
 
+    async def get_relay(self, relay: Union[int, str]) -> dict:
+        """Stato canale: /rpc/Switch.GetStatus?id=N (output, apower, aenergy...)"""
+        url = f"{self.base}/rpc/Switch.GetStatus"
+        limit = deadline.timeout(self.timeout, f"stato Shelly {self.name}")
+        try:
+            with span("shelly", device=self.name, command=f"Switch.GetStatus {int(relay)}"):
+                r = await self._client().get(url, params={"id": int(relay)}, timeout=limit)
+                r.raise_for_status()
+                return r.json()
+        except httpx.HTTPError as exc:
+            # letta anche ogni pochi secondi in background: l'errore lo riporta chi chiama
+            logging.getLogger(__name__).debug("Errore lettura stato Shelly %s: %s", url, exc)
+            raise
+
     async def pulse(self, relay: Union[int, str], ms: int = 500) -> bool:
         """
         Impulso semplice: ON -> sleep -> OFF.
         Se il tuo impianto usa logica diversa, adatta qui.
         """
         ok1 = await self.set_relay(relay, True)
+        deadline.check(max(ms, 0) / 1000.0, f"impulso Shelly {self.name}")
         await asyncio.sleep(max(ms, 0) / 1000.0)
         ok2 = await self.set_relay(relay, False)
         return ok1 and ok2
 
-    async def is_online(self) -> bool:
-        """Verifica se il dispositivo Shelly risponde alle richieste RPC."""
+    async def get_status(self) -> dict | None:
+        """Stato completo (/rpc/Shelly.GetStatus, con ``switch:N`` di ogni
+        canale); None se il dispositivo non risponde."""
 
         url = f"{self.base}/rpc/Shelly.GetStatus"
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as c:
-                r = await c.get(url)
-                return r.status_code == 200
-        except httpx.RequestError as exc:
-            logging.getLogger(__name__).error(
+            with span("shelly", device=self.name, command="Shelly.GetStatus"):
+                r = await self._client().get(url)
+                if r.status_code != 200:
+                    return None
+                return r.json()
+        except (httpx.RequestError, ValueError) as exc:
+            # chiamata periodica (app/health.py): i cambi di stato li registra il monitor
+            logging.getLogger(__name__).debug(
                 "Shelly %s non raggiungibile: %s", self.base, exc
             )
-            return False
+            return None
+
+    async def is_online(self) -> bool:
+        """Verifica se il dispositivo Shelly risponde alle richieste RPC."""
+
+        return await self.get_status() is not None
 
 class ShellyHTTP_script:
     """
@@ -73,12 +116,20 @@ class ShellyHTTP_script:
             raise ValueError("ShellyHTTP: specifica base/base_url o host")
         self.base = base_url.rstrip("/")
         self.timeout = timeout
+        self.name = f"shelly@{self.base.split('//', 1)[-1]}"
+        # connessioni riusate fra i comandi (istanza di lunga durata, app/devices.py)
+        self._session = requests.Session()
+
+    async def aclose(self) -> None:
+        await asyncio.to_thread(self._session.close)
 
     def projct_off_main(self) -> bool:
         """Spegnimento ritardato proiettore http://IP_DEL_SHELLY/rpc/Script.Start?id=1"""
         url = "http://192.168.1.10/rpc/Script.Start?id=1"
+        limit = deadline.timeout(self.timeout, f"script Shelly {self.name}")
         try:
-            r =  requests.get(url, timeout=self.timeout)
+            with span("shelly", device=self.name, command="Script.Start 1"):
+                r = self._session.get(url, timeout=limit)
             return r.status_code == 200
         except requests.RequestException as exc:
             logging.getLogger(__name__).error("Errore comando Shelly script verso %s: %s", url, exc)
@@ -161,13 +212,15 @@ class ShellyHTTP_script:
 
         url = base + path
         #print(url)#---------------------------------------------------------------------
+        timeout = deadline.timeout(timeout, f"cover Shelly {ip}")
         try:
-            if username and password:
-                resp = requests.get(url, timeout=timeout, auth=(username, password))
-            else:
-                resp = requests.get(url, timeout=timeout)
-                 
-            resp.raise_for_status()
+            with span("shelly", device=f"shelly@{ip}", command=path.split("/rpc/", 1)[1]):
+                if username and password:
+                    resp = self._session.get(url, timeout=timeout, auth=(username, password))
+                else:
+                    resp = self._session.get(url, timeout=timeout)
+
+                resp.raise_for_status()
             #print(resp,"---",resp.raise_for_status())
         except requests.RequestException as e:
             raise ShellyCoverError(f"Errore nella richiesta a {url}: {e}") from e
@@ -185,7 +238,8 @@ class ShellyHTTP_script:
 
         url = f"{self.base}/rpc/Shelly.GetStatus"
         try:
-            r = requests.get(url, timeout=self.timeout)
+            with span("shelly", device=self.name, command="Shelly.GetStatus"):
+                r = self._session.get(url, timeout=self.timeout)
             return r.status_code == 200
         except requests.RequestException as exc:
             logging.getLogger(__name__).error(
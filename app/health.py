@@ -0,0 +1,183 @@
+"""Monitor di salute dei dispositivi in background.
+
+Un task per dispositivo del registro (app/devices.py), tutti concorrenti:
+ognuno interroga il proprio dispositivo con ``Device.probe`` (un solo
+tentativo, budget ``PROBE_BUDGET_S``) e pubblica l'esito nello stato pubblico
+sotto ``health``::
+
+    {"projector": {"online": true, "last_seen": 1700000000, "rtt_ms": 42}, ...}
+
+L'intervallo si adatta: ``FAST_S`` mentre il dispositivo cambia stato
+(proiettore in warm-up/cooling, passaggio online/offline, comando appena
+inviato: vedi ``kick``), poi raddoppia fino a ``STABLE_S`` finché resta
+stabile; un dispositivo offline si ricontrolla ogni ``OFFLINE_S``.
+
+Proiettore e DSP accettano una connessione alla volta: se un comando utente
+la sta usando (``Device.busy``) il controllo viene rimandato di
+``BUSY_RETRY_S`` invece di mettersi in coda.
+
+Ogni esito finisce anche nello storico (app/history.py): raggiungibilità,
+tempo di risposta e le misure lette dal controllo (stato e ore lampada del
+proiettore, potenza ed energia per canale degli Shelly).
+
+Per il proiettore il controllo PJLink si salta quando la fase ricavata
+dall'assorbimento sullo Shelly (app/powersig.py) conferma l'ultimo stato
+letto, o dice che i mains sono spenti; ogni stato letto via PJLink riallinea
+e addestra il classificatore.
+
+Le scene usano ``require`` per fallire subito su un dispositivo che il
+monitor ha visto offline di recente, invece di attendere i timeout.
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import logging
+import time
+
+from fastapi import HTTPException
+
+from app import audit, deadline, devices, history, powersig, tracing
+from app.state import update as update_state
+
+FAST_S = 5.0
+STABLE_S = 60.0
+OFFLINE_S = 15.0
+BUSY_RETRY_S = 2.0
+PROBE_BUDGET_S = 4.0
+# dopo un comando il dispositivo resta sotto osservazione ravvicinata
+KICK_WINDOW_S = 60.0
+# oltre questa età un "offline" non basta per rifiutare un comando
+TRUST_OFFLINE_S = 2 * OFFLINE_S
+
+log = logging.getLogger(__name__)
+
+
+def _public(dev: devices.Device) -> dict:
+    return {
+        "online": dev.online,
+        "last_seen": None if dev.last_seen is None else int(dev.last_seen),
+        "rtt_ms": None if dev.rtt_s is None else round(dev.rtt_s * 1000),
+    }
+
+
+def _record(dev: devices.Device, ok: bool) -> None:
+    """Esito e misure del controllo nello storico (app/history.py)."""
+
+    history.add(f"online.{dev.name}", 1.0 if ok else 0.0)
+    if ok:
+        history.add(f"rtt.{dev.name}", dev.rtt_s * 1000)
+        for key, value in dev.readings.items():
+            history.add(f"{dev.name}.{key}", value)
+
+
+class HealthMonitor:
+    def __init__(self, registry: devices.DeviceRegistry = devices.registry):
+        self._registry = registry
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._wake: dict[str, asyncio.Event] = {}
+        self._fast_until: dict[str, float] = {}
+        self._kicked: dict[str, float] = {}
+
+    def start(self) -> None:
+        for dev in self._registry.all():
+            task = self._tasks.get(dev.name)
+            if task is None or task.done():
+                self._wake[dev.name] = asyncio.Event()
+                # contesto vuoto: il task vive quanto l'applicazione
+                self._tasks[dev.name] = asyncio.create_task(self._watch(dev.name), context=contextvars.Context())
+
+    async def stop(self) -> None:
+        tasks, self._tasks = list(self._tasks.values()), {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def kick(self, name: str) -> None:
+        """Segnala un comando appena inviato a ``name``: controllo subito e
+        ravvicinato per ``KICK_WINDOW_S``; gli esiti precedenti non valgono più."""
+
+        self._kicked[name] = time.time()
+        self._fast_until[name] = time.monotonic() + KICK_WINDOW_S
+        wake = self._wake.get(name)
+        if wake is not None:
+            wake.set()
+
+    def require(self, name: str) -> None:
+        """``HTTPException`` 503 se ``name`` è risultato offline nell'ultimo controllo recente."""
+
+        dev = self._registry.get(name)
+        if dev.online is not False or dev.last_probe is None:
+            return
+        if dev.last_probe < self._kicked.get(name, 0.0) or time.time() - dev.last_probe > TRUST_OFFLINE_S:
+            return
+        # al prossimo tentativo l'esito sarà aggiornato
+        self.kick(name)
+        raise HTTPException(status_code=503, detail=f"Dispositivo {name} non raggiungibile: {dev.last_error or 'nessuna risposta'}")
+
+    async def _watch(self, name: str) -> None:
+        interval = FAST_S
+        while True:
+            try:
+                dev = self._registry.get(name)
+                if dev.busy():
+                    await asyncio.sleep(BUSY_RETRY_S)
+                    continue
+                verdict = self._verdict(dev)
+                if verdict == "agree":
+                    history.add("projector.power", dev.readings.get("power"))
+                    await self._sleep(name, FAST_S)
+                    continue
+                was = dev.online
+                if verdict == "off":
+                    dev.assume_offline("alimentazione assente (relè Shelly aperto)")
+                    ok = False
+                else:
+                    with deadline.budget(PROBE_BUDGET_S, replace=True), audit.quiet(), tracing.untraced():
+                        ok = await dev.probe()
+                    if ok and name == "projector":
+                        powersig.signature.observe_pjlink(dev.readings.get("power"))
+                if was is not None and ok != was:
+                    log.warning("Dispositivo %s %s", name, "di nuovo online" if ok else f"offline: {dev.last_error}")
+                update_state(lambda st: st.setdefault("health", {}).__setitem__(name, _public(dev)))
+                _record(dev, ok)
+                if ok != was or dev.transitional or time.monotonic() < self._fast_until.get(name, 0.0):
+                    interval = FAST_S
+                elif not ok:
+                    interval = OFFLINE_S
+                else:
+                    interval = min(interval * 2, STABLE_S)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.error("Controllo salute %s fallito: %s", name, exc)
+                interval = STABLE_S
+            await self._sleep(name, interval)
+
+    @staticmethod
+    def _verdict(dev: devices.Device) -> str | None:
+        if dev.name != "projector":
+            return None
+        last_code = dev.readings.get("power") if dev.online else None
+        return powersig.signature.probe_verdict(last_code, dev.last_probe)
+
+    async def _sleep(self, name: str, interval: float) -> None:
+        # asyncio.wait e non wait_for: su 3.11 wait_for può perdere una
+        # cancellazione che arriva insieme al risveglio (stop() resterebbe appeso)
+        wake = self._wake[name]
+        waiter = asyncio.ensure_future(wake.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=interval)
+        finally:
+            waiter.cancel()
+        wake.clear()
+
+
+monitor = HealthMonitor()
+
+
+def kick(name: str) -> None:
+    monitor.kick(name)
+
+
+def require(name: str) -> None:
+    monitor.require(name)
@@ -0,0 +1,345 @@
+"""Storico delle misure (stile RRD) su file mappati in memoria.
+
+Ogni serie (``rtt.projector``, ``shelly1.apower.0``, ``soc.temp``...) è un file
+di dimensione fissa in ``HISTORY_DIR`` con un anello per livello di
+risoluzione (``TIERS``): 10 s per 6 ore, 1 min per un giorno, 10 min per una
+settimana, 1 h per 90 giorni. Ogni anello ha quattro colonne di ``double``
+contigue (minimo, massimo, somma, conteggio) e ogni campione aggiorna la
+cella corrente di tutti i livelli: niente consolidamento a parte, e il file
+(``mmap``) sopravvive ai riavvii senza serializzazione.
+
+Le celle saltate (dispositivo offline, servizio fermo) vengono azzerate alla
+scrittura successiva, così in lettura ogni finestra dell'anello è valida e gli
+aggregati per intervallo sono riduzioni su fette contigue delle colonne
+(``min``/``max``/``sum`` in C), senza controlli riga per riga.
+
+I campioni arrivano dal monitor di salute (app/health.py: tempo di risposta,
+raggiungibilità, stato e ore lampada del proiettore, potenza ed energia degli
+Shelly), dalle letture dei livelli DSP e dalla telemetria di sistema
+(app/telemetry.py: temperatura del SoC, carico, memoria). ``GET /api/diag/history`` restituisce minimo, massimo e media per
+intervallo, già in colonne per i grafici della pagina operatore.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from pathlib import Path
+
+from app.config import DATA_DIR
+
+HISTORY_DIR = Path(os.environ.get("ROOMCTL_HISTORY_DIR", str(DATA_DIR / "history")))
+# (passo in secondi, numero di celle)
+TIERS: tuple[tuple[int, int], ...] = ((10, 2160), (60, 1440), (600, 1008), (3600, 2160))
+MAX_SERIES = 64
+MAX_POINTS = 1000
+# msync periodico: oltre a quanto scrive già il kernel, limita la perdita a una mancanza di corrente
+FLUSH_S = 300.0
+
+_MAGIC = b"RCTS"
+_VERSION = 1
+_HEAD = struct.Struct("<4sII")
+_TIER = struct.Struct("<IIq")
+_COLS = 4  # min, max, somma, conteggio
+_NAME_RE = re.compile(r"^[A-Za-z0-9_.\-]{1,64}$")
+
+log = logging.getLogger(__name__)
+
+
+def _data_offset(tiers) -> int:
+    size = _HEAD.size + _TIER.size * len(tiers)
+    return (size + 7) // 8 * 8
+
+
+class Series:
+    """Una serie su file: per livello passo, celle e ultimo intervallo scritto."""
+
+    def __init__(self, path: Path, tiers=TIERS):
+        self.path = path
+        self.tiers = tiers
+        self._offset = _data_offset(tiers)
+        size = self._offset + 8 * _COLS * sum(rows for _, rows in tiers)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o640)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if not fresh and not self._header_ok():
+            fresh = True
+        if fresh:
+            self._init_header()
+        self._values = memoryview(self._mm)[self._offset:].cast("d")
+        # per livello: (passo, celle, colonne min/max/somma/conteggio)
+        self._rings = []
+        pos = 0
+        for step, rows in tiers:
+            cols = tuple(self._values[pos + c * rows: pos + (c + 1) * rows] for c in range(_COLS))
+            self._rings.append((step, rows, cols))
+            pos += _COLS * rows
+        self._last = [_TIER.unpack_from(self._mm, _HEAD.size + i * _TIER.size)[2] for i in range(len(tiers))]
+
+    def _header_ok(self) -> bool:
+        magic, version, n = _HEAD.unpack_from(self._mm, 0)
+        if magic != _MAGIC or version != _VERSION or n != len(self.tiers):
+            return False
+        for i, (step, rows) in enumerate(self.tiers):
+            if _TIER.unpack_from(self._mm, _HEAD.size + i * _TIER.size)[:2] != (step, rows):
+                return False
+        return True
+
+    def _init_header(self) -> None:
+        _HEAD.pack_into(self._mm, 0, _MAGIC, _VERSION, len(self.tiers))
+        for i, (step, rows) in enumerate(self.tiers):
+            _TIER.pack_into(self._mm, _HEAD.size + i * _TIER.size, step, rows, -1)
+
+    def _set_last(self, i: int, bucket: int) -> None:
+        self._last[i] = bucket
+        step, rows = self.tiers[i]
+        _TIER.pack_into(self._mm, _HEAD.size + i * _TIER.size, step, rows, bucket)
+
+    # -------------------------------------------------------------- scrittura
+
+    @staticmethod
+    def _clear(cols, rows: int, first: int, last: int) -> None:
+        """Azzera le celle degli intervalli ``first``..``last`` (inclusi)."""
+
+        n = min(last - first + 1, rows)
+        start = (last - n + 1) % rows
+        for a, b in ((start, min(start + n, rows)), (0, max(0, start + n - rows))):
+            if b > a:
+                cols[0][a:b] = array("d", [math.inf]) * (b - a)
+                cols[1][a:b] = array("d", [-math.inf]) * (b - a)
+                cols[2][a:b] = array("d", [0.0]) * (b - a)
+                cols[3][a:b] = array("d", [0.0]) * (b - a)
+
+    def add(self, t: float, value: float) -> None:
+        for i, (step, rows, cols) in enumerate(self._rings):
+            bucket = int(t // step)
+            last = self._last[i]
+            if bucket > last or bucket <= last - rows:
+                if bucket <= last - rows:
+                    # orologio tornato indietro oltre la durata del livello: si riparte
+                    last = -1
+                self._clear(cols, rows, max(last + 1, bucket - rows + 1), bucket)
+                self._set_last(i, bucket)
+            slot = bucket % rows
+            if value < cols[0][slot]:
+                cols[0][slot] = value
+            if value > cols[1][slot]:
+                cols[1][slot] = value
+            cols[2][slot] += value
+            cols[3][slot] += 1.0
+
+    # -------------------------------------------------------------- lettura
+
+    def aggregate(self, since: float, until: float, points: int, now: float) -> dict:
+        # il livello più fine che copre ancora ``since``
+        tier = len(self._rings) - 1
+        for i, (step, rows, _) in enumerate(self._rings):
+            if now - since <= step * rows:
+                tier = i
+                break
+        step, rows, cols = self._rings[tier]
+        last = self._last[tier]
+        k = max(1, math.ceil(round((until - since) / max(points, 1) / step, 6)))
+        width = k * step
+        out: dict = {"step_s": width, "tier_s": step, "t": [], "min": [], "max": [], "avg": [], "count": []}
+        lo_valid = last - rows + 1
+        first = int(since // width) * k
+        for b0 in range(first, int(until // step) + 1, k):
+            a, b = max(b0, lo_valid), min(b0 + k - 1, last)
+            mn, mx, total, n = math.inf, -math.inf, 0.0, 0.0
+            if last >= 0 and a <= b:
+                sa, sb = a % rows, b % rows
+                parts = ((sa, sb + 1),) if sa <= sb else ((sa, rows), (0, sb + 1))
+                for x, y in parts:
+                    mn = min(mn, min(cols[0][x:y]))
+                    mx = max(mx, max(cols[1][x:y]))
+                    total += sum(cols[2][x:y])
+                    n += sum(cols[3][x:y])
+            out["t"].append(b0 * step)
+            if n:
+                out["min"].append(mn)
+                out["max"].append(mx)
+                out["avg"].append(round(total / n, 4))
+            else:
+                out["min"].append(None)
+                out["max"].append(None)
+                out["avg"].append(None)
+            out["count"].append(int(n))
+        return out
+
+    def flush(self) -> None:
+        self._mm.flush()
+
+    def close(self) -> None:
+        # le viste sulle colonne vanno rilasciate prima di chiudere la mappa
+        for _, _, cols in self._rings:
+            for col in cols:
+                col.release()
+        self._rings = []
+        self._values.release()
+        self._mm.close()
+
+
+class History:
+    def __init__(self, directory: Path = HISTORY_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # msync e chiusura non si sovrappongono; ``add`` usa solo ``_lock``
+        self._flush_lock = threading.Lock()
+        self._series: dict[str, Series] = {}
+        self._failed: set[str] = set()
+        # serie nuove in apertura in un thread -> campioni arrivati nel frattempo
+        self._opening: dict[str, list[tuple[float, float]]] = {}
+        self._closed = False
+
+    def _open(self, name: str) -> Series | None:
+        # solo per ``load`` (all'avvio, in un thread), con ``_lock`` preso
+        series = self._series.get(name)
+        if series is not None or name in self._failed:
+            return series
+        if not _NAME_RE.match(name) or len(self._series) >= MAX_SERIES:
+            self._failed.add(name)
+            log.warning("Serie storica %s rifiutata (nome non valido o troppe serie)", name)
+            return None
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            series = self._series[name] = Series(self.directory / f"{name}.rrd")
+        except (OSError, ValueError) as exc:
+            self._failed.add(name)
+            log.error("Serie storica %s non disponibile: %s", name, exc)
+        return series
+
+    def add(self, name: str, value: float | None, t: float | None = None) -> None:
+        """Aggiunge un campione (``None`` ignorato); pochi microsecondi.
+
+        Una serie nuova si crea in un thread (mkdir, file da ~200 KB, mmap): i
+        campioni che arrivano intanto restano in attesa e vengono scritti
+        all'apertura. Dopo ``close`` non fa nulla."""
+
+        if value is None:
+            return
+        value = float(value)
+        if math.isnan(value):
+            return
+        t = time.time() if t is None else t
+        with self._lock:
+            if self._closed:
+                return
+            series = self._series.get(name)
+            if series is not None:
+                series.add(t, value)
+                return
+            if name in self._failed:
+                return
+            waiting = self._opening.get(name)
+            if waiting is not None:
+                if len(waiting) < 64:
+                    waiting.append((t, value))
+                return
+            if not _NAME_RE.match(name) or len(self._series) + len(self._opening) >= MAX_SERIES:
+                self._failed.add(name)
+                log.warning("Serie storica %s rifiutata (nome non valido o troppe serie)", name)
+                return
+            self._opening[name] = [(t, value)]
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._open_new(name)
+        else:
+            loop.run_in_executor(None, self._open_new, name)
+
+    def _open_new(self, name: str) -> None:
+        # bloccante, fuori da ``_lock``: crea la serie e scrive i campioni in attesa
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            series = Series(self.directory / f"{name}.rrd")
+        except (OSError, ValueError) as exc:
+            series = None
+            log.error("Serie storica %s non disponibile: %s", name, exc)
+        with self._lock:
+            samples = self._opening.pop(name, [])
+            if series is None:
+                self._failed.add(name)
+                return
+            if self._closed:
+                series.close()
+                return
+            self._series[name] = series
+            for t, value in samples:
+                series.add(t, value)
+
+    def load(self) -> int:
+        """Apre le serie già su disco (bloccante, all'avvio)."""
+
+        try:
+            paths = sorted(self.directory.glob("*.rrd"))
+        except OSError:
+            return 0
+        with self._lock:
+            for path in paths:
+                self._open(path.stem)
+        return len(self._series)
+
+    def names(self) -> list[str]:
+        with self._lock:
+            return sorted(self._series)
+
+    def query(self, name: str, since: float | None = None, until: float | None = None, points: int = 120) -> dict | None:
+        """Minimo, massimo, media e conteggio per intervallo (``points`` intervalli
+        fra ``since`` e ``until``, epoch; default l'ultima ora)."""
+
+        now = time.time()
+        until = now if until is None else min(until, now)
+        since = until - 3600 if since is None else since
+        points = max(1, min(points, MAX_POINTS))
+        with self._lock:
+            series = self._series.get(name)
+            if series is None or since >= until:
+                return None
+            return {"series": name, **series.aggregate(since, until, points, now)}
+
+    def flush(self) -> None:
+        # msync fuori da ``_lock`` (rilascia il GIL ma può durare): intanto ``add`` continua
+        with self._flush_lock:
+            with self._lock:
+                series = list(self._series.values())
+            for s in series:
+                s.flush()
+
+    def close(self) -> None:
+        with self._flush_lock, self._lock:
+            self._closed = True
+            for series in self._series.values():
+                try:
+                    series.flush()
+                    series.close()
+                except (OSError, ValueError) as exc:
+                    log.error("Chiusura serie storica %s fallita: %s", series.path, exc)
+            self._series.clear()
+
+    async def run_flusher(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_S)
+            try:
+                await asyncio.to_thread(self.flush)
+            except (OSError, ValueError) as exc:
+                log.error("Scrittura storico fallita: %s", exc)
+
+
+history = History()
+
+
+def add(name: str, value: float | None, t: float | None = None) -> None:
+    history.add(name, value, t)
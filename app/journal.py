@@ -0,0 +1,121 @@
+"""Journal append-only dei passi di scena, per riprendere dopo un riavvio.
+
+Ogni record è una riga JSON compatta:
+  {"k":"b","id":..,"s":scena,"p":{parametri},"t":epoch}  inizio scena
+  {"k":"s","id":..,"n":passo}                            passo completato
+  {"k":"e","id":..,"o":esito}                            fine scena
+
+Le righe sono poche e piccole; il file viene troncato appena supera
+``JOURNAL_MAX_BYTES`` e non ci sono scene in corso, così la SD non cresce.
+"""
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import secrets
+import time
+from pathlib import Path
+
+from app.config import DATA_DIR
+
+JOURNAL_PATH = Path(os.environ.get("ROOMCTL_JOURNAL", str(DATA_DIR / "scene_journal.log")))
+JOURNAL_MAX_BYTES = 16 * 1024
+
+log = logging.getLogger(__name__)
+_lock = asyncio.Lock()
+
+
+def _append(record: dict, *, compact: bool = False) -> None:
+    line = (json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+    JOURNAL_PATH.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(JOURNAL_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+        if compact and os.fstat(fd).st_size > JOURNAL_MAX_BYTES and _pending_from_disk() is None:
+            os.ftruncate(fd, 0)
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+async def _write(record: dict, *, compact: bool = False) -> None:
+    async with _lock:
+        try:
+            await asyncio.to_thread(_append, record, compact=compact)
+        except OSError as exc:
+            # il journal non deve mai bloccare una scena
+            log.error("Impossibile scrivere il journal %s: %s", JOURNAL_PATH, exc)
+
+
+async def begin(scene: str, params: dict | None = None) -> str:
+    run_id = secrets.token_hex(4)
+    await _write({"k": "b", "id": run_id, "s": scene, "p": params or {}, "t": int(time.time())})
+    return run_id
+
+
+async def step(run_id: str, name: str) -> None:
+    await _write({"k": "s", "id": run_id, "n": name})
+
+
+async def end(run_id: str, outcome: str = "ok") -> None:
+    await _write({"k": "e", "id": run_id, "o": outcome}, compact=True)
+
+
+def _open_runs_from_disk() -> list[dict]:
+    runs: dict[str, dict] = {}
+    try:
+        with JOURNAL_PATH.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # riga troncata da un'interruzione di corrente: si ignora
+                    continue
+                rid = rec.get("id")
+                kind = rec.get("k")
+                if kind == "b":
+                    runs[rid] = {"id": rid, "scene": rec.get("s"), "params": rec.get("p") or {},
+                                 "started": rec.get("t") or 0, "done": []}
+                elif kind == "s" and rid in runs:
+                    runs[rid]["done"].append(rec.get("n"))
+                elif kind == "e":
+                    runs.pop(rid, None)
+    except FileNotFoundError:
+        return []
+    return sorted(runs.values(), key=lambda r: r["started"])
+
+
+def _pending_from_disk() -> dict | None:
+    runs = _open_runs_from_disk()
+    # la più recente è quella rimasta a metà
+    return runs[-1] if runs else None
+
+
+def open_runs() -> list[dict]:
+    """Tutte le scene senza fine nel journal, dalla più vecchia alla più recente.
+
+    Più di una resta aperta solo se una ripresa precedente è fallita a sua
+    volta: le più vecchie vanno chiuse (``end(..., "abandoned")``).
+    """
+
+    try:
+        return _open_runs_from_disk()
+    except OSError as exc:
+        log.error("Impossibile leggere il journal %s: %s", JOURNAL_PATH, exc)
+        return []
+
+
+def pending() -> dict | None:
+    """Rilegge il journal e restituisce la scena interrotta (o ``None``).
+
+    Il dizionario contiene ``id``, ``scene``, ``params``, ``started`` e
+    ``done`` (passi già completati, in ordine).
+    """
+
+    try:
+        return _pending_from_disk()
+    except OSError as exc:
+        log.error("Impossibile leggere il journal %s: %s", JOURNAL_PATH, exc)
+        return None
@@ -0,0 +1,202 @@
+"""Pipeline di logging non bloccante.
+
+``setup`` (chiamata da app/main.py all'import) sostituisce gli handler del
+logger radice con un ``QueueHandler``: chi logga (event loop, thread del DSP,
+thread di guardia) si limita a mettere il record in una coda limitata, e un
+solo thread (``QueueListener``) formatta e scrive su stderr, cioè journald.
+A coda piena i record vengono scartati e contati, mai attesi.
+
+Livelli per sottosistema con ``ROOMCTL_LOG_LEVELS``, per esempio
+``app.drivers.dsp408=DEBUG,app.health=WARNING`` (il livello radice viene da
+``ROOMCTL_LOG_LEVEL``, default ``INFO``). ``ROOMCTL_LOG_FORMAT=json`` produce
+una riga JSON per record invece di ``chiave=valore``.
+
+Limitazione e campionamento, per riga di codice che logga:
+
+- oltre ``RATE_BURST`` record in ``RATE_WINDOW_S`` secondi i successivi
+  vengono scartati; il primo record della finestra seguente riporta quanti
+  ne sono stati soppressi (``suppressed=N``);
+- ``log.debug(..., extra={"sample": 10})`` tiene un record ogni 10.
+
+Campi strutturati aggiuntivi: ``extra={"fields": {"device": "dsp"}}``.
+"""
+from __future__ import annotations
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+from app import metrics
+
+QUEUE_SIZE = 10000
+RATE_BURST = 20
+RATE_WINDOW_S = 60.0
+
+# librerie che a INFO loggano ogni richiesta
+DEFAULT_LEVELS = {"httpx": "WARNING", "httpcore": "WARNING"}
+# logger con handler propri (configurati da uvicorn prima dell'import dell'app):
+# passano anche loro dalla coda
+ADOPTED = ("uvicorn", "uvicorn.error", "uvicorn.access")
+# una sola riga di codice per tutte le richieste: niente limitazione
+RATE_EXEMPT = frozenset({"uvicorn.access"})
+
+_listener: logging.handlers.QueueListener | None = None
+_handler: "_QueueHandler | None" = None
+_out: logging.Handler | None = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Accoda senza mai bloccare; i record in eccesso si contano e si scartano."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # stesso processo: niente copia né formattazione qui, solo il messaggio
+        # risolto (gli argomenti potrebbero cambiare prima della scrittura)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """Limitazione per riga di codice e campionamento con ``extra={"sample": N}``."""
+
+    def __init__(self, burst: int = RATE_BURST, window_s: float = RATE_WINDOW_S):
+        super().__init__()
+        self.burst = burst
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        # (logger, file, riga) -> [inizio finestra, emessi, soppressi, visti]
+        self._sites: dict[tuple, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name in RATE_EXEMPT:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [now, 0, 0, 0]
+            site[3] += 1
+            sample = getattr(record, "sample", 0)
+            if sample and sample > 1 and (site[3] - 1) % sample:
+                return False
+            if now - site[0] >= self.window_s:
+                suppressed = site[2]
+                site[0], site[1], site[2] = now, 0, 0
+                if suppressed:
+                    record.suppressed = suppressed
+            if site[1] >= self.burst and record.levelno < logging.CRITICAL:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """``level=... logger=... msg="..." chiave=valore`` oppure JSON (senza
+    data: la aggiunge journald)."""
+
+    def __init__(self, as_json: bool = False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {"level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        fields.update(getattr(record, "fields", None) or {})
+        if getattr(record, "suppressed", 0):
+            fields["suppressed"] = record.suppressed
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        if self.as_json:
+            return json.dumps(fields, ensure_ascii=False, default=str)
+        return " ".join(f"{str(k).replace(' ', '_')}={_logfmt(v)}" for k, v in fields.items())
+
+
+def _logfmt(value) -> str:
+    text = str(value)
+    if text and not any(c in text for c in ' ="\n'):
+        return text
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+def parse_levels(raw: str | None) -> dict[str, str]:
+    levels: dict[str, str] = {}
+    for item in (raw or "").split(","):
+        name, sep, level = item.partition("=")
+        if sep and name.strip() and _valid_level(level):
+            levels[name.strip()] = _valid_level(level)
+    return levels
+
+
+def _valid_level(raw: str) -> str | None:
+    level = raw.strip().upper()
+    return level if isinstance(logging.getLevelName(level), int) else None
+
+
+def setup() -> None:
+    """Installa la pipeline sul logger radice (idempotente)."""
+
+    global _listener, _handler, _out
+    if _listener is not None:
+        return
+    _out = logging.StreamHandler(sys.stderr)
+    _out.setFormatter(StructuredFormatter(os.environ.get("ROOMCTL_LOG_FORMAT", "").lower() == "json"))
+    q: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+    _handler = _QueueHandler(q)
+    _handler.addFilter(RateLimitFilter())
+    _listener = logging.handlers.QueueListener(q, _out, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_handler)
+    for name in ADOPTED:
+        logger = logging.getLogger(name)
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+        logger.propagate = True
+    raw_level = os.environ.get("ROOMCTL_LOG_LEVEL", "INFO")
+    root_level = _valid_level(raw_level)
+    root.setLevel(root_level or "INFO")
+    for name, level in {**DEFAULT_LEVELS, **parse_levels(os.environ.get("ROOMCTL_LOG_LEVELS"))}.items():
+        logging.getLogger(name).setLevel(level)
+    _listener.start()
+    atexit.register(shutdown)
+    if root_level is None:
+        logging.getLogger(__name__).warning("ROOMCTL_LOG_LEVEL=%r non valido: uso INFO", raw_level)
+
+
+def dropped() -> int:
+    return _handler.dropped if _handler is not None else 0
+
+
+metrics.Gauge("roomctl_log_records_dropped", "Record di log scartati a coda piena.", fn=dropped)
+
+
+def shutdown() -> None:
+    """Svuota la coda e ferma il thread di scrittura; da qui in poi si scrive
+    direttamente (solo i messaggi di chiusura)."""
+
+    global _listener
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(_handler)
+    _listener.stop()
+    _listener = None
+    root.addHandler(_out)
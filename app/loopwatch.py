@@ -0,0 +1,187 @@
+"""Rilevatore di blocchi dell'event loop.
+
+Un callback sull'event loop (``_tick``) aggiorna un battito ogni
+``HEARTBEAT_S``; un thread di guardia lo controlla ogni ``CHECK_S`` e, se il
+battito è fermo da più di ``THRESHOLD_S``, cattura lo stack del thread del
+loop con ``sys._current_frames``: è il codice che lo sta tenendo occupato
+(``requests`` sincrono, ``subprocess``, file YAML, verifica Argon2...).
+
+I blocchi sono aggregati per punto di chiamata, cioè il frame più interno
+che appartiene al pacchetto ``app`` (la riga del nostro codice che ha fatto la
+chiamata bloccante), con conteggio, durata totale e massima e uno stack di
+esempio; li espone ``GET /api/diag/loop`` (app/diag.py).
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from app import metrics
+
+THRESHOLD_S = float(os.environ.get("ROOMCTL_LOOP_BLOCK_MS", "100")) / 1000
+HEARTBEAT_S = 0.05
+CHECK_S = 0.02
+MAX_SITES = 100
+STACK_DEPTH = 12
+
+log = logging.getLogger(__name__)
+
+_APP_DIR = str(Path(__file__).resolve().parent)
+_ROOT = os.path.dirname(_APP_DIR)
+
+LOOP_BLOCKS = metrics.Counter("roomctl_event_loop_blocks_total", "Blocchi dell'event loop oltre la soglia del rilevatore.")
+
+
+@dataclass
+class Site:
+    """Punto di chiamata che ha bloccato il loop."""
+
+    site: str
+    leaf: str
+    stack: list[str]
+    count: int = 0
+    total_s: float = 0.0
+    max_s: float = 0.0
+    last: float = field(default_factory=time.time)
+
+    def to_dict(self) -> dict:
+        return {
+            "site": self.site,
+            "leaf": self.leaf,
+            "count": self.count,
+            "total_ms": round(self.total_s * 1000, 1),
+            "max_ms": round(self.max_s * 1000, 1),
+            "last": self.last,
+            "stack": self.stack,
+        }
+
+
+def _short(filename: str) -> str:
+    return os.path.relpath(filename, _ROOT) if filename.startswith(_APP_DIR) else filename
+
+
+def _where(frame) -> str:
+    return f"{_short(frame.f_code.co_filename)}:{frame.f_lineno} in {frame.f_code.co_name}"
+
+
+def _describe(frame) -> tuple[str, str, list[str]]:
+    """(punto di chiamata nel pacchetto app, frame più interno, stack sintetico)."""
+
+    leaf = _where(frame)
+    site = None
+    stack = []
+    for fs in traceback.extract_stack(frame, limit=None)[::-1][:STACK_DEPTH]:
+        stack.append(f"{_short(fs.filename)}:{fs.lineno} in {fs.name}")
+    cur = frame
+    while cur is not None:
+        if cur.f_code.co_filename.startswith(_APP_DIR) and cur.f_code.co_filename != __file__:
+            site = _where(cur)
+            break
+        cur = cur.f_back
+    return site or leaf, leaf, stack
+
+
+class LoopWatch:
+    def __init__(self, threshold_s: float = THRESHOLD_S):
+        self.threshold_s = threshold_s
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+        self._beat = time.monotonic()
+        self._handle: asyncio.TimerHandle | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._sites: dict[str, Site] = {}
+        # blocco in corso: (sito, inizio)
+        self._episode: tuple[Site, float] | None = None
+
+    # -------------------------------------------------------------- ciclo di vita
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._tick()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loopwatch", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _tick(self) -> None:
+        self._beat = time.monotonic()
+        self._handle = self._loop.call_later(HEARTBEAT_S, self._tick)
+
+    # -------------------------------------------------------------- guardia
+
+    def _watch(self) -> None:
+        while not self._stop.wait(CHECK_S):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if self._episode is None:
+                if stalled - HEARTBEAT_S >= self.threshold_s:
+                    self._capture(beat)
+            elif self._episode[1] != beat:
+                # il loop è ripartito: il blocco è durato fino al battito successivo
+                self._close(beat)
+
+    def _capture(self, start: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return
+        site, leaf, stack = _describe(frame)
+        del frame
+        with self._lock:
+            entry = self._sites.get(site)
+            if entry is None:
+                if len(self._sites) >= MAX_SITES:
+                    # si tiene traccia dei siti peggiori
+                    worst = min(self._sites.values(), key=lambda s: s.total_s)
+                    del self._sites[worst.site]
+                entry = self._sites[site] = Site(site, leaf, stack)
+            entry.leaf, entry.stack = leaf, stack
+        self._episode = (entry, start)
+
+    def _close(self, resumed: float) -> None:
+        entry, start = self._episode
+        self._episode = None
+        blocked = max(0.0, resumed - start - HEARTBEAT_S)
+        with self._lock:
+            first = entry.count == 0
+            worse = blocked > entry.max_s
+            entry.count += 1
+            entry.total_s += blocked
+            entry.max_s = max(entry.max_s, blocked)
+            entry.last = time.time()
+        LOOP_BLOCKS.inc()
+        if first or worse:
+            log.warning("Event loop bloccato %.0f ms da %s (%s)", blocked * 1000, entry.site, entry.leaf)
+
+    # -------------------------------------------------------------- report
+
+    def report(self) -> list[dict]:
+        with self._lock:
+            sites = sorted(self._sites.values(), key=lambda s: s.total_s, reverse=True)
+            return [s.to_dict() for s in sites]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._sites.clear()
+
+
+watch = LoopWatch()
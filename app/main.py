@@ -1,24 +1,104 @@
-from fastapi import FastAPI,WebSocket
+from fastapi import FastAPI,Request,WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-import asyncio
+from fastapi.responses import JSONResponse,PlainTextResponse
+import asyncio,logging
+from app import audit, auth, config, deadline, devices, health, history, logs, loopwatch, metrics, power_policy, powersig, state, telemetry
 from app.main_ui import mount_ui
-from app.state import get_public_state
+from app.broadcast import broadcaster
 from app.api import router as api_router
+from app.services import projector, scenes, status
+from app.services.common import spawn
+from app.diag import router as diag_router
+
+# log in coda, scritti da un thread dedicato (app/logs.py)
+logs.setup()
 
 app=FastAPI()
 mount_ui(app)
 app.include_router(api_router, prefix="/api")
+app.include_router(diag_router, prefix="/api/diag")
 app.add_middleware(CORSMiddleware,allow_origins=['*'],allow_credentials=True,allow_methods=['*'],allow_headers=['*'])
 
+@app.middleware('http')
+async def request_budget(request:Request,call_next):
+ # budget complessivo della richiesta, rispettato da tutti i driver (app/deadline.py)
+ # e autore dei comandi per il registro eventi (app/audit.py)
+ ip=request.client.host if request.client else '?'
+ token=audit.bind_actor(f'op@{ip}' if auth.is_operator(request) else ip)
+ try:
+  with deadline.budget(deadline.budget_for(request.url.path,request.headers.get(deadline.HEADER))):
+   return await call_next(request)
+ finally: audit.reset_actor(token)
+
+@app.exception_handler(deadline.DeadlineExceeded)
+async def deadline_exceeded(request:Request,exc:deadline.DeadlineExceeded):
+ return JSONResponse(status_code=504,content={'detail':str(exc)})
+
+@app.on_event('startup')
+async def startup():
+ # ultimo stato salvato subito, poi verificato sui dispositivi (app/services/status.py)
+ state.restore_snapshot()
+ # indice del registro eventi dai file su disco, poi scrittura a blocchi
+ await asyncio.to_thread(audit.audit.load)
+ spawn(audit.audit.run_writer())
+ # driver di lunga durata, uno per dispositivo (app/devices.py)
+ await devices.registry.open()
+ broadcaster.start()
+ status.schedule_verify()
+ # serie storiche su file mappati, alimentate dal monitor di salute (app/history.py)
+ await asyncio.to_thread(history.history.load)
+ spawn(history.history.run_flusher())
+ # batteria RTC, temperatura, throttling, carico e memoria in cache (app/telemetry.py)
+ spawn(telemetry.sampler.run())
+ # fase del proiettore dall'assorbimento Shelly, per saltare i controlli PJLink (app/powersig.py)
+ await asyncio.to_thread(powersig.signature.load)
+ spawn(powersig.signature.run())
+ # salute dei dispositivi, pubblicata nello stato sotto 'health' (app/health.py)
+ health.monitor.start()
+ # ritardo dell'event loop per /metrics (app/metrics.py)
+ spawn(metrics.run_loop_lag_probe())
+ # stack di chi blocca l'event loop oltre soglia (app/loopwatch.py, /api/diag/loop)
+ loopwatch.watch.start()
+ spawn(state.run_persist_loop())
+ # riprende l'eventuale scena interrotta da un riavvio (vedi app/journal.py)
+ await scenes.schedule_resume()
+ # taglio mains differito rimasto in sospeso prima del riavvio (app/power_policy.py)
+ await power_policy.restore_deferred_cut(projector.cut_mains)
+ # pre-riscaldamento delle scene secondo l'orario lezioni (app/timetable.py)
+ scenes.schedule_prewarm()
+
+@app.on_event('shutdown')
+async def shutdown():
+ # modifiche di configurazione ancora in scrittura differita
+ await asyncio.to_thread(config.flush_all)
+ try: await asyncio.to_thread(audit.audit.flush)
+ except OSError as exc: logging.getLogger('main').error('Registro eventi non salvato: %s',exc)
+ try: await asyncio.to_thread(state.save_snapshot)
+ except OSError as exc: logging.getLogger('main').error('Snapshot stato non salvato: %s',exc)
+ loopwatch.watch.stop()
+ await health.monitor.stop()
+ await asyncio.to_thread(history.history.close)
+ try: await asyncio.to_thread(powersig.signature.save)
+ except OSError as exc: logging.getLogger('main').error('Soglie di assorbimento non salvate: %s',exc)
+ await devices.registry.close()
+ await broadcaster.stop()
+
+@app.get('/events')
+async def events(request:Request):
+ # Server-Sent Events ripristinabili con Last-Event-ID (app/broadcast.py)
+ return broadcaster.sse(request)
+
+@app.get('/state/poll')
+async def state_poll(request:Request,wait:float=25.0):
+ # long-poll: 304 se la versione non cambia entro wait secondi
+ return await broadcaster.poll(request,wait)
+
 @app.websocket('/ws')
 async def ws(ws:WebSocket):
- await ws.accept()
- try:
-  while True:
-   await ws.send_json(get_public_state()); await asyncio.sleep(2.0)
- except Exception:
-  pass
- finally:
-  try: await ws.close()
-  except Exception: pass
+ # un solo task codifica gli aggiornamenti per tutti i client (app/broadcast.py)
+ await broadcaster.serve(ws)
 
+@app.get('/metrics',response_class=PlainTextResponse)
+async def get_metrics():
+ # formato testuale Prometheus (app/metrics.py)
+ return PlainTextResponse(metrics.render(),media_type='text/plain; version=0.0.4; charset=utf-8')
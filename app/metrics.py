@@ -0,0 +1,192 @@
+"""Metriche in formato Prometheus (``GET /metrics``).
+
+Contatori, gauge e istogrammi in memoria, senza dipendenze esterne: ogni
+osservazione è un'addizione sotto un lock condiviso, quindi si possono
+aggiornare anche dai thread di ``asyncio.to_thread`` (client RS232 del DSP,
+script Shelly). ``render`` produce il formato testuale 0.0.4.
+
+Le latenze dei driver arrivano dagli span di app/tracing.py (ogni span con un
+dispositivo), i tempi dei passi di scena da app/services/scenes.py, i client
+e il ritardo di diffusione da app/broadcast.py; ``run_loop_lag_probe`` misura
+quanto l'event loop risveglia in ritardo un timer.
+"""
+from __future__ import annotations
+import asyncio
+import math
+import threading
+import time
+from typing import Callable, Iterable
+
+LOOP_LAG_INTERVAL_S = 0.5
+
+_lock = threading.Lock()
+_metrics: list["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        _metrics.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> list[str]:
+        with _lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Valore impostato con ``set`` o letto al momento da ``fn``."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = (), fn: Callable[[], dict | float] | None = None):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+        self._fn = fn
+
+    def set(self, value: float, *labels) -> None:
+        with _lock:
+            self._values[labels] = value
+
+    def samples(self) -> list[str]:
+        if self._fn is not None:
+            got = self._fn()
+            items = sorted(got.items()) if isinstance(got, dict) else [((), got)]
+        else:
+            with _lock:
+                items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Iterable[str] = (), buckets: Iterable[float] = ()):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # per etichette: [conteggi per bucket (non cumulativi)..., somma, totale]
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        idx = next(i for i, b in enumerate(self.buckets) if value <= b)
+        with _lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+            row[idx] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def samples(self) -> list[str]:
+        with _lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        out = []
+        for key, row in items:
+            acc = 0.0
+            for bound, n in zip(self.buckets, row):
+                acc += n
+                le = 'le="' + _fmt(bound) + '"'
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {_fmt(acc)}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(row[-2])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, key)} {_fmt(row[-1])}")
+        return out
+
+
+def render() -> str:
+    return "\n".join(line for m in _metrics for line in m.render()) + "\n"
+
+
+# ---------------------------------------------------------------- metriche
+
+_DRIVER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DRIVER_SECONDS = Histogram(
+    "roomctl_driver_request_seconds", "Durata delle chiamate ai driver per dispositivo e comando.",
+    ("op", "device", "command"), _DRIVER_BUCKETS,
+)
+DRIVER_ERRORS = Counter(
+    "roomctl_driver_errors_total", "Chiamate ai driver terminate con errore.", ("op", "device", "command"),
+)
+DRIVER_TIMEOUTS = Counter(
+    "roomctl_driver_timeouts_total", "Chiamate ai driver scadute (timeout o budget esaurito).", ("op", "device", "command"),
+)
+DRIVER_RETRIES = Counter("roomctl_driver_retries_total", "Nuovi tentativi dei driver.", ("op", "device"))
+DRIVER_RECONNECTS = Counter("roomctl_driver_reconnects_total", "Riconnessioni dei driver a connessione persistente.", ("device",))
+
+SCENE_STEP_SECONDS = Histogram(
+    "roomctl_scene_step_seconds", "Durata dei passi di scena.", ("scene", "step", "outcome"),
+    (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0),
+)
+
+BROADCAST_LAG_SECONDS = Histogram(
+    "roomctl_broadcast_lag_seconds", "Ritardo fra la modifica dello stato e l'invio al websocket.", (),
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+
+LOOP_LAG_SECONDS = Histogram(
+    "roomctl_event_loop_lag_seconds", "Ritardo di risveglio dell'event loop rispetto al timer.", (),
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+LOOP_LAG_LAST = Gauge("roomctl_event_loop_lag_last_seconds", "Ultimo ritardo misurato dell'event loop.")
+
+
+def command_label(command: str | None) -> str:
+    """Nome del comando senza argomenti (``POWR ?`` -> ``POWR``): cardinalità limitata."""
+
+    if not command:
+        return ""
+    return command.split(" ", 1)[0].rstrip("?") or command
+
+
+async def run_loop_lag_probe() -> None:
+    """Task di background: ogni ``LOOP_LAG_INTERVAL_S`` misura quanto in ritardo
+    si risveglia rispetto al previsto (callback lunghi o bloccanti nel loop)."""
+
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_S)
+        lag = max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL_S)
+        LOOP_LAG_SECONDS.observe(lag)
+        LOOP_LAG_LAST.set(lag)
@@ -0,0 +1,262 @@
+"""Politica di spegnimento dell'alimentazione (mains) del proiettore.
+
+A fine lezione ``scene_spegni_aula`` chiedeva sempre allo Shelly di togliere
+la corrente al proiettore; la lezione successiva pagava così ``nic_warmup_s``
+e un boot PJLink completo. Qui si decide se tagliare i mains o lasciare il
+proiettore in standby di rete, guardando:
+
+- la pianificazione di accensione (``power_schedule.yaml``): fuori orario, o a
+  ridosso dello spegnimento del Raspberry, si taglia sempre;
+- lo storico recente degli avvii lezione: se nelle settimane passate, nello
+  stesso giorno della settimana, una lezione è iniziata entro
+  ``keep_warm_window_min`` da adesso, si tiene caldo;
+- le lezioni consecutive di oggi (avvii ravvicinati).
+
+Se si tiene caldo e la lezione prevista non arriva, un task differito taglia
+comunque i mains allo scadere della finestra, a meno che nel frattempo il
+proiettore sia stato riacceso. La scadenza è
+salvata in ``DEFERRED_CUT_PATH`` e ripresa al riavvio del servizio.
+
+Parametri in ``devices.yaml``, sezione ``projector``:
+  mains_policy: auto | always_cut | keep_warm   (default: auto)
+  keep_warm_window_min: 45
+  usage_history_days: 28
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import datetime as dt
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, NamedTuple
+
+from app import deadline, devices, power_schedule, powersig
+from app.config import DATA_DIR
+
+USAGE_PATH = Path(os.environ.get("ROOMCTL_USAGE_HISTORY", str(DATA_DIR / "usage_history.json")))
+DEFERRED_CUT_PATH = Path(os.environ.get("ROOMCTL_DEFERRED_CUT", str(DATA_DIR / "deferred_cut.json")))
+
+log = logging.getLogger(__name__)
+
+_starts: list[int] | None = None
+_deferred: asyncio.Task | None = None
+_deferred_at: float | None = None
+_deferred_lock = threading.Lock()
+
+
+class PolicySettings(NamedTuple):
+    mode: str
+    window_min: int
+    history_days: int
+
+
+def settings(pconf: dict) -> PolicySettings:
+    return PolicySettings(
+        mode=str(pconf.get("mains_policy", "auto")).strip().lower(),
+        window_min=int(pconf.get("keep_warm_window_min", 45)),
+        history_days=int(pconf.get("usage_history_days", 28)),
+    )
+
+
+def _load_starts() -> list[int]:
+    global _starts
+    if _starts is None:
+        try:
+            with USAGE_PATH.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            _starts = sorted(int(t) for t in data if isinstance(t, (int, float)))
+        except FileNotFoundError:
+            _starts = []
+        except (OSError, ValueError) as exc:
+            log.error("Storico utilizzo non leggibile %s: %s", USAGE_PATH, exc)
+            _starts = []
+    return _starts
+
+
+def _save_starts(starts: list[int]) -> None:
+    USAGE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = USAGE_PATH.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(starts, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, USAGE_PATH)
+
+
+async def record_lesson_start(history_days: int = 28) -> None:
+    """Registra l'avvio di una lezione e annulla un eventuale taglio differito."""
+
+    global _starts
+    cancel_deferred_cut()
+    now = int(time.time())
+    cutoff = now - history_days * 86400
+    starts = [t for t in _load_starts() if t >= cutoff] + [now]
+    _starts = starts
+    try:
+        await asyncio.to_thread(_save_starts, list(starts))
+    except OSError as exc:
+        log.error("Impossibile salvare lo storico utilizzo %s: %s", USAGE_PATH, exc)
+
+
+def _expected_lesson_soon(now: dt.datetime, window_min: int, starts: list[int]) -> str | None:
+    today = now.date()
+    t_now = now.hour * 60 + now.minute
+    todays: list[int] = []
+    for ts in starts:
+        d = dt.datetime.fromtimestamp(ts)
+        t = d.hour * 60 + d.minute
+        if d.date() == today:
+            todays.append(ts)
+        elif d.weekday() == now.weekday() and t_now < t <= t_now + window_min:
+            return f"lezione abituale alle {d:%H:%M} di {power_schedule.VALID_DAYS[d.weekday()]}"
+    todays.sort()
+    if len(todays) >= 2 and todays[-1] - todays[-2] <= window_min * 60:
+        return "lezioni consecutive in corso oggi"
+    return None
+
+
+def decide_cut_mains(
+    pconf: dict,
+    now: dt.datetime | None = None,
+    next_lesson_at: dt.datetime | None = None,
+) -> tuple[bool, str]:
+    """Decide se togliere alimentazione al proiettore a fine lezione.
+
+    ``next_lesson_at`` è la prossima lezione dell'orario importato
+    (``app/timetable.py``), se disponibile. Ritorna ``(taglia, motivo)``;
+    il motivo finisce nei log.
+    """
+
+    now = now or dt.datetime.now()
+    mode, window, _ = settings(pconf)
+    if mode == "always_cut":
+        return True, "politica always_cut"
+    schedule = power_schedule.load_power_schedule()
+    if schedule.get("enabled"):
+        to_off = power_schedule.minutes_until_off(now, schedule)
+        if to_off is None:
+            return True, "fuori dall'orario pianificato"
+        if to_off <= window:
+            return True, f"spegnimento pianificato fra {to_off} min"
+    if mode == "keep_warm":
+        return False, "politica keep_warm"
+    if next_lesson_at is not None and next_lesson_at - now <= dt.timedelta(minutes=window):
+        return False, f"prossima lezione in orario alle {next_lesson_at:%H:%M}"
+    reason = _expected_lesson_soon(now, window, _load_starts())
+    if reason:
+        return False, reason
+    return True, "nessuna lezione prevista a breve"
+
+
+def _persist_deferred() -> None:
+    # scrive la scadenza corrente, chiunque sia l'ultimo a chiamare
+    with _deferred_lock:
+        at = _deferred_at
+        try:
+            if at is None:
+                DEFERRED_CUT_PATH.unlink(missing_ok=True)
+                return
+            DEFERRED_CUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+            tmp = DEFERRED_CUT_PATH.with_suffix(".tmp")
+            with tmp.open("w", encoding="utf-8") as f:
+                json.dump({"at": at}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, DEFERRED_CUT_PATH)
+        except OSError as exc:
+            log.error("Impossibile salvare il taglio differito %s: %s", DEFERRED_CUT_PATH, exc)
+
+
+def _set_deferred_at(at: float | None) -> None:
+    global _deferred_at
+    if at == _deferred_at:
+        return
+    _deferred_at = at
+    asyncio.get_running_loop().run_in_executor(None, _persist_deferred)
+
+
+def cancel_deferred_cut() -> None:
+    global _deferred
+    if _deferred is not None and not _deferred.done():
+        _deferred.cancel()
+    _deferred = None
+    _set_deferred_at(None)
+
+
+async def _projector_in_use() -> str | None:
+    """Motivo per non tagliare i mains adesso, ``None`` se si può.
+
+    Conta solo lo stato reale del proiettore (fase da assorbimento o PJLink):
+    le lezioni avviate annullano già il task (``record_lesson_start``,
+    ``power_sequence``)."""
+
+    phase = powersig.signature.current()
+    if phase in ("on", "warmup"):
+        return f"proiettore {phase} (assorbimento)"
+    if phase is not None:
+        return None
+    # fase non nota: chiede a PJLink, senza ritentativi
+    try:
+        code = await devices.projector().get_power(retries=0)
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        return None
+    return "proiettore acceso (PJLink)" if code in (1, 3) else None
+
+
+def schedule_deferred_cut(delay_s: float, cut: Callable[[], Awaitable[object]]) -> None:
+    """Taglia comunque i mains dopo ``delay_s`` se nel frattempo non parte
+    nessuna lezione (``record_lesson_start`` annulla il task) e il proiettore
+    non risulta acceso."""
+
+    global _deferred
+    cancel_deferred_cut()
+
+    async def _run():
+        await asyncio.sleep(delay_s)
+        try:
+            with deadline.budget(deadline.COMMAND_BUDGET_S):
+                busy = await _projector_in_use()
+                if busy:
+                    log.info("Taglio alimentazione differito annullato: %s", busy)
+                else:
+                    log.info("Nessuna lezione entro la finestra: taglio alimentazione proiettore")
+                    await cut()
+        except Exception as exc:
+            log.warning("Taglio alimentazione differito fallito: %s", exc)
+        finally:
+            if _deferred is asyncio.current_task():
+                _set_deferred_at(None)
+
+    _set_deferred_at(time.time() + delay_s)
+    # contesto vuoto: il task non deve ereditare budget e traccia della scena
+    _deferred = asyncio.create_task(_run(), context=contextvars.Context())
+
+
+def _load_deferred() -> float | None:
+    try:
+        with DEFERRED_CUT_PATH.open("r", encoding="utf-8") as f:
+            at = json.load(f).get("at")
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, AttributeError) as exc:
+        log.error("Taglio differito non leggibile %s: %s", DEFERRED_CUT_PATH, exc)
+        return None
+    return float(at) if isinstance(at, (int, float)) else None
+
+
+async def restore_deferred_cut(cut: Callable[[], Awaitable[object]]) -> None:
+    """All'avvio riprogramma il taglio differito rimasto in sospeso (scaduto:
+    subito, con gli stessi controlli)."""
+
+    at = await asyncio.to_thread(_load_deferred)
+    if at is None or _deferred is not None:
+        return
+    delay = max(0.0, at - time.time())
+    log.info("Taglio alimentazione differito ripreso: fra %d s", int(delay))
+    schedule_deferred_cut(delay, cut)
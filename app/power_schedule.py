@@ -1,10 +1,13 @@
 from __future__ import annotations
+import datetime as dt
 import os
 from pathlib import Path
 import re
 import yaml
 import logging
 
+from app import config
+
 DEFAULT_SCHEDULE = {
     "on_time": "07:30",
     "off_time": "19:00",
@@ -60,26 +63,53 @@ def _normalize_schedule(data: dict | None) -> dict:
     }
 
 
+_schedule_file = config.ConfigFile(POWER_SCHEDULE_PATH, _normalize_schedule)
+
+
 def load_power_schedule() -> dict:
-    path = POWER_SCHEDULE_PATH
-    if not path.is_file():
-        return dict(DEFAULT_SCHEDULE)
-    try:
-        with path.open("r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or {}
-    except (OSError, yaml.YAMLError) as exc:
-        log.error("Impossibile leggere la pianificazione %s: %s", path, exc)
-        return dict(DEFAULT_SCHEDULE)
-    return _normalize_schedule(data)
+    """Pianificazione corrente (letta dalla cache di app/config.py)."""
+
+    schedule = _schedule_file.get()
+    return {**schedule, "days": list(schedule["days"])}
 
 
 def save_power_schedule(schedule: dict) -> dict:
     normalized = _normalize_schedule(schedule)
-    path = POWER_SCHEDULE_PATH
     try:
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("w", encoding="utf-8") as f:
-            yaml.safe_dump(normalized, f, allow_unicode=True)
+        _schedule_file.write(normalized)
     except (OSError, yaml.YAMLError) as exc:
         raise ValueError(f"Impossibile salvare la pianificazione: {exc}") from exc
-    return normalized
+    return dict(normalized)
+
+
+def _minutes(hhmm: str) -> int:
+    h, m = hhmm.split(":", 1)
+    return int(h) * 60 + int(m)
+
+
+def minutes_until_off(when: dt.datetime, schedule: dict) -> int | None:
+    """Minuti fra ``when`` e lo spegnimento pianificato; ``None`` se ``when``
+    cade fuori dalla finestra di accensione (giorno o orario)."""
+
+    if schedule.get("days") and VALID_DAYS[when.weekday()] not in schedule["days"]:
+        return None
+    on_m, off_m = _minutes(schedule["on_time"]), _minutes(schedule["off_time"])
+    t = when.hour * 60 + when.minute
+    if on_m < off_m:
+        return off_m - t if on_m <= t < off_m else None
+    # finestra a cavallo della mezzanotte
+    if t >= on_m:
+        return off_m + 1440 - t
+    if t < off_m:
+        return off_m - t
+    return None
+
+
+def is_powered_at(when: dt.datetime, schedule: dict | None = None) -> bool:
+    """Vero se a ``when`` il Raspberry è acceso secondo la pianificazione
+    (sempre vero se la pianificazione è disabilitata)."""
+
+    schedule = schedule or load_power_schedule()
+    if not schedule.get("enabled"):
+        return True
+    return minutes_until_off(when, schedule) is not None
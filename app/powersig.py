@@ -0,0 +1,273 @@
+"""Fase del proiettore dall'assorbimento sul canale mains dello Shelly.
+
+Interrogare il proiettore via PJLink costa una sessione TCP (con ping e
+handshake) che il proiettore gestisce lentamente. Lo Shelly Pro che lo
+alimenta (``shelly1``, canale ``ch1``) misura invece la potenza assorbita
+(``apower``) e risponde in pochi millisecondi: ``run`` la legge ogni
+``POLL_FAST_S`` secondi durante le transizioni e ogni ``POLL_SLOW_S`` a
+regime, e ne ricava la fase:
+
+- ``off``: relè aperto (il proiettore non risponderebbe);
+- ``standby`` / ``on``: sotto o sopra le soglie apprese;
+- ``warmup`` / ``cooling``: la zona intermedia, distinta dalla fase precedente
+  (si sale da standby, si scende da acceso); un warm-up diventa ``on`` quando
+  l'assorbimento resta nella fascia di acceso per ``SETTLE_S`` secondi.
+
+Soglie apprese: ogni volta che PJLink riporta uno stato (``observe_pjlink``)
+la potenza misurata in quel momento aggiorna la media mobile del livello
+corrispondente; le soglie sono i punti medi fra i livelli. I livelli sono
+salvati in ``POWERSIG_PATH`` e partono da valori tipici di un proiettore a
+lampada (``DEFAULT_LEVELS``).
+
+Uso: il monitor di salute (app/health.py) salta il controllo PJLink finché la
+fase concorda con l'ultimo stato letto (al più per ``VERIFY_S`` secondi) e
+l'attesa del cooling (app/services/projector.py) non interroga il proiettore
+mentre l'assorbimento dice che sta ancora raffreddando. Quando fase e PJLink
+non concordano vale PJLink: la fase si riallinea e la discordanza si conta.
+
+Disattivabile con ``power_signature: false`` nella sezione ``projector`` di
+``devices.yaml``.
+"""
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from app import audit, deadline, devices, history, metrics, tracing
+from app.config import DATA_DIR
+from app.services.common import cfg
+
+POWERSIG_PATH = Path(os.environ.get("ROOMCTL_POWERSIG", str(DATA_DIR / "powersig.json")))
+POLL_FAST_S = 2.0
+POLL_SLOW_S = 10.0
+# una fase ferma da tanto si legge meno spesso
+STEADY_AFTER_S = 60.0
+# lettura più vecchia di così: nessuna fase
+FRESH_S = 15.0
+SETTLE_S = 20.0
+# anche con fase concorde, PJLink si ricontrolla almeno ogni VERIFY_S
+VERIFY_S = 300.0
+ALPHA = 0.1
+SAVE_EVERY_S = 600.0
+
+# codice PJLink POWR -> fase, e livelli iniziali in W
+PHASES = {0: "standby", 1: "on", 2: "cooling", 3: "warmup"}
+CODES = {phase: code for code, phase in PHASES.items()}
+DEFAULT_LEVELS = {"standby": 3.0, "on": 250.0, "cooling": 90.0, "warmup": 180.0}
+
+log = logging.getLogger(__name__)
+
+PJLINK_SKIPPED = metrics.Counter(
+    "roomctl_pjlink_polls_skipped_total", "Interrogazioni PJLink evitate grazie alla fase da assorbimento.", ("reason",),
+)
+DISAGREEMENTS = metrics.Counter(
+    "roomctl_powersig_disagreements_total", "Fase da assorbimento smentita da PJLink.", ("phase", "pjlink"),
+)
+
+
+class PowerSignature:
+    def __init__(self, path: Path = POWERSIG_PATH):
+        self.path = path
+        self.levels = dict(DEFAULT_LEVELS)
+        self.samples = {phase: 0 for phase in DEFAULT_LEVELS}
+        self.phase: str | None = None
+        self.watts: float | None = None
+        self.relay_on = False
+        self.read_at = 0.0
+        self.since = 0.0
+        self._on_band_since: float | None = None
+        self._dirty = False
+        self._saved_at = 0.0
+
+    # -------------------------------------------------------------- soglie
+
+    def thresholds(self) -> tuple[float, float]:
+        """(standby/attivo, intermedio/acceso) in W."""
+
+        lv = self.levels
+        middle_lo = min(lv["cooling"], lv["warmup"])
+        middle_hi = max(lv["cooling"], lv["warmup"])
+        low = (lv["standby"] + middle_lo) / 2
+        high = max((middle_hi + lv["on"]) / 2, low)
+        return low, high
+
+    def classify(self, watts: float | None, relay_on: bool, now: float) -> str | None:
+        """Fase dopo una lettura; ``None`` se non è deducibile."""
+
+        prev = self.phase
+        if watts is None:
+            return None
+        if not relay_on:
+            return "off"
+        low, high = self.thresholds()
+        if watts < low:
+            return "standby"
+        in_on_band = watts >= high
+        if prev == "on":
+            return "on" if in_on_band else "cooling"
+        if prev == "cooling":
+            return "cooling"
+        if prev in ("off", "standby", "warmup"):
+            if not in_on_band:
+                self._on_band_since = None
+                return "warmup"
+            if self._on_band_since is None:
+                self._on_band_since = now
+            return "on" if prev == "warmup" and now - self._on_band_since >= SETTLE_S else "warmup"
+        # nessuna fase precedente (avvio): solo i livelli certi
+        return "on" if in_on_band else None
+
+    def update(self, watts: float | None, relay_on: bool, now: float | None = None) -> str | None:
+        now = time.time() if now is None else now
+        phase = self.classify(watts, relay_on, now)
+        if phase != "warmup":
+            self._on_band_since = None
+        if phase != self.phase:
+            if self.phase is not None and phase is not None:
+                log.info("Proiettore: fase %s -> %s (%.0f W)", self.phase, phase, watts or 0.0)
+            self.phase, self.since = phase, now
+        self.watts, self.relay_on, self.read_at = watts, relay_on, now
+        return phase
+
+    # -------------------------------------------------------------- PJLink
+
+    def current(self, now: float | None = None) -> str | None:
+        """Fase corrente se la lettura è recente."""
+
+        now = time.time() if now is None else now
+        return self.phase if now - self.read_at <= FRESH_S else None
+
+    def observe_pjlink(self, code: int | None, now: float | None = None) -> None:
+        """Stato letto via PJLink: apprende il livello e riallinea la fase."""
+
+        now = time.time() if now is None else now
+        pj_phase = PHASES.get(code) if code is not None else None
+        if pj_phase is None:
+            return
+        fresh = now - self.read_at <= FRESH_S and self.watts is not None and self.relay_on
+        if fresh:
+            old = self.levels[pj_phase]
+            self.levels[pj_phase] = old + ALPHA * (self.watts - old) if self.samples[pj_phase] else self.watts
+            self.samples[pj_phase] += 1
+            self._dirty = True
+        phase = self.current(now)
+        if phase is not None and phase != pj_phase:
+            DISAGREEMENTS.inc(phase, pj_phase)
+            log.info("Fase da assorbimento %s smentita da PJLink (%s): riallineata", phase, pj_phase)
+        if phase != pj_phase:
+            self.phase, self.since = pj_phase, now
+            self._on_band_since = None
+
+    def probe_verdict(self, last_code: int | None, last_probe: float | None, now: float | None = None) -> str | None:
+        """Per il monitor di salute: ``"off"`` se il proiettore è senza
+        alimentazione, ``"agree"`` se la fase conferma l'ultimo stato PJLink
+        (controllo evitabile), ``None`` se serve interrogare PJLink."""
+
+        now = time.time() if now is None else now
+        phase = self.current(now)
+        if phase == "off":
+            PJLINK_SKIPPED.inc("off")
+            return "off"
+        if phase is None or last_probe is None or now - last_probe > VERIFY_S:
+            return None
+        if CODES.get(phase) == last_code:
+            PJLINK_SKIPPED.inc("agree")
+            return "agree"
+        return None
+
+    def still_not(self, desired: int) -> bool:
+        """True se la fase dice con certezza che il proiettore non ha ancora
+        raggiunto ``desired`` ma ci sta andando (warm-up verso 1, cooling verso 0)."""
+
+        phase = self.current()
+        if (desired, phase) in ((0, "cooling"), (1, "warmup")):
+            PJLINK_SKIPPED.inc("transition")
+            return True
+        return False
+
+    # -------------------------------------------------------------- persistenza
+
+    def load(self) -> None:
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            for phase, value in (data.get("levels") or {}).items():
+                if phase in self.levels and isinstance(value, (int, float)):
+                    self.levels[phase] = float(value)
+            for phase, n in (data.get("samples") or {}).items():
+                if phase in self.samples and isinstance(n, int):
+                    self.samples[phase] = n
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as exc:
+            log.error("Soglie di assorbimento non leggibili %s: %s", self.path, exc)
+
+    def save(self) -> None:
+        data = {"levels": {k: round(v, 2) for k, v in self.levels.items()}, "samples": self.samples}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    async def _maybe_save(self) -> None:
+        if not self._dirty or time.monotonic() - self._saved_at < SAVE_EVERY_S:
+            return
+        self._saved_at = time.monotonic()
+        try:
+            await asyncio.to_thread(self.save)
+        except OSError as exc:
+            log.error("Impossibile salvare le soglie di assorbimento %s: %s", self.path, exc)
+
+    def status(self) -> dict:
+        low, high = self.thresholds()
+        return {
+            "phase": self.current(),
+            "watts": self.watts,
+            "read_at": self.read_at or None,
+            "since": self.since or None,
+            "levels": {k: round(v, 1) for k, v in self.levels.items()},
+            "samples": self.samples,
+            "thresholds_w": [round(low, 1), round(high, 1)],
+        }
+
+    # -------------------------------------------------------------- lettura
+
+    async def _read(self) -> None:
+        ch = cfg()["shelly1"]["ch1"]
+        # lettura periodica: niente registro eventi né tracce (scacciano quelle delle scene)
+        with deadline.budget(POLL_FAST_S * 2, replace=True), audit.quiet(), tracing.untraced():
+            st = await devices.shelly("shelly1").get_relay(ch)
+        watts = st.get("apower")
+        watts = float(watts) if isinstance(watts, (int, float)) else None
+        self.update(watts, bool(st.get("output")))
+        history.add("projector.watts", watts)
+
+    async def run(self) -> None:
+        """Task di background: legge l'assorbimento del canale mains."""
+
+        while True:
+            interval = POLL_SLOW_S
+            try:
+                if bool(cfg()["projector"].get("power_signature", True)):
+                    await self._read()
+                    await self._maybe_save()
+                    if self.phase is None or self.phase in ("warmup", "cooling") or time.time() - self.since < STEADY_AFTER_S:
+                        interval = POLL_FAST_S
+                else:
+                    self.phase = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # Shelly non raggiungibile: nessuna fase, si torna a PJLink
+                log.debug("Lettura assorbimento proiettore fallita: %s", exc)
+            await asyncio.sleep(interval)
+
+
+signature = PowerSignature()
@@ -0,0 +1,148 @@
+"""Profiler a campionamento e istantanee di memoria, su richiesta.
+
+Sul Raspberry non è comodo agganciare profiler esterni al servizio systemd:
+``sample`` campiona dall'interno gli stack di tutti i thread (o del solo
+thread dell'event loop) ogni ``interval`` secondi per ``seconds`` secondi e
+restituisce gli stack collassati (``thread;f1;f2;... conteggio``), pronti per
+``flamegraph.pl`` o speedscope. Il campionatore gira in un thread a parte e
+costa solo la lettura di ``sys._current_frames`` a ogni campione.
+
+``tracemalloc`` si accende e spegne a richiesta (rallenta le allocazioni);
+``memory_snapshot`` restituisce le righe che allocano di più e, con ``diff``, la
+differenza rispetto all'istantanea precedente.
+
+Endpoint operatore in app/diag.py (``/api/diag/profile``, ``/api/diag/memory``).
+"""
+from __future__ import annotations
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+
+MAX_SECONDS = 60.0
+MIN_INTERVAL_S = 0.001
+
+_ROOT = str(Path(__file__).resolve().parent.parent)
+
+_busy = threading.Lock()
+_last_snapshot: tracemalloc.Snapshot | None = None
+
+
+class ProfilerBusy(RuntimeError):
+    """Un campionamento è già in corso."""
+
+
+def _label(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(_ROOT):
+        filename = os.path.relpath(filename, _ROOT)
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def sample(seconds: float, interval: float = 0.005, thread_id: int | None = None) -> str:
+    """Campiona gli stack per ``seconds`` secondi (bloccante: va chiamata in un
+    thread); ``thread_id`` limita il campionamento a un thread."""
+
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("profilazione già in corso")
+    try:
+        seconds = max(0.0, min(seconds, MAX_SECONDS))
+        interval = max(interval, MIN_INTERVAL_S)
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks: Counter[str] = Counter()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == me or (thread_id is not None and ident != thread_id):
+                    continue
+                parts = []
+                while frame is not None:
+                    parts.append(_label(frame.f_code))
+                    frame = frame.f_back
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                parts.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(parts))] += 1
+            # niente riferimenti ai frame fra un campione e l'altro
+            del frames, frame
+            time.sleep(interval)
+    finally:
+        _busy.release()
+    return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+# ---------------------------------------------------------------- memoria
+
+def memory_start(frames: int = 10) -> None:
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, min(frames, 50)))
+        _last_snapshot = None
+
+
+def memory_stop() -> None:
+    global _last_snapshot
+    tracemalloc.stop()
+    _last_snapshot = None
+
+
+def _where(frame: tracemalloc.Frame) -> str:
+    filename = frame.filename
+    if filename.startswith(_ROOT):
+        filename = os.path.relpath(filename, _ROOT)
+    return f"{filename}:{frame.lineno}"
+
+
+def memory_snapshot(top: int = 30, diff: bool = False, key: str = "lineno") -> dict:
+    """Prime ``top`` righe per memoria allocata (``key``: ``lineno``,
+    ``filename`` o ``traceback``); con ``diff`` la differenza rispetto
+    all'istantanea precedente. Bloccante: va chiamata in un thread."""
+
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    snap = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+    previous, _last_snapshot = _last_snapshot, snap
+    current, peak = tracemalloc.get_traced_memory()
+    out: dict = {
+        "tracing": True,
+        "traced_kb": round(current / 1024, 1),
+        "peak_kb": round(peak / 1024, 1),
+        "diff": bool(diff and previous is not None),
+    }
+    if diff and previous is not None:
+        stats = snap.compare_to(previous, key)[:top]
+        out["stats"] = [
+            {
+                "where": _where(st.traceback[0]),
+                "size_kb": round(st.size / 1024, 1),
+                "size_diff_kb": round(st.size_diff / 1024, 1),
+                "count": st.count,
+                "count_diff": st.count_diff,
+                "traceback": [_where(f) for f in st.traceback] if key == "traceback" else None,
+            }
+            for st in stats
+        ]
+    else:
+        stats = snap.statistics(key)[:top]
+        out["stats"] = [
+            {
+                "where": _where(st.traceback[0]),
+                "size_kb": round(st.size / 1024, 1),
+                "count": st.count,
+                "traceback": [_where(f) for f in st.traceback] if key == "traceback" else None,
+            }
+            for st in stats
+        ]
+    return out
@@ -0,0 +1,13 @@
+"""Logica applicativa condivisa fra API JSON (``app/api.py``) e UI (``app/ui.py``).
+
+I router HTTP sono solo adattatori: validano l'input, chiamano questi servizi
+e formattano la risposta. La UI non passa più dall'API via HTTP sullo stesso
+processo (loopback su ``ROOMCTL_BASE``), ma chiama direttamente le funzioni.
+
+Gli errori dei dispositivi sono ``HTTPException`` (502, o 504 a budget
+scaduto) come negli endpoint, così l'API li restituisce invariati e la UI li
+intercetta per mostrare un messaggio breve.
+"""
+from app.services import common, dsp, projector, schedule, scenes, shelly, status, system
+
+__all__ = ["common", "dsp", "projector", "schedule", "scenes", "shelly", "status", "system"]
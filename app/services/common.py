@@ -0,0 +1,86 @@
+"""Configurazione dispositivi ed helper comuni ai servizi."""
+from __future__ import annotations
+import asyncio
+import contextvars
+import logging
+from typing import Callable, Mapping
+
+from app import config, deadline, tracing
+from app.drivers.pjlink import PJLinkConnectionError
+from fastapi import HTTPException
+
+log = logging.getLogger(__name__)
+
+
+def cfg() -> Mapping:
+    """Configurazione dispositivi corrente (snapshot immutabile, app/config.py)."""
+
+    return config.devices()
+
+
+def update_devices(mutate: Callable[[dict], None]) -> Mapping:
+    """Modifica e salva ``devices.yaml`` (vedi ``config.update_devices``)."""
+
+    return config.update_devices(mutate)
+
+
+def device_error(detail: str, exc: Exception, reason: str | None = None) -> HTTPException:
+    """Errore HTTP per un comando dispositivo fallito: 504 se è scaduto il
+    budget della richiesta (vedi app/deadline.py), altrimenti 502."""
+
+    status = 504 if isinstance(exc, deadline.DeadlineExceeded) else 502
+    return HTTPException(status_code=status, detail=f"{detail}: {reason or exc}")
+
+
+def format_pjlink_error(exc: Exception, host: str, port: int) -> str:
+    if isinstance(exc, PJLinkConnectionError):
+        return str(exc)
+    if isinstance(exc, OSError):
+        return (
+            f"Connessione PJLink fallita verso {host}:{port}: {exc}; "
+            "verifica indirizzo IP/rete del proiettore"
+        )
+    return str(exc)
+
+
+async def fast_ping(host: str) -> bool:
+    with tracing.span("ping", device=host, command="ping"):
+        return await _fast_ping_exec(host)
+
+
+async def _fast_ping_exec(host: str) -> bool:
+    limit = deadline.timeout(2, f"ping {host}")
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ping",
+            "-c",
+            "1",
+            "-W",
+            "1",
+            host,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=limit)
+        except asyncio.TimeoutError:
+            proc.kill()
+            return False
+        return proc.returncode == 0
+    except FileNotFoundError:
+        return True
+    except Exception:
+        return False
+
+
+_bg_tasks: set = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """Avvia un task di background tenendone un riferimento forte."""
+
+    # contesto vuoto: i task di background non ereditano budget e traccia
+    task = asyncio.create_task(coro, context=contextvars.Context())
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
@@ -0,0 +1,131 @@
+"""Servizio DSP408: mute, gain/volume a passi, preset e lettura livelli."""
+from __future__ import annotations
+import logging
+
+from fastapi import HTTPException
+
+from app import devices, history, snapshots
+from app.drivers.dsp408 import DSP408Client
+from app.services.common import cfg, device_error, update_devices
+
+log = logging.getLogger(__name__)
+
+
+def client() -> DSP408Client:
+    """Driver DSP condiviso (app/devices.py): il socket resta aperto fra i comandi."""
+
+    return devices.dsp()
+
+
+def used_channels() -> dict:
+    """Canali IN/OUT marcati come usati in ``devices.yaml`` (``in0``.., ``out0``..)."""
+
+    dsp = cfg().get('dsp') or {}
+    in_map = dsp.get('input', {}) or {}
+    out_map = dsp.get('output', {}) or {}
+    used = {}
+    for i in range(4):
+        used[f"in{i}"] = bool(in_map.get(str(i), True))
+    for i in range(8):
+        used[f"out{i}"] = bool(out_map.get(str(i), True))
+    return used
+
+
+async def mute(on: bool, *, only_used: bool = True) -> None:
+    """Mute/unmute globale; con ``only_used`` i canali non usati restano esclusi."""
+
+    dsp = client()
+    kwargs = {}
+    if only_used:
+        # mappe input/output usate per escludere canali dal MUTE ALL
+        kwargs = {
+            "used_inputs": (cfg().get("dsp") or {}).get("input", {}) or {},
+            "used_outputs": (cfg().get("dsp") or {}).get("output", {}) or {},
+        }
+        log.debug("used in %s --used out %s", kwargs["used_inputs"], kwargs["used_outputs"])
+    try:
+        await dsp.mute_all(on, **kwargs)
+    except Exception as exc:
+        raise device_error("DSP non raggiungibile per mute", exc) from exc
+
+
+async def set_used(channel: str, used: bool) -> None:
+    """Aggiorna lo stato di un canale usato (``in0``..``in3``, ``out0``..``out7``);
+    effetto immediato, salvataggio in ``devices.yaml`` in differita."""
+
+    if channel.startswith('in'):
+        section, idx = 'input', channel[2:]
+    elif channel.startswith('out'):
+        section, idx = 'output', channel[3:]
+    else:
+        raise HTTPException(status_code=400, detail="Canale non valido")
+
+    def _apply(cfg_local: dict) -> None:
+        cfg_local.setdefault('dsp', {}).setdefault(section, {})[idx] = bool(used)
+
+    update_devices(_apply)
+
+
+def _cache_level(bus: str, key: str, value) -> None:
+    history.add(f"dsp.{bus}", value)
+
+    def _change(levels: dict) -> dict:
+        levels = {b: dict(v) for b, v in levels.items()}
+        levels.setdefault(bus, {})[key] = value
+        return levels
+
+    snapshots.update("dsp_levels", _change)
+
+
+async def gain_step(bus: str, delta: int) -> float:
+    """Un passo di gain sul bus; di ``delta`` conta solo il segno."""
+
+    sign = 1 if delta >= 0 else -1
+    try:
+        value = await client().apply_gain_delta(bus, sign)
+    except Exception as exc:
+        raise device_error("DSP non raggiungibile per gain", exc) from exc
+    _cache_level(bus, "gain", value)
+    return value
+
+
+async def volume_step(bus: str, delta: int) -> float:
+    """Un passo di volume sul bus; di ``delta`` conta solo il segno."""
+
+    sign = 1 if delta >= 0 else -1
+    try:
+        value = await client().apply_volume_delta(bus, sign)
+    except Exception as exc:
+        raise device_error("DSP non raggiungibile per volume", exc) from exc
+    _cache_level(bus, "volume", value)
+    return value
+
+
+async def recall(preset: str) -> None:
+    try:
+        await client().recall(preset)
+    except Exception as exc:
+        raise device_error("DSP non raggiungibile per preset", exc) from exc
+
+
+async def levels() -> dict:
+    """Livelli letti dal DSP, raggruppati per bus: ``{bus: {gain, volume}}``."""
+
+    try:
+        levels = await client().read_levels()
+    except Exception as exc:
+        raise device_error("DSP non raggiungibile per lettura livelli", exc) from exc
+    # levels è del tipo {"gain": {"in_a": -3, ...}, "volume": {...}}
+    gain_map = levels.get("gain", {})
+    vol_map = levels.get("volume", {})
+    by_bus: dict = {}
+    for bus in set(gain_map.keys()) | set(vol_map.keys()):
+        by_bus[bus] = {
+            "gain": gain_map.get(bus),
+            "volume": vol_map.get(bus),
+        }
+    # ultimo valore noto per la pagina operatore (app/snapshots.py) e storico
+    snapshots.put("dsp_levels", by_bus)
+    for bus, value in gain_map.items():
+        history.add(f"dsp.{bus}", value)
+    return by_bus
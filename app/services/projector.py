@@ -0,0 +1,197 @@
+"""Servizio proiettore: sequenza di accensione/spegnimento (mains Shelly +
+PJLink) e selezione sorgente."""
+from __future__ import annotations
+import asyncio
+import logging
+
+from fastapi import HTTPException
+
+from app import deadline, devices, health, power_policy, powersig, tracing
+from app.drivers.pjlink import PJLinkClient
+from app.services.common import cfg, device_error, fast_ping, format_pjlink_error
+from app.state import set_text, update as update_state
+
+log = logging.getLogger(__name__)
+
+
+def client() -> PJLinkClient:
+    """Driver PJLink condiviso (app/devices.py)."""
+
+    return devices.projector()
+
+
+async def _wait_power_state(pj: PJLinkClient, desired: int, budget_s: int) -> bool:
+    # desired: 1=ON, 0=STANDBY; molti Epson rispondono 2=cooling, 3=warm-up
+    #power_state={0:'STANDBY',1:"ON",2:'COOLING',3:'WARM-UP',4:'Undefined'}
+    rem = deadline.remaining()
+    if rem is not None:
+        budget_s = min(budget_s, rem)
+    end = asyncio.get_running_loop().time() + budget_s
+    st=4
+    while asyncio.get_running_loop().time() < end:
+        # l'assorbimento dice che la transizione è ancora in corso: niente PJLink (app/powersig.py)
+        if powersig.signature.still_not(desired):
+            await tracing.sleep(1.5, "attesa stato proiettore (assorbimento)")
+            continue
+        try:
+            st = await pj.get_power()
+            powersig.signature.observe_pjlink(st)
+            if st == desired:
+                set_text('Sistema pronto')
+                return True,st
+        except Exception:
+            set_text('Errore accensione proiettore')
+            pass
+        await tracing.sleep(1.5, "attesa stato proiettore")
+        set_text('Errore accensione proiettore')
+    return False,st
+
+
+async def power_sequence(on: bool):
+    if on:
+        # acceso a mano (API, pagina operatore) o da una scena: niente taglio mains differito
+        power_policy.cancel_deferred_cut()
+    try:
+        with tracing.span(f"power_sequence {'on' if on else 'off'}"):
+            await _power_sequence_steps(on)
+    finally:
+        # warm-up/cooling: il monitor di salute segue la transizione da vicino
+        health.kick("projector")
+
+
+async def _power_sequence_steps(on: bool):
+    # Config
+    conf = cfg()
+    pconf = conf["projector"]
+    nic_warmup = int(pconf.get("nic_warmup_s", 12))
+    ping_check = bool(pconf.get("pjlink_ping_check", True))
+
+    if ping_check and not await fast_ping(pconf["host"]):
+        raise HTTPException(
+            status_code=502,
+            detail=(
+                f"Proiettore non raggiungibile via rete: ping verso "
+                f"{pconf['host']} fallito"
+            ),
+        )
+
+    pj = client()
+    shelly_main = devices.shelly("shelly1")
+    ch_main = conf["shelly1"]["ch1"]
+
+    if on:
+
+        # 0) mains già accesi (vedi app/power_policy.py): il proiettore è in
+        #    standby di rete e il warm-up della scheda di rete si può saltare
+        try:
+            mains_on = bool((await shelly_main.get_relay(ch_main)).get("output"))
+        except deadline.DeadlineExceeded:
+            raise
+        except Exception:
+            mains_on = False
+
+        if mains_on:
+            log.info("Alimentazione proiettore già presente: salto nic_warmup")
+        else:
+            # 1) mains ON
+            try:
+                ok = await shelly_main.set_relay(ch_main, True)
+            except Exception as exc:
+                set_text('Errore alimentazione proiettore')
+                raise device_error("Mancata accensione alimentazione principale", exc) from exc
+            if not ok:
+                raise HTTPException(status_code=502, detail="Shelly non ha confermato l'accensione")
+
+            await tracing.sleep(nic_warmup, "nic_warmup")
+
+        # 3) POWER ON via PJLink
+        try:
+            _ = await pj.power(True)
+            #set_text('Proiettore -> ON')
+        except Exception as e:
+            set_text('Errore accensione proiettore')
+            detail = format_pjlink_error(e, pconf["host"], pconf.get("port", 4352))
+            raise device_error("Comando PJLink power-on fallito", e, detail) from e
+
+    else:
+        # POWER OFF
+        try:
+            okp = await pj.power(False)
+            #log.info("PJLink POWER OFF: %s", okp)
+        except Exception as e:
+            log.exception("PJLink POWER OFF error: %s", e)
+            detail = format_pjlink_error(e, pconf["host"], pconf.get("port", 4352))
+            raise device_error("Comando PJLink power-off fallito", e, detail) from e
+
+        # attesa cooldown a STANDBY (spesso serve)
+        off = await _wait_power_state(pj, desired=0, budget_s=90)
+        #log.info("Projector OFF ready: %s", off)
+
+        # opzionale: spegnere mains dopo cooldown
+        # ok = await shelly_main.set_relay(ch_main, False)
+        #log.info("Shelly mains OFF: %s", ok)
+
+
+async def power_background(on: bool):
+    """Esegue la sequenza di accensione/spegnimento senza propagare eccezioni.
+
+    Quando viene usato come task in background la risposta HTTP è già stata
+    inviata: sollevare HTTPException qui genera un errore runtime. Per questo
+    motivo intercettiamo gli errori e ci limitiamo a loggarli e aggiornare lo
+    stato pubblico con un messaggio sintetico.
+    """
+
+    try:
+        # la risposta HTTP è già partita: la sequenza ha un budget tutto suo
+        with deadline.budget(deadline.SCENE_BUDGET_S, replace=True):
+            await power_sequence(on)
+    except HTTPException as exc:
+        log.warning("Projector power background failed: %s", exc)
+        set_text('Errore alimentazione proiettore')
+    except Exception as exc:  # pragma: no cover - salvaguardia generica
+        log.exception("Unexpected projector power background error")
+        set_text('Errore alimentazione proiettore')
+
+
+async def set_input(source: str) -> None:
+    """Cambia sorgente verificando prima la raggiungibilità di rete."""
+
+    host = cfg()['projector']['host']
+    if bool(cfg()['projector'].get('pjlink_ping_check', True)) and not await fast_ping(host):
+        raise HTTPException(
+            status_code=502,
+            detail=f"Proiettore non raggiungibile via rete: ping verso {host} fallito",
+        )
+
+    pj=client()
+    try:
+        ok=await pj.set_input(source)
+    except Exception as exc:
+        raise device_error("Impossibile cambiare sorgente PJLink", exc) from exc
+    if not ok:
+        raise HTTPException(500,'PJLink input failed')
+
+    def _apply(st: dict) -> None:
+        st['projector']['input']=source.upper()
+
+    update_state(_apply)
+
+
+async def is_on() -> bool:
+    """Stato ON letto via PJLink, senza ritentativi (falso se non risponde)."""
+
+    try:
+        return await client().get_power(retries=0) == 1
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        return False
+
+
+async def cut_mains():
+    sh1=devices.shelly_script('shelly1')
+    try:
+        await asyncio.to_thread(sh1.projct_off_main)  #disattiva alimentazione per proiettore
+    except Exception as exc:
+        raise device_error("Shelly principale non raggiungibile per spegnimento", exc) from exc
+    health.kick("projector")
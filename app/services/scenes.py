@@ -0,0 +1,378 @@
+"""Scene d'aula (avvio lezione, spegnimento, pre-riscaldamento).
+
+Ogni scena è una lista di passi con nome. Il runner registra i passi
+completati nel journal (app/journal.py): se il servizio si riavvia a metà
+scena, all'avvio si riprende dal primo passo non completato invece di
+ripetere l'intera sequenza a freddo.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+from fastapi import HTTPException
+
+from app import audit, deadline, health, journal, metrics, power_policy, timetable, tracing
+from app.services import dsp, projector, shelly
+from app.services.common import cfg, device_error, spawn
+from app.state import get_public_state, set_text, update as update_state
+
+log = logging.getLogger(__name__)
+
+SCENE_RESUME_MAX_S = int(os.environ.get("ROOMCTL_SCENE_RESUME_MAX_S", "600"))
+# lo spegnimento si completa anche dopo un riavvio lungo, ma non a ore di distanza
+SCENE_RESUME_OFF_MAX_S = int(os.environ.get("ROOMCTL_SCENE_RESUME_OFF_MAX_S", "3600"))
+
+# quanto a lungo dopo l'inizio previsto una lezione pre-riscaldata resta "calda"
+PREWARM_GRACE_S = 30 * 60
+
+# passo -> dispositivo che deve già rispondere (alimentato indipendentemente
+# dalla scena): se il monitor di salute lo ha appena visto offline si fallisce
+# subito. DSP e proiettore dopo l'accensione non compaiono: stanno ancora partendo.
+_STEP_DEVICES = {
+    'dsp_on': 'shelly1',
+    'dsp_off': 'shelly1',
+    'dsp_mute': 'dsp',
+    'telo_giu': 'shelly2',
+    'telo_su': 'shelly2',
+    'proiettore_on': 'shelly1',
+    'mains_off': 'shelly1',
+}
+
+# istante dell'ultimo avvio lezione (per capire se un pre-riscaldamento è servito)
+_last_lesson_start = 0.0
+
+# una scena per volta sui dispositivi: le scene dell'utente si accodano, quelle
+# di background (pre-riscaldamento e suo timeout) saltano se il lock è preso
+_scene_lock = asyncio.Lock()
+
+
+async def _run_scene(scene: str, steps: list, params: dict, **kw):
+    async with _scene_lock:
+        await _run_steps(scene, steps, params, **kw)
+
+
+def _scene_busy(what: str) -> bool:
+    if _scene_lock.locked():
+        log.info("Scena in corso: %s saltato", what)
+        return True
+    return False
+
+
+async def _run_steps(scene: str, steps: list, params: dict, *, run_id: str | None = None, done=()):
+    """Esegue i passi registrandoli nel journal; il chiamante tiene ``_scene_lock``."""
+
+    if run_id is None:
+        run_id = await journal.begin(scene, params)
+    started, name = time.monotonic(), None
+    try:
+        for name, fn in steps:
+            if name in done:
+                continue
+            if name in _STEP_DEVICES:
+                health.require(_STEP_DEVICES[name])
+            start, outcome = time.monotonic(), "error"
+            try:
+                with tracing.span(name):
+                    await fn()
+                outcome = "ok"
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            finally:
+                metrics.SCENE_STEP_SECONDS.observe(time.monotonic() - start, scene, name, outcome)
+            await journal.step(run_id, name)
+    except asyncio.CancelledError:
+        # arresto del servizio: la scena resta aperta nel journal e verrà ripresa
+        audit.record("scene", action=scene, outcome="cancelled", duration_s=time.monotonic() - started, step=name)
+        raise
+    except Exception as exc:
+        await journal.end(run_id, "error")
+        detail = getattr(exc, "detail", None) or str(exc)
+        audit.record("scene", action=scene, outcome=f"error: {detail}"[:200], duration_s=time.monotonic() - started, step=name)
+        raise
+    await journal.end(run_id, "ok")
+    audit.record("scene", action=scene, duration_s=time.monotonic() - started, **params)
+
+
+async def _step_dsp_mute(mute: bool, error_text: str):
+    try:
+        await dsp.client().mute_all(mute)
+    except Exception as exc:
+        raise device_error(error_text, exc) from exc
+
+
+async def _step_dsp_preset(preset: str):
+    await dsp.recall(preset)
+    update_state(lambda st: st.__setitem__('volume_preset', preset))
+
+
+async def _step_set_input(source: str):
+    try:
+        await projector.client().set_input(source)
+    except Exception as exc:
+        raise device_error("Cambio sorgente PJLink fallito", exc) from exc
+
+
+async def _step_projector_main_off():
+    tconf = timetable.settings(cfg())
+    nxt = await timetable.next_lesson(tconf) if tconf["enabled"] else None
+    cut, reason = power_policy.decide_cut_mains(cfg()['projector'], next_lesson_at=nxt.start if nxt else None)
+    if not cut:
+        # proiettore lasciato in standby di rete fino alla prossima lezione
+        log.info("Alimentazione proiettore mantenuta: %s", reason)
+        policy = power_policy.settings(cfg()['projector'])
+        if policy.mode == "auto":
+            power_policy.schedule_deferred_cut(policy.window_min * 60, projector.cut_mains)
+        return
+    log.info("Taglio alimentazione proiettore: %s", reason)
+    await projector.cut_mains()
+
+
+async def _step_mark_lesson(lesson: str):
+    update_state(lambda st: st.__setitem__('current_lesson', lesson))
+
+
+async def _step_mark_off():
+    # nessuna lezione attiva: passo del journal, vale anche per API e riprese
+    def _apply(st: dict) -> None:
+        st['projector']['power']=False; st['text']="Lezione terminata..."
+        st['current_lesson']=None; st['volume_preset']=None
+
+    update_state(_apply)
+
+
+def _steps_dsp_start(ctx: dict, error_text: str) -> list:
+    # se il DSP è già alimentato (pre-riscaldamento, lezioni consecutive)
+    # l'attesa di avvio non serve
+    async def _dsp_on():
+        ctx['dsp_was_on'] = await shelly.dsp_relay_is_on()
+        await shelly.dsp_power(True, "Shelly DSP non raggiungibile")
+
+    async def _wait_dsp():
+        if not ctx.get('dsp_was_on'):
+            await tracing.sleep(6, "attesa avvio DSP")
+
+    return [
+        ("dsp_on", _dsp_on),
+        ("attesa_dsp", _wait_dsp),
+        ("dsp_unmute", lambda: _step_dsp_mute(False, error_text)),
+    ]
+
+
+def _steps_lesson_tail(params: dict) -> list:
+    steps = []
+    if params.get('preset'):
+        steps.append(("dsp_preset", lambda: _step_dsp_preset(params['preset'])))
+    if params.get('lesson'):
+        steps.append(("stato", lambda: _step_mark_lesson(params['lesson'])))
+    return steps
+
+
+def _steps_avvio_semplice(params: dict) -> list:
+    ctx: dict = {}
+    return _steps_dsp_start(ctx, "DSP non raggiungibile durante avvio semplice") + _steps_lesson_tail(params)
+
+
+def _steps_avvio_proiettore(params: dict) -> list:
+    source = params.get('source') or 'HDMI1'
+
+    ctx: dict = {}
+
+    async def _projector_on():
+        # proiettore già acceso dal pre-riscaldamento dell'orario lezioni
+        lead_s = timetable.settings(cfg())["lead_min"] * 60
+        if timetable.is_prewarmed(lead_s + PREWARM_GRACE_S) and await projector.is_on():
+            ctx['projector_ready'] = True
+            return
+        await projector.power_sequence(True)
+
+    async def _wait_projector():
+        if not ctx.get('projector_ready'):
+            await tracing.sleep(20, "attesa proiettore pronto")
+
+    async def _set_input():
+        await _step_set_input(source)
+
+        def _apply(st: dict) -> None:
+            st['projector']['power']=True; st['projector']['input']=source.upper()
+
+        update_state(_apply)
+
+    return _steps_dsp_start(ctx, "DSP non raggiungibile durante avvio proiettore") + [
+        ("telo_giu", lambda: shelly.cover('close', "Comando telo non riuscito")),
+        ("proiettore_on", _projector_on),
+        ("attesa_proiettore", _wait_projector),
+        ("sorgente", _set_input),
+    ] + _steps_lesson_tail(params)
+
+
+def _steps_prewarm(params: dict) -> list:
+    # solo le parti lente dell'avvio: alimentazione DSP e, per le lezioni
+    # video, mains + accensione proiettore; il DSP resta in mute
+    steps = [("dsp_on", lambda: shelly.dsp_power(True, "Shelly DSP non raggiungibile"))]
+    if params.get('scene') != 'semplice':
+        steps.append(("proiettore_on", lambda: projector.power_sequence(True)))
+    return steps
+
+
+def _steps_spegni_aula(params: dict) -> list:
+    steps = [
+        ("dsp_mute", lambda: _step_dsp_mute(True, "DSP non raggiungibile durante spegnimento")),
+        ("attesa_mute", lambda: tracing.sleep(6, "attesa mute DSP")),
+        ("dsp_off", lambda: shelly.dsp_power(False, "Shelly DSP non raggiungibile in spegnimento")),
+    ]
+    if params.get('lesson') != 'semplice':
+        steps += [
+            ("proiettore_off", lambda: projector.power_sequence(False)),
+            ("telo_su", lambda: shelly.cover('open', "Comando telo in apertura non riuscito")),
+            ("mains_off", _step_projector_main_off),
+        ]
+    steps.append(("stato", _step_mark_off))
+    return steps
+
+
+_SCENES = {
+    'avvio_semplice': _steps_avvio_semplice,
+    'avvio_proiettore': _steps_avvio_proiettore,
+    'spegni_aula': _steps_spegni_aula,
+    'prewarm': _steps_prewarm,
+}
+
+
+def _params(**values) -> dict:
+    return {k: v for k, v in values.items() if v}
+
+
+@tracing.traced_scene('avvio_semplice')
+async def avvio_semplice(lesson: str | None = None, preset: str | None = None) -> None:
+    """Lezione solo audio: DSP acceso e smutato, preset opzionale."""
+
+    global _last_lesson_start
+    _last_lesson_start = time.time()
+    params = _params(lesson=lesson, preset=preset)
+    await _run_scene('avvio_semplice', _steps_avvio_semplice(params), params)
+
+
+@tracing.traced_scene('avvio_proiettore')
+async def avvio_proiettore(lesson: str | None = None, preset: str | None = None, source: str | None = None) -> None:
+    """Lezione video: DSP, telo giù, proiettore acceso sulla sorgente indicata."""
+
+    global _last_lesson_start
+    _last_lesson_start = time.time()
+    params = _params(lesson=lesson, preset=preset)
+    params['source'] = source or 'HDMI1'
+    await power_policy.record_lesson_start(power_policy.settings(cfg()['projector']).history_days)
+    await _run_scene('avvio_proiettore', _steps_avvio_proiettore(params), params)
+
+
+@tracing.traced_scene('spegni_aula')
+async def spegni_aula() -> None:
+    """Fine lezione: DSP in mute e spento, proiettore e telo se usati."""
+
+    # la lezione corrente decide se spegnere anche proiettore e telo; va fissata
+    # nel journal perché dopo un riavvio lo stato in memoria torna ai default.
+    # Letta col lock preso: una scena di avvio in coda davanti la cambia.
+    async with _scene_lock:
+        params = {'lesson': get_public_state().get('current_lesson')}
+        await _run_steps('spegni_aula', _steps_spegni_aula(params), params)
+
+
+async def resume_interrupted() -> None:
+    """Riprende (o chiude) la scena rimasta a metà nel journal, con
+    ``_scene_lock`` già preso dal chiamante (``schedule_resume``).
+
+    Si riprende solo la più recente: le altre aperte (riprese fallite a loro
+    volta) vengono chiuse come abbandonate. Le accensioni si riprendono solo
+    se interrotte da meno di ``SCENE_RESUME_MAX_S`` secondi, per non
+    riaccendere l'aula al mattino dopo un blackout serale; lo spegnimento
+    entro ``SCENE_RESUME_OFF_MAX_S``, per non spegnere un'aula che nel
+    frattempo è tornata in uso.
+    """
+
+    runs = journal.open_runs()
+    if not runs:
+        return
+    *stale, run = runs
+    for old in stale:
+        log.warning("Scena interrotta %s (%s) superata da una più recente: abbandonata", old['scene'], old['id'])
+        await journal.end(old['id'], "abandoned")
+    scene = run['scene']
+    builder = _SCENES.get(scene)
+    age = time.time() - run['started']
+    max_age = SCENE_RESUME_OFF_MAX_S if scene == 'spegni_aula' else SCENE_RESUME_MAX_S
+    if builder is None or age > max_age:
+        log.warning("Scena interrotta %s (%ds fa) abbandonata", scene, int(age))
+        await journal.end(run['id'], "abandoned")
+        return
+
+    log.warning("Ripresa scena %s interrotta dopo i passi %s", scene, run['done'])
+    set_text('Ripresa operazione interrotta…')
+    try:
+        with deadline.budget(deadline.scene_budget(scene), replace=True), tracing.span(scene, kind="scene"):
+            await _run_steps(scene, builder(run['params']), run['params'], run_id=run['id'], done=set(run['done']))
+    except HTTPException as exc:
+        log.warning("Ripresa scena %s fallita: %s", scene, exc.detail)
+        set_text('Errore ripresa operazione')
+        return
+    set_text('Sistema pronto')
+
+
+async def schedule_resume() -> None:
+    """Prende il lock delle scene all'avvio, prima che arrivino richieste, e
+    lancia la ripresa: le nuove scene partono dopo, non insieme."""
+
+    await _scene_lock.acquire()
+
+    async def _resume():
+        try:
+            await resume_interrupted()
+        except Exception:
+            log.exception("Ripresa scena interrotta fallita")
+        finally:
+            _scene_lock.release()
+
+    spawn(_resume())
+
+
+async def _prewarm(lesson: timetable.Lesson) -> None:
+    # aula già in uso (lezioni consecutive): niente da scaldare, e il timeout
+    # spegnerebbe la lezione in corso
+    if get_public_state().get('current_lesson'):
+        log.info("Lezione in corso: pre-riscaldamento per le %s saltato", lesson.start)
+        return
+    if _scene_busy(f"pre-riscaldamento per le {lesson.start}"):
+        return
+    # il proiettore sta per servire: il taglio differito della lezione prima non deve scattare
+    power_policy.cancel_deferred_cut()
+    params = {'scene': lesson.scene, 'start': lesson.start.isoformat(timespec='minutes')}
+    prewarmed_at = time.time()
+    with deadline.budget(deadline.SCENE_BUDGET_S), tracing.span('prewarm', kind="scene"):
+        await _run_scene('prewarm', _steps_prewarm(params), params)
+    spawn(_prewarm_timeout(lesson, prewarmed_at))
+
+
+async def _prewarm_timeout(lesson: timetable.Lesson, prewarmed_at: float) -> None:
+    """Se nessuno avvia la lezione entro ``PREWARM_GRACE_S`` dall'inizio
+    previsto, spegne quanto acceso dal pre-riscaldamento."""
+
+    await asyncio.sleep(max(0.0, (lesson.start - datetime.now()).total_seconds()) + PREWARM_GRACE_S)
+    if _last_lesson_start >= prewarmed_at or get_public_state().get('current_lesson'):
+        return
+    if _scene_busy(f"spegnimento del pre-riscaldamento delle {lesson.start}"):
+        return
+    log.info("Lezione %s non avviata: spengo il pre-riscaldamento", lesson.start)
+    params = {'lesson': lesson.scene}
+    try:
+        with deadline.budget(deadline.SHUTDOWN_BUDGET_S), tracing.span('spegni_aula', kind="scene"):
+            await _run_scene('spegni_aula', _steps_spegni_aula(params), params)
+    except HTTPException as exc:
+        log.warning("Spegnimento dopo pre-riscaldamento fallito: %s", exc.detail)
+
+
+def schedule_prewarm() -> None:
+    """Avvia il task di pre-riscaldamento guidato dall'orario lezioni."""
+
+    spawn(timetable.run_prewarm_loop(cfg, _prewarm))
@@ -0,0 +1,41 @@
+"""Servizio pianificazioni: accensione/spegnimento del Raspberry e orario lezioni."""
+from __future__ import annotations
+from datetime import datetime
+
+from fastapi import HTTPException
+
+from app import power_schedule, timetable
+from app.services.common import cfg
+
+
+def get() -> dict:
+    """Pianificazione di accensione/spegnimento del Raspberry."""
+
+    return power_schedule.load_power_schedule()
+
+
+def save(payload: dict) -> dict:
+    """Valida e salva la pianificazione; 400 se non valida."""
+
+    try:
+        return power_schedule.save_power_schedule(payload)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+
+def timetable_settings() -> dict:
+    return timetable.settings(cfg())
+
+
+async def upcoming_lessons(limit: int = 20) -> dict:
+    """Prossime lezioni dell'aula secondo l'orario importato."""
+
+    conf = timetable_settings()
+    await timetable.index.refresh(conf)
+    upcoming = timetable.index.upcoming(datetime.now(), limit)
+    return {
+        "enabled": conf["enabled"],
+        "room": conf["room"],
+        "lead_min": conf["lead_min"],
+        "upcoming": [l.to_dict() for l in upcoming],
+    }
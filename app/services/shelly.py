@@ -0,0 +1,88 @@
+"""Servizio Shelly: relè (mains proiettore e DSP) e motore del telo."""
+from __future__ import annotations
+import asyncio
+
+from fastapi import HTTPException
+
+from app import deadline, devices, health
+from app.services.common import cfg, device_error, update_devices
+
+
+def map_sid(sid: str):
+    """``sid`` -> (nome dispositivo nel registro, canale)."""
+
+    if sid=='shelly1_ch1': return 'shelly1',cfg()['shelly1']['ch1']
+    if sid=='shelly1_ch2': return 'shelly1',cfg()['shelly1']['ch2']
+    if sid=='shelly2_ch1': return 'shelly2',2
+    if sid=='shelly2_ch2': return 'shelly2',3
+    raise HTTPException(404,'Unknown Shelly sid')
+
+
+def is_inverted() -> bool:
+    return bool((cfg().get('shelly2') or {}).get('inverti_corsa', False))
+
+
+async def set_invert(value: bool) -> None:
+    """Inversione della corsa del telo; salvata in ``devices.yaml`` in differita."""
+
+    def _apply(cfg_local: dict) -> None:
+        cfg_local.setdefault('shelly2', {})['inverti_corsa'] = bool(value)
+
+    update_devices(_apply)
+
+
+async def set_output(sid: str, on: bool) -> None:
+    """Comanda un relè (``shelly1_ch*``) o il telo (``shelly2_ch1`` giù,
+    ``shelly2_ch2`` su)."""
+
+    name,ch=map_sid(sid)
+    inverti_corsa=is_inverted()
+
+    if ch in (2, 3):
+        # client sincrono (requests): fuori dall'event loop, come cover()
+        action, what = ('close', "giù") if ch==2 else ('open', "su")
+        sh=devices.shelly_script(name)
+        try:
+            ok=await asyncio.to_thread(sh.shelly_pro2pm_cover, action=action, inverti_corsa=inverti_corsa)
+        except Exception as exc:
+            raise device_error(f"Shelly cover {what} non raggiungibile", exc) from exc
+    else:
+        sh=devices.shelly(name)
+        try:
+            ok=await sh.set_relay(ch,on)
+        except Exception as exc:
+            raise device_error("Shelly non raggiungibile", exc) from exc
+    if not ok: raise HTTPException(500,'Shelly set failed')
+
+
+async def cover(action: str, error_text: str) -> None:
+    """Telo ``close``/``open`` senza bloccare l'event loop (client sincrono)."""
+
+    sh=devices.shelly_script('shelly2')
+    try:
+        await asyncio.to_thread(sh.shelly_pro2pm_cover, action=action, inverti_corsa=is_inverted())
+    except Exception as exc:
+        raise device_error(error_text, exc) from exc
+
+
+async def dsp_power(on: bool, error_text: str) -> None:
+    """Alimentazione del DSP (relè ``shelly1_ch2``)."""
+
+    name,ch=map_sid('shelly1_ch2')
+    try:
+        ok = await devices.shelly(name).set_relay(ch, on)
+    except Exception as exc:
+        raise device_error(error_text, exc) from exc
+    health.kick("dsp")
+    if on and not ok:
+        raise HTTPException(status_code=502, detail="Accensione DSP non confermata")
+
+
+async def dsp_relay_is_on() -> bool:
+    name,ch=map_sid('shelly1_ch2')
+    try:
+        return bool((await devices.shelly(name).get_relay(ch)).get("output"))
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        return False
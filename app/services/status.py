@@ -0,0 +1,85 @@
+"""Verifica dello stato pubblico sui dispositivi reali.
+
+Dopo un riavvio lo stato ripristinato dallo snapshot (app/state.py) può essere
+vecchio: qualcuno ha spento l'aula a mano, è mancata la corrente. ``verify``
+interroga in parallelo proiettore, DSP e relè Shelly (una sola andata e
+ritorno, senza ritentativi) e corregge solo ciò che le letture smentiscono;
+un dispositivo che non risponde lascia invariati i campi che lo riguardano.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+
+from app import deadline, devices, powersig
+from app.services.common import cfg, spawn
+from app.state import update as update_state
+
+log = logging.getLogger(__name__)
+
+
+async def _projector_power() -> int | None:
+    try:
+        return await devices.projector().get_power(retries=0)
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        return None
+
+
+async def _relay(name: str, channel: int) -> bool | None:
+    try:
+        return bool((await devices.shelly(name).get_relay(channel)).get("output"))
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        return None
+
+
+async def _dsp_online() -> bool:
+    try:
+        return await devices.dsp().check_status()
+    except Exception:
+        return False
+
+
+async def verify() -> dict:
+    """Letture concorrenti di tutti i dispositivi, applicate allo stato pubblico."""
+
+    conf = cfg()
+    power, mains, dsp_relay, dsp_ok = await asyncio.gather(
+        _projector_power(),
+        _relay("shelly1", conf["shelly1"]["ch1"]),
+        _relay("shelly1", conf["shelly1"]["ch2"]),
+        _dsp_online(),
+    )
+    readings = {"projector_power": power, "mains": mains, "dsp_relay": dsp_relay, "dsp": dsp_ok}
+    powersig.signature.observe_pjlink(power)
+
+    def _apply(st: dict) -> None:
+        # 1=ON, 3=warm-up; 0=standby, 2=cooling (PJLink POWR)
+        if power is not None:
+            st["projector"]["power"] = power in (1, 3)
+        elif mains is False:
+            st["projector"]["power"] = False
+        st["dsp"]["state"] = "OK" if dsp_ok else "OFFLINE"
+        st["shelly"]["main"] = "OFFLINE" if mains is None else "OK"
+        if dsp_relay is False and power not in (1, 3):
+            # aula spenta: nessuna lezione in corso, qualunque cosa dica lo snapshot
+            st["current_lesson"] = None
+            st["volume_preset"] = None
+
+    update_state(_apply)
+    log.info("Verifica stato dispositivi: %s", readings)
+    return readings
+
+
+async def _verify_background() -> None:
+    try:
+        with deadline.budget(deadline.COMMAND_BUDGET_S, replace=True):
+            await verify()
+    except Exception as exc:
+        log.warning("Verifica stato dispositivi fallita: %s", exc)
+
+
+def schedule_verify() -> None:
+    spawn(_verify_background())
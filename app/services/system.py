@@ -0,0 +1,35 @@
+"""Servizio di sistema: data/ora e riavvio del terminale."""
+from __future__ import annotations
+import asyncio
+import os
+import subprocess
+from datetime import datetime
+
+from fastapi import HTTPException
+
+
+def reboot() -> None:
+    """Riavvia l'intera macchina; da eseguire come background task, dopo
+    l'invio della risposta HTTP."""
+
+    # scegli la variante corretta in base alla tua configurazione
+    # Variante A: il servizio gira come root
+    # os.system("/sbin/reboot")
+
+    # Variante B: il servizio gira come utente normale con sudo configurato
+    os.system("sudo /sbin/reboot")
+
+
+async def set_datetime(dt: datetime) -> str:
+    """Aggiorna la data/ora del sistema; ritorna la data impostata."""
+
+    dt_str = dt.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        await asyncio.to_thread(subprocess.run, ["sudo", "date", "-s", dt_str], check=True)
+        #subprocess.run(["sudo", "hwclock", "--systohc"], check=True)
+    except subprocess.CalledProcessError as exc:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Impossibile impostare data/ora: {exc}",
+        ) from exc
+    return dt_str
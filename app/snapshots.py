@@ -0,0 +1,106 @@
+"""Ultimi valori letti da dispositivi e sistema, per rendere le pagine subito.
+
+Le letture lente (12 letture seriali del DSP, ``vcgencmd`` per la batteria
+RTC) non stanno più nel percorso della richiesta: la pagina usa l'ultimo
+valore noto con la sua età, chiede un aggiornamento in background e lo
+riceve in un secondo momento (``GET /operator/snapshot``).
+
+Per ogni nome c'è al più un aggiornamento in corso; le richieste concorrenti
+attendono lo stesso task.
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from app import deadline
+
+log = logging.getLogger(__name__)
+
+
+class Snapshot(NamedTuple):
+    value: Any = None
+    updated: float | None = None   # epoch dell'ultima lettura riuscita
+    error: str | None = None       # ultimo errore, azzerato dalla lettura successiva
+
+    def age(self, now: float | None = None) -> float | None:
+        if self.updated is None:
+            return None
+        return (now or time.time()) - self.updated
+
+    def is_stale(self, max_age_s: float) -> bool:
+        age = self.age()
+        return age is None or age > max_age_s
+
+    def to_dict(self, max_age_s: float) -> dict:
+        age = self.age()
+        return {
+            "value": self.value,
+            "age_s": None if age is None else round(age, 1),
+            "stale": self.is_stale(max_age_s),
+            "error": self.error,
+        }
+
+
+_snapshots: dict[str, Snapshot] = {}
+_refreshing: dict[str, asyncio.Task] = {}
+
+
+def get(name: str) -> Snapshot:
+    return _snapshots.get(name) or Snapshot()
+
+
+def put(name: str, value: Any) -> None:
+    _snapshots[name] = Snapshot(value, time.time(), None)
+
+
+def update(name: str, change: Callable[[Any], Any]) -> None:
+    """Applica ``change`` al valore in cache (se c'è), senza ringiovanirlo:
+    serve a riflettere subito l'effetto di un comando noto."""
+
+    snap = _snapshots.get(name)
+    if snap is not None and snap.value is not None:
+        _snapshots[name] = snap._replace(value=change(snap.value))
+
+
+def _fail(name: str, exc: BaseException) -> None:
+    prev = get(name)
+    _snapshots[name] = prev._replace(error=str(getattr(exc, "detail", None) or exc))
+
+
+def refresh(name: str, fetch: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+    """Avvia (o riusa) l'aggiornamento in background di ``name``."""
+
+    task = _refreshing.get(name)
+    if task is not None and not task.done():
+        return task
+
+    async def _run():
+        try:
+            # budget proprio: non eredita quello della pagina che l'ha chiesto
+            with deadline.budget(deadline.COMMAND_BUDGET_S, replace=True):
+                put(name, await fetch())
+        except Exception as exc:
+            log.info("Aggiornamento %s non riuscito: %s", name, exc)
+            _fail(name, exc)
+        finally:
+            _refreshing.pop(name, None)
+
+    task = asyncio.create_task(_run(), context=contextvars.Context())
+    _refreshing[name] = task
+    return task
+
+
+async def fresh(name: str, fetch: Callable[[], Awaitable[Any]], max_age_s: float, wait_s: float) -> Snapshot:
+    """Valore aggiornato se quello in cache è più vecchio di ``max_age_s``,
+    attendendo al più ``wait_s`` secondi; altrimenti il valore in cache."""
+
+    if get(name).is_stale(max_age_s):
+        task = refresh(name, fetch)
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout=wait_s)
+        except asyncio.TimeoutError:
+            pass
+    return get(name)
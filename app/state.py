@@ -1,12 +1,266 @@
-_state={
-    'projector':{'power':'STANDBY','input':'HDMI1'},
-    'dsp':{'state':'OK'},
-    'shelly':{'main':'OK', 'telo':'OK'},
-    'text':'Sistema pronto',
-    'current_lesson':'',
+"""Stato pubblico dell'aula (proiettore, DSP, Shelly, messaggi), versionato.
+
+Ogni modifica passa da ``update``: la funzione di modifica lavora su una copia
+sotto lock, il risultato viene confrontato con lo stato precedente e solo se
+qualcosa è cambiato si incrementa la versione, si registra la differenza come
+JSON Patch (RFC 6902) e si svegliano gli ascoltatori. Il websocket (app/main.py)
+spedisce così solo le differenze, e solo quando ci sono.
+
+``get_public_state``/``set_public_state`` restano per i chiamanti esistenti;
+per le nuove modifiche meglio ``update`` o ``set_text``, che non perdono
+aggiornamenti concorrenti.
+
+Lo stato viene salvato in ``SNAPSHOT_PATH`` (JSON compatto, scrittura
+atomica) al massimo ogni ``SNAPSHOT_INTERVAL_S`` secondi quando cambia e allo
+spegnimento; all'avvio ``restore_snapshot`` lo ricarica subito, poi
+app/services/status.py lo verifica interrogando i dispositivi. Le chiavi in
+``VOLATILE`` (la salute dei dispositivi, app/health.py) non vengono salvate:
+cambiano a ogni controllo e dopo un riavvio non valgono più; se cambiano solo
+quelle il file non viene riscritto.
+"""
+from __future__ import annotations
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable
+
+from app.config import DATA_DIR
+
+# quante differenze tenere per riallineare un client rimasto indietro
+HISTORY = 64
+SNAPSHOT_PATH = Path(os.environ.get("ROOMCTL_STATE_SNAPSHOT", str(DATA_DIR / "state_snapshot.json")))
+SNAPSHOT_INTERVAL_S = 10.0
+VOLATILE = frozenset({'health'})
+
+log = logging.getLogger(__name__)
+
+_state: dict = {
+    'projector': {'power': 'STANDBY', 'input': 'HDMI1'},
+    'dsp': {'state': 'OK'},
+    'shelly': {'main': 'OK', 'telo': 'OK'},
+    'text': 'Sistema pronto',
+    'current_lesson': '',
     'volume_preset': None,
 }
+# parte dall'istante di avvio: la versione di un client rimasto connesso a un
+# processo precedente non coincide mai con una di questo (riceve lo stato completo)
+_version = int(time.time() * 1000)
+# istante (monotonic) dell'ultima modifica, per misurare il ritardo di diffusione
+_changed_at = time.monotonic()
+_history: deque[tuple[int, list]] = deque(maxlen=HISTORY)
+_lock = threading.Lock()
+_waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+_listeners: list[Callable[[int, list], None]] = []
+_saved_state: dict | None = None
+
+
+# ---------------------------------------------------------------- JSON Patch
+
+def _pointer(path: tuple) -> str:
+    return "".join("/" + str(p).replace("~", "~0").replace("/", "~1") for p in path)
+
+
+def diff(old: Any, new: Any, path: tuple = ()) -> list[dict]:
+    """Differenza ``old`` -> ``new`` come lista di operazioni JSON Patch."""
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops: list[dict] = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": _pointer(path + (key,))})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": _pointer(path + (key,)), "value": copy.deepcopy(value)})
+            else:
+                ops.extend(diff(old[key], value, path + (key,)))
+        return ops
+    if old == new and type(old) is type(new):
+        return []
+    return [{"op": "replace", "path": _pointer(path), "value": copy.deepcopy(new)}]
+
+
+# ---------------------------------------------------------------- lettura
+
+def snapshot() -> tuple[int, dict]:
+    """Versione corrente e copia profonda dello stato."""
+
+    with _lock:
+        return _version, copy.deepcopy(_state)
+
+
+def version() -> int:
+    return _version
+
+
+def changed_at() -> float:
+    """``time.monotonic()`` dell'ultima modifica."""
+
+    return _changed_at
+
+
+def changes_since(since: int) -> tuple[int, list | None]:
+    """Operazioni da applicare a uno stato alla versione ``since`` per portarlo
+    alla corrente; ``None`` se la storia non basta (serve lo stato completo)."""
+
+    with _lock:
+        if since == _version:
+            return _version, []
+        if since > _version or not _history or _history[0][0] > since + 1:
+            return _version, None
+        ops: list = []
+        for v, patch in _history:
+            if v > since:
+                ops.extend(patch)
+        return _version, ops
+
+
+def get_public_state() -> dict:
+    return snapshot()[1]
+
+
+# ---------------------------------------------------------------- modifica
+
+def update(mutate: Callable[[dict], None]) -> int:
+    """Applica ``mutate`` in modo atomico; ritorna la versione risultante."""
+
+    global _state, _version, _changed_at
+    with _lock:
+        new = copy.deepcopy(_state)
+        mutate(new)
+        patch = diff(_state, new)
+        if not patch:
+            return _version
+        _state = new
+        _version += 1
+        _changed_at = time.monotonic()
+        version = _version
+        _history.append((version, patch))
+        waiters = list(_waiters)
+        _waiters.clear()
+    for loop, fut in waiters:
+        try:
+            loop.call_soon_threadsafe(_wake, fut, version)
+        except RuntimeError:
+            # event loop già chiuso
+            pass
+    for listener in list(_listeners):
+        listener(version, patch)
+    return version
+
+
+def set_public_state(d: dict) -> int:
+    return update(lambda s: s.update(copy.deepcopy(d)))
+
+
+def set_text(text: str) -> int:
+    """Messaggio di stato mostrato su chiosco e pagine operatore."""
+
+    return update(lambda s: s.__setitem__('text', text))
+
+
+# ---------------------------------------------------------------- notifiche
+
+def _wake(fut: asyncio.Future, version: int) -> None:
+    if not fut.done():
+        fut.set_result(version)
+
+
+async def wait_change(since: int, timeout: float | None = None) -> int:
+    """Attende una versione successiva a ``since`` (o lo scadere di ``timeout``);
+    ritorna la versione corrente."""
+
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    entry = (loop, fut)
+    with _lock:
+        if _version != since:
+            return _version
+        _waiters.add(entry)
+    try:
+        return await asyncio.wait_for(fut, timeout)
+    except asyncio.TimeoutError:
+        return _version
+    finally:
+        with _lock:
+            _waiters.discard(entry)
+
+
+def subscribe(listener: Callable[[int, list], None]) -> Callable[[], None]:
+    """Registra ``listener(versione, patch)``, chiamato dopo ogni modifica
+    (anche da thread diversi dall'event loop). Ritorna la funzione di disiscrizione."""
+
+    _listeners.append(listener)
+    return lambda: _listeners.remove(listener) if listener in _listeners else None
+
+
+# ---------------------------------------------------------------- persistenza
+
+def save_snapshot() -> int:
+    """Scrive lo stato corrente su ``SNAPSHOT_PATH``; ritorna la versione salvata."""
+
+    global _saved_state
+    version, current = snapshot()
+    current = {k: v for k, v in current.items() if k not in VOLATILE}
+    if current == _saved_state:
+        return version
+    data = json.dumps({"t": int(time.time()), "state": current}, separators=(",", ":"), ensure_ascii=False)
+    SNAPSHOT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = SNAPSHOT_PATH.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, SNAPSHOT_PATH)
+    _saved_state = current
+    return version
+
+
+def restore_snapshot() -> float | None:
+    """Ricarica l'ultimo stato salvato sopra i default; ritorna l'istante del
+    salvataggio, o ``None`` se non c'è uno snapshot leggibile."""
+
+    try:
+        with SNAPSHOT_PATH.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+        saved = data["state"]
+        if not isinstance(saved, dict):
+            raise ValueError("stato non valido")
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        log.error("Snapshot stato non leggibile %s: %s", SNAPSHOT_PATH, exc)
+        return None
+
+    def _apply(st: dict) -> None:
+        for key, value in saved.items():
+            if key in VOLATILE:
+                continue
+            if isinstance(st.get(key), dict) and isinstance(value, dict):
+                st[key].update(value)
+            else:
+                st[key] = value
+
+    update(_apply)
+    log.info("Stato ripristinato dallo snapshot del %s", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(data.get("t", 0))))
+    return float(data.get("t", 0))
+
 
-def set_public_state(d): _state.update(d)
+async def run_persist_loop() -> None:
+    """Task di background: salva lo stato dopo ogni modifica, raggruppando
+    quelle ravvicinate in un'unica scrittura ogni ``SNAPSHOT_INTERVAL_S``."""
 
-def get_public_state(): return _state.copy()
+    saved = _version
+    while True:
+        await wait_change(saved)
+        await asyncio.sleep(SNAPSHOT_INTERVAL_S)
+        try:
+            saved = await asyncio.to_thread(save_snapshot)
+        except OSError as exc:
+            # nuovo tentativo al prossimo giro
+            log.error("Impossibile salvare lo snapshot stato %s: %s", SNAPSHOT_PATH, exc)
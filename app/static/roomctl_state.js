@@ -0,0 +1,107 @@
+// Stato pubblico dell'aula (vedi app/state.py e app/broadcast.py).
+// Il server manda lo stato completo ({v, state}) e poi solo le differenze
+// JSON Patch ({v, patch} o, sul websocket, {v, topic, patch}) quando qualcosa
+// cambia; un client rimasto indietro riceve di nuovo lo stato completo.
+//
+// Trasporto (attributo data-transport sullo <script>):
+//   sse  (default) /events, riconnessione automatica del browser che riprende
+//        da Last-Event-ID; dopo ripetuti errori senza messaggi passa al long-poll
+//   poll /state/poll, risposta 304 se non cambia nulla
+//   ws   /ws
+// data-ws-topics="projector,jobs" limita gli argomenti ricevuti.
+// Le pagine si registrano con roomctlState.onChange(function(state){ ... }).
+(function(){
+  var state = null, version = null, handlers = [];
+  var script = document.currentScript;
+  var topics = script && script.getAttribute('data-ws-topics');
+  var transport = (script && script.getAttribute('data-transport')) || 'sse';
+
+  function unescapeToken(t){ return t.replace(/~1/g, '/').replace(/~0/g, '~'); }
+
+  function applyPatch(doc, ops){
+    ops.forEach(function(op){
+      var parts = op.path.split('/').slice(1).map(unescapeToken);
+      if (!parts.length){ doc = op.value; return; }
+      var target = doc;
+      for (var i = 0; i < parts.length - 1; i++){ target = target[parts[i]]; }
+      var key = parts[parts.length - 1];
+      if (op.op === 'remove'){ delete target[key]; } else { target[key] = op.value; }
+    });
+    return doc;
+  }
+
+  function notify(){
+    handlers.forEach(function(fn){ try { fn(state); } catch(e){} });
+  }
+
+  // false se il messaggio non si può applicare: serve lo stato completo
+  function handle(msg){
+    if (msg.state){
+      state = msg.state;
+    } else if (msg.patch && state !== null){
+      try { state = applyPatch(state, msg.patch); } catch(e){ version = null; return false; }
+    } else {
+      version = null; return false;
+    }
+    version = msg.v;
+    notify();
+    return true;
+  }
+
+  function query(){
+    var params = [];
+    if (version !== null) params.push('v=' + version);
+    if (topics) params.push('topics=' + encodeURIComponent(topics));
+    return params.length ? '?' + params.join('&') : '';
+  }
+
+  function connectWs(){
+    var proto = location.protocol === 'https:' ? 'wss:' : 'ws:';
+    var ws;
+    try { ws = new WebSocket(proto + '//' + location.host + '/ws' + query()); }
+    catch(e){ setTimeout(connectWs, 3000); return; }
+    ws.onmessage = function(ev){
+      var msg;
+      try { msg = JSON.parse(ev.data || '{}'); } catch(e){ return; }
+      if (!handle(msg)) ws.close();
+    };
+    ws.onclose = function(){ setTimeout(connectWs, 2000); };
+  }
+
+  function connectSse(){
+    var failures = 0;
+    var es = new EventSource('/events' + query());
+    function onEvent(ev){
+      failures = 0;
+      var msg;
+      try { msg = JSON.parse(ev.data || '{}'); } catch(e){ return; }
+      if (!handle(msg)){ es.close(); setTimeout(connectSse, 1000); }
+    }
+    es.addEventListener('state', onEvent);
+    es.addEventListener('patch', onEvent);
+    es.onerror = function(){
+      // il browser ritenta da solo con Last-Event-ID; se non arriva mai nulla
+      // (proxy che bufferizza, SSE bloccato) si ripiega sul long-poll
+      if (++failures >= 5){ es.close(); poll(); }
+    };
+  }
+
+  function poll(){
+    fetch('/state/poll' + query(), {cache: 'no-store', credentials: 'same-origin'})
+      .then(function(r){
+        if (r.status === 304) return null;
+        if (!r.ok) throw new Error(r.status);
+        return r.json();
+      })
+      .then(function(msg){ if (msg) handle(msg); setTimeout(poll, 0); })
+      .catch(function(){ setTimeout(poll, 3000); });
+  }
+
+  window.roomctlState = {
+    onChange: function(fn){ handlers.push(fn); if (state !== null){ try { fn(state); } catch(e){} } },
+    get: function(){ return state; }
+  };
+  if (transport === 'ws') connectWs();
+  else if (transport === 'poll' || !window.EventSource) poll();
+  else connectSse();
+})();
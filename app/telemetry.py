@@ -0,0 +1,244 @@
+"""Misure di sistema del Raspberry in background.
+
+Ogni ``SAMPLE_S`` secondi ``run`` legge batteria RTC, temperatura del SoC,
+flag di throttling, carico e memoria e li mette in cache: la pagina operatore
+(app/ui.py, tramite app/snapshots.py), ``/metrics`` e lo storico
+(app/history.py) leggono solo la cache, e nessuna richiesta lancia processi.
+
+Le letture passano da sysfs/procfs quando il kernel le espone (un'unica
+``asyncio.to_thread`` per campione). Quello che sysfs non offre (``vcgencmd
+pmic_read_adc BATT_V`` sul Pi 5, ``vcgencmd get_throttled`` sui kernel senza
+``get_throttled``) passa da un'unica shell di supporto a lunga durata
+(``_Helper``), avviata alla prima necessità e riavviata solo se muore: prima
+ogni caricamento della pagina operatore faceva ``subprocess`` con
+``shell=True``.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import re
+import shlex
+import shutil
+import time
+from pathlib import Path
+
+from app import history, metrics, snapshots
+
+SAMPLE_S = 30.0
+HELPER_TIMEOUT_S = 5.0
+HELPER_RETRY_S = 300.0
+
+RTC_VBAT_PATHS = (
+    Path("/sys/class/power_supply/rtc-battery/voltage_now"),
+    Path("/sys/class/power_supply/rtc-vbat/voltage_now"),
+    Path("/sys/class/power_supply/rtc/voltage_now"),
+)
+SOC_TEMP_PATH = Path("/sys/class/thermal/thermal_zone0/temp")
+THROTTLED_PATH = Path("/sys/devices/platform/soc/soc:firmware/get_throttled")
+
+# bit di get_throttled: attuali (0-3) e avvenuti dall'avvio (16-19)
+THROTTLE_FLAGS = {
+    0: "under_voltage", 1: "freq_capped", 2: "throttled", 3: "soft_temp_limit",
+    16: "under_voltage_occurred", 17: "freq_capped_occurred", 18: "throttled_occurred", 19: "soft_temp_limit_occurred",
+}
+
+log = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------- sysfs / procfs
+
+def _read_rtc_vbat() -> float | None:
+    for path in RTC_VBAT_PATHS:
+        try:
+            raw = path.read_text(encoding="utf-8").strip()
+            if not raw:
+                continue
+            value = float(raw)
+        except (OSError, ValueError):
+            continue
+        # i driver di alimentazione riportano spesso microvolt/millivolt
+        if value > 10000:
+            value /= 1_000_000
+        elif value > 100:
+            value /= 1000
+        return round(value, 3)
+    return None
+
+
+def _read_soc_temp() -> float | None:
+    try:
+        return int(SOC_TEMP_PATH.read_text().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def _read_throttled() -> int | None:
+    try:
+        return int(THROTTLED_PATH.read_text().strip(), 16)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_meminfo() -> dict[str, int]:
+    out: dict[str, int] = {}
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("MemTotal", "MemAvailable"):
+                    out[key] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return out
+
+
+def _read_sysfs() -> dict:
+    mem = _read_meminfo()
+    try:
+        load = os.getloadavg()
+    except OSError:
+        load = None
+    return {
+        "rtc_vbat": _read_rtc_vbat(),
+        "soc_temp": _read_soc_temp(),
+        "throttled": _read_throttled(),
+        "load": None if load is None else [round(x, 2) for x in load],
+        "mem_total": mem.get("MemTotal"),
+        "mem_available": mem.get("MemAvailable"),
+    }
+
+
+# ---------------------------------------------------------------- shell di supporto
+
+class _Helper:
+    """Una shell a lunga durata che esegue i comandi per cui non c'è sysfs."""
+
+    _END = "__roomctl_end__"
+
+    def __init__(self):
+        self._proc: asyncio.subprocess.Process | None = None
+        self._failed_at: float | None = None
+
+    async def run(self, *argv: str) -> str | None:
+        if self._proc is None or self._proc.returncode is not None:
+            if self._failed_at is not None and time.monotonic() - self._failed_at < HELPER_RETRY_S:
+                return None
+            try:
+                self._proc = await asyncio.create_subprocess_exec(
+                    "/bin/sh", stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+            except OSError as exc:
+                self._failed_at = time.monotonic()
+                log.warning("Shell di supporto per la telemetria non avviata: %s", exc)
+                return None
+        proc = self._proc
+        try:
+            proc.stdin.write(f"{shlex.join(argv)} 2>&1; echo {self._END}\n".encode())
+            await proc.stdin.drain()
+            lines = []
+            while True:
+                line = await asyncio.wait_for(proc.stdout.readline(), HELPER_TIMEOUT_S)
+                if not line:
+                    raise ConnectionError("shell terminata")
+                text = line.decode(errors="replace").rstrip("\n")
+                if text == self._END:
+                    return "\n".join(lines)
+                lines.append(text)
+        except (OSError, ConnectionError, asyncio.TimeoutError) as exc:
+            log.warning("Shell di supporto per la telemetria non risponde (%s): riavvio", exc)
+            self._failed_at = time.monotonic()
+            await self.close()
+            return None
+
+    async def close(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc is None or proc.returncode is not None:
+            return
+        proc.kill()
+        await proc.wait()
+
+
+# ---------------------------------------------------------------- campionatore
+
+class Telemetry:
+    def __init__(self):
+        self.values: dict = {}
+        self.updated: float | None = None
+        self._helper = _Helper()
+        self._vcgencmd = shutil.which("vcgencmd")
+
+    async def _vcgencmd_value(self, *args: str) -> str | None:
+        if self._vcgencmd is None:
+            return None
+        out = await self._helper.run(self._vcgencmd, *args)
+        if not out or "=" not in out:
+            return None
+        return out.rsplit("=", 1)[1].strip()
+
+    async def sample(self) -> dict:
+        values = await asyncio.to_thread(_read_sysfs)
+        if values["rtc_vbat"] is None:
+            raw = await self._vcgencmd_value("pmic_read_adc", "BATT_V")
+            m = re.match(r"([0-9.]+)", raw or "")
+            values["rtc_vbat"] = round(float(m.group(1)), 3) if m else None
+        if values["throttled"] is None:
+            raw = await self._vcgencmd_value("get_throttled")
+            try:
+                values["throttled"] = int(raw, 16) if raw else None
+            except ValueError:
+                values["throttled"] = None
+        flags = values["throttled"]
+        values["throttle_flags"] = None if flags is None else [name for bit, name in THROTTLE_FLAGS.items() if flags >> bit & 1]
+        self.values, self.updated = values, time.time()
+        self._publish(values)
+        return values
+
+    @staticmethod
+    def _publish(values: dict) -> None:
+        if values["rtc_vbat"] is not None:
+            snapshots.put("rtc_vbat", values["rtc_vbat"])
+        snapshots.put("system", values)
+        history.add("soc.temp", values["soc_temp"])
+        if values["load"]:
+            history.add("sys.load1", values["load"][0])
+        history.add("sys.mem_available", values["mem_available"])
+
+    def get(self, key: str):
+        return self.values.get(key)
+
+    async def run(self) -> None:
+        """Task di background: un campione ogni ``SAMPLE_S`` secondi."""
+
+        try:
+            while True:
+                try:
+                    await self.sample()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    log.error("Lettura telemetria di sistema fallita: %s", exc)
+                await asyncio.sleep(SAMPLE_S)
+        finally:
+            await self._helper.close()
+
+
+sampler = Telemetry()
+
+
+def _gauge(key: str):
+    def _value() -> dict:
+        value = sampler.get(key)
+        return {} if value is None else {(): value}
+    return _value
+
+
+metrics.Gauge("roomctl_soc_temperature_celsius", "Temperatura del SoC.", fn=_gauge("soc_temp"))
+metrics.Gauge("roomctl_rtc_battery_volts", "Tensione della batteria RTC.", fn=_gauge("rtc_vbat"))
+metrics.Gauge("roomctl_throttled_flags", "Maschera get_throttled del firmware (0 = nessun problema).", fn=_gauge("throttled"))
+metrics.Gauge("roomctl_memory_available_bytes", "Memoria disponibile.", fn=_gauge("mem_available"))
+metrics.Gauge(
+    "roomctl_load_average", "Carico medio del sistema.", ("period",),
+    fn=lambda: {} if not sampler.get("load") else dict(zip((("1m",), ("5m",), ("15m",)), sampler.get("load"))),
+)
@@ -0,0 +1,321 @@
+"""Orario delle lezioni dell'aula e pre-riscaldamento delle scene.
+
+L'orario è un file locale iCalendar (``.ics``) o CSV, indicato nella sezione
+``timetable`` di ``devices.yaml``::
+
+  timetable:
+    path: /opt/roomctl/config/timetable.ics   # oppure .csv
+    room: "Aula 3"          # filtra LOCATION (ics) o colonna room (csv)
+    lead_min: 5             # anticipo del pre-riscaldamento
+    enabled: true
+
+CSV: intestazione ``room,day,start,end,scene[,source]`` con ``day`` = mon..sun
+(lezione settimanale) oppure una data ``YYYY-MM-DD``; ``scene`` è
+``semplice``, ``video`` o ``combinata``.
+
+iCalendar: VEVENT con DTSTART/DTEND, RRULE settimanale o giornaliera
+(BYDAY, INTERVAL, UNTIL, COUNT), EXDATE; la scena si legge da
+``X-ROOMCTL-SCENE`` o ``CATEGORIES`` (default ``video``).
+
+Le occorrenze dei prossimi ``HORIZON_DAYS`` giorni sono precalcolate in un
+indice ordinato, ricostruito quando il file cambia o a cambio giornata.
+"""
+from __future__ import annotations
+import asyncio
+import bisect
+import csv
+import datetime as dt
+import logging
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from app import power_schedule
+
+HORIZON_DAYS = 8
+SCENES = ("semplice", "video", "combinata")
+DAYS = power_schedule.VALID_DAYS
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Lesson:
+    start: dt.datetime
+    end: dt.datetime
+    scene: str
+    title: str = ""
+    source: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "start": self.start.isoformat(timespec="minutes"),
+            "end": self.end.isoformat(timespec="minutes"),
+            "scene": self.scene,
+            "title": self.title,
+            "source": self.source,
+        }
+
+
+def settings(cfg: dict) -> dict:
+    tt = (cfg or {}).get("timetable") or {}
+    return {
+        "path": str(tt.get("path") or ""),
+        "room": str(tt.get("room") or "").strip(),
+        "lead_min": float(tt.get("lead_min", 5)),
+        "enabled": bool(tt.get("enabled", bool(tt.get("path")))),
+    }
+
+
+# ---------------------------------------------------------------- parsing
+
+def _norm_scene(value: str | None) -> str:
+    value = (value or "").strip().lower()
+    for scene in SCENES:
+        if scene in value:
+            return scene
+    return "video"
+
+
+def _parse_ics_dt(value: str) -> dt.datetime | None:
+    value = value.strip()
+    if len(value) == 8:
+        # evento "tutto il giorno": non è una lezione
+        return None
+    utc = value.endswith("Z")
+    parsed = dt.datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+    if utc:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc).astimezone().replace(tzinfo=None)
+    # TZID viene trattato come ora locale dell'aula
+    return parsed
+
+
+def _ics_events(text: str) -> list[dict]:
+    lines: list[str] = []
+    for raw in text.splitlines():
+        if raw[:1] in (" ", "\t") and lines:
+            lines[-1] += raw[1:]
+        else:
+            lines.append(raw)
+    events, cur = [], None
+    for line in lines:
+        if line == "BEGIN:VEVENT":
+            cur = {"EXDATE": []}
+        elif line == "END:VEVENT":
+            if cur is not None:
+                events.append(cur)
+            cur = None
+        elif cur is not None and ":" in line:
+            head, value = line.split(":", 1)
+            name = head.split(";", 1)[0].upper()
+            if name == "EXDATE":
+                cur["EXDATE"].extend(v for v in value.split(",") if v)
+            else:
+                cur[name] = value
+    return events
+
+
+def _weekly_dates(first: dt.date, rule: dict, until: dt.date, count: int | None) -> list[dt.date]:
+    freq = rule.get("FREQ", "WEEKLY")
+    interval = max(1, int(rule.get("INTERVAL", "1")))
+    out: list[dt.date] = []
+    if freq == "DAILY":
+        d = first
+        while d <= until and (count is None or len(out) < count):
+            out.append(d)
+            d += dt.timedelta(days=interval)
+        return out
+    byday = [b[-2:] for b in rule.get("BYDAY", "").split(",") if b]
+    codes = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+    weekdays = sorted(codes.index(b) for b in byday if b in codes) or [first.weekday()]
+    week = first - dt.timedelta(days=first.weekday())
+    while week <= until and (count is None or len(out) < count):
+        for wd in weekdays:
+            d = week + dt.timedelta(days=wd)
+            if first <= d <= until and (count is None or len(out) < count):
+                out.append(d)
+        week += dt.timedelta(weeks=interval)
+    return out
+
+
+def parse_ics(text: str, room: str, start: dt.datetime, end: dt.datetime) -> list[Lesson]:
+    lessons: list[Lesson] = []
+    for ev in _ics_events(text):
+        if room and room.lower() not in ev.get("LOCATION", "").lower():
+            continue
+        dtstart = _parse_ics_dt(ev.get("DTSTART", ""))
+        if dtstart is None:
+            continue
+        dtend = _parse_ics_dt(ev.get("DTEND", "")) if ev.get("DTEND") else None
+        length = (dtend - dtstart) if dtend else dt.timedelta(hours=1)
+        scene = _norm_scene(ev.get("X-ROOMCTL-SCENE") or ev.get("CATEGORIES"))
+        source = ev.get("X-ROOMCTL-SOURCE")
+        title = ev.get("SUMMARY", "")
+        excluded = {_parse_ics_dt(x) for x in ev["EXDATE"]}
+        if "RRULE" in ev:
+            rule = dict(p.split("=", 1) for p in ev["RRULE"].split(";") if "=" in p)
+            until = end.date()
+            if "UNTIL" in rule:
+                u = rule["UNTIL"]
+                until = min(until, (_parse_ics_dt(u) or dt.datetime.strptime(u[:8], "%Y%m%d")).date())
+            count = int(rule["COUNT"]) if "COUNT" in rule else None
+            dates = _weekly_dates(dtstart.date(), rule, until, count)
+        else:
+            dates = [dtstart.date()]
+        for d in dates:
+            occ = dt.datetime.combine(d, dtstart.time())
+            if occ in excluded or not (start <= occ <= end):
+                continue
+            lessons.append(Lesson(occ, occ + length, scene, title, source))
+    return lessons
+
+
+def parse_csv(text: str, room: str, start: dt.datetime, end: dt.datetime) -> list[Lesson]:
+    lessons: list[Lesson] = []
+    for row in csv.DictReader(text.splitlines()):
+        row = {(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+        if room and row.get("room", "").lower() != room.lower():
+            continue
+        try:
+            t_start = dt.datetime.strptime(row["start"], "%H:%M").time()
+            t_end = dt.datetime.strptime(row["end"], "%H:%M").time()
+        except (KeyError, ValueError):
+            log.warning("Riga orario non valida: %s", row)
+            continue
+        day = row.get("day", "").lower()[:3]
+        if day in DAYS:
+            d = start.date()
+            dates = []
+            while d <= end.date():
+                if d.weekday() == DAYS.index(day):
+                    dates.append(d)
+                d += dt.timedelta(days=1)
+        else:
+            try:
+                dates = [dt.date.fromisoformat(row.get("day", ""))]
+            except ValueError:
+                log.warning("Giorno non valido nell'orario: %s", row.get("day"))
+                continue
+        for d in dates:
+            occ = dt.datetime.combine(d, t_start)
+            if start <= occ <= end:
+                lessons.append(Lesson(occ, dt.datetime.combine(d, t_end), _norm_scene(row.get("scene")),
+                                      row.get("title", ""), row.get("source") or None))
+    return lessons
+
+
+# ---------------------------------------------------------------- indice
+
+class TimetableIndex:
+    """Indice ordinato delle prossime lezioni, ricostruito a richiesta."""
+
+    def __init__(self):
+        self._key: tuple | None = None
+        self._starts: list[dt.datetime] = []
+        self._lessons: list[Lesson] = []
+
+    async def refresh(self, conf: dict, now: dt.datetime | None = None) -> None:
+        """Ricarica l'indice se file, aula o giorno sono cambiati; stat, lettura
+        e parsing girano in un thread."""
+
+        now = now or dt.datetime.now()
+        loaded = await asyncio.to_thread(self._load, conf, now, self._key)
+        if loaded is None:
+            return
+        key, lessons = loaded
+        self._key, self._lessons, self._starts = key, lessons, [l.start for l in lessons]
+        log.info("Orario lezioni: %d occorrenze nei prossimi %d giorni", len(lessons), HORIZON_DAYS)
+
+    @staticmethod
+    def _load(conf: dict, now: dt.datetime, current_key: tuple | None) -> tuple[tuple, list[Lesson]] | None:
+        # bloccante: ``None`` se l'indice è già aggiornato
+        path = Path(conf["path"]) if conf["path"] else None
+        try:
+            mtime = path.stat().st_mtime if path else None
+        except OSError:
+            mtime = None
+        key = (conf["path"], conf["room"], mtime, now.date())
+        if key == current_key:
+            return None
+        lessons: list[Lesson] = []
+        if mtime is not None:
+            start = dt.datetime.combine(now.date(), dt.time())
+            end = start + dt.timedelta(days=HORIZON_DAYS)
+            try:
+                text = path.read_text(encoding="utf-8")
+                parser = parse_csv if path.suffix.lower() == ".csv" else parse_ics
+                lessons = parser(text, conf["room"], start, end)
+            except (OSError, ValueError) as exc:
+                log.error("Impossibile leggere l'orario %s: %s", path, exc)
+        lessons.sort(key=lambda l: l.start)
+        return key, lessons
+
+    def upcoming(self, after: dt.datetime, limit: int = 20) -> list[Lesson]:
+        i = bisect.bisect_left(self._starts, after)
+        return self._lessons[i:i + limit]
+
+    def current(self, when: dt.datetime) -> Lesson | None:
+        i = bisect.bisect_right(self._starts, when)
+        if i and self._lessons[i - 1].end > when:
+            return self._lessons[i - 1]
+        return None
+
+
+index = TimetableIndex()
+
+# lezioni già pre-riscaldate (inizio lezione -> istante del pre-riscaldamento)
+_prewarmed: dict[dt.datetime, float] = {}
+
+
+async def next_lesson(conf: dict, now: dt.datetime | None = None) -> Lesson | None:
+    now = now or dt.datetime.now()
+    await index.refresh(conf, now)
+    nxt = index.upcoming(now, 1)
+    return nxt[0] if nxt else None
+
+
+def is_prewarmed(max_age_s: float) -> bool:
+    """Vero se un pre-riscaldamento è avvenuto negli ultimi ``max_age_s`` secondi."""
+
+    now = time.time()
+    return any(now - ts <= max_age_s for ts in _prewarmed.values())
+
+
+async def run_prewarm_loop(
+    get_conf: Callable[[], dict],
+    prewarm: Callable[[Lesson], Awaitable[object]],
+) -> None:
+    """Task di background: ``lead_min`` minuti prima di ogni lezione lancia
+    ``prewarm(lezione)``, solo se il Raspberry è acceso in quell'orario secondo
+    ``power_schedule.yaml``. Dorme a tratti di al massimo un minuto per
+    accorgersi di modifiche a orario e configurazione."""
+
+    while True:
+        conf = settings(get_conf())
+        delay = 60.0
+        if conf["enabled"]:
+            now = dt.datetime.now()
+            lead = dt.timedelta(minutes=conf["lead_min"])
+            await index.refresh(conf, now)
+            for lesson in index.upcoming(now, 3):
+                if lesson.start in _prewarmed:
+                    continue
+                fire_at = lesson.start - lead
+                if fire_at <= now:
+                    _prewarmed[lesson.start] = time.time()
+                    if not power_schedule.is_powered_at(lesson.start):
+                        log.info("Lezione %s fuori orario di accensione: nessun pre-riscaldamento", lesson.start)
+                        continue
+                    log.info("Pre-riscaldamento per la lezione %s (%s)", lesson.start, lesson.scene)
+                    try:
+                        await prewarm(lesson)
+                    except Exception as exc:
+                        log.warning("Pre-riscaldamento fallito: %s", exc)
+                    continue
+                delay = min(delay, (fire_at - now).total_seconds())
+                break
+            # dimentica i pre-riscaldamenti di lezioni già concluse
+            for start in [s for s in _prewarmed if s < now - dt.timedelta(hours=12)]:
+                _prewarmed.pop(start, None)
+        await asyncio.sleep(max(1.0, delay))
@@ -0,0 +1,253 @@
+"""Tracciamento delle scene e delle chiamate ai driver.
+
+Ogni scena (e ogni chiamata driver eseguita fuori da una scena) produce un
+albero di span con inizio, fine, dispositivo, comando, tentativi ed esito.
+Gli alberi completati finiscono in un ring buffer in memoria consultabile
+dagli endpoint diagnostici dell'operatore (vedi ``app/diag.py``). Gli span
+con un dispositivo alimentano anche le metriche Prometheus (``app/metrics.py``)
+e, solo il più esterno di ogni operazione, il registro eventi (``app/audit.py``).
+
+Le letture periodiche di background (monitor di salute, assorbimento del
+proiettore) girano dentro ``untraced``: metriche sì, ma nessun albero nel
+buffer, che altrimenti in pochi minuti perderebbe tutte le tracce di scena.
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import functools
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from app import audit, deadline, metrics
+
+try:
+    import httpx
+    _HTTP_TIMEOUTS: tuple = (httpx.TimeoutException,)
+except ImportError:
+    _HTTP_TIMEOUTS = ()
+try:
+    import requests
+    _HTTP_TIMEOUTS += (requests.Timeout,)
+except ImportError:
+    pass
+
+TRACE_BUFFER_SIZE = int(os.environ.get("ROOMCTL_TRACE_BUFFER", "50"))
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "roomctl_span", default=None
+)
+_untraced: contextvars.ContextVar[bool] = contextvars.ContextVar("roomctl_untraced", default=False)
+_traces: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("name", "kind", "device", "command", "start", "end", "retries", "outcome", "children")
+
+    def __init__(self, name: str, kind: str, device: str | None, command: str | None):
+        self.name = name
+        self.kind = kind
+        self.device = device
+        self.command = command
+        self.start = time.monotonic()
+        self.end: float | None = None
+        self.retries = 0
+        self.outcome: str | None = None
+        self.children: list[Span] = []
+
+    @property
+    def key(self) -> str:
+        """Chiave di aggregazione per i percentili (dispositivo:comando o nome)."""
+
+        if self.device:
+            return f"{self.device}:{self.command or self.name}"
+        return self.name
+
+    @property
+    def duration(self) -> float:
+        end = self.end if self.end is not None else time.monotonic()
+        return end - self.start
+
+    def to_dict(self, t0: float | None = None) -> dict:
+        t0 = self.start if t0 is None else t0
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "device": self.device,
+            "command": self.command,
+            "start_ms": round((self.start - t0) * 1000, 1),
+            "duration_ms": round(self.duration * 1000, 1),
+            "retries": self.retries,
+            "outcome": self.outcome,
+            "children": [c.to_dict(t0) for c in list(self.children)],
+        }
+
+
+def _is_timeout(exc: BaseException | None) -> bool:
+    """Timeout di qualunque driver: ``TimeoutError`` (socket, budget), i timeout
+    di httpx/requests (Shelly) e gli errori che ne incapsulano uno, come
+    ``PJLinkConnectionError`` (``cause``) o i ``raise ... from``."""
+
+    for _ in range(8):
+        if exc is None:
+            return False
+        if isinstance(exc, (TimeoutError, *_HTTP_TIMEOUTS)):
+            return True
+        exc = getattr(exc, "cause", None) or exc.__cause__
+    return False
+
+
+@contextmanager
+def span(name: str, *, device: str | None = None, command: str | None = None, kind: str = "step") -> Iterator[Span]:
+    """Apre uno span figlio dello span corrente (o radice se non ce n'è uno).
+
+    Funziona sia nel codice async (lo span resta legato al task corrente) sia
+    nei thread di ``asyncio.to_thread``, che ereditano il contesto.
+    """
+
+    parent = _current.get()
+    sp = Span(name, kind, device, command)
+    if parent is not None:
+        parent.children.append(sp)
+    token = _current.set(sp)
+    try:
+        yield sp
+    except asyncio.CancelledError:
+        sp.outcome = "cancelled"
+        raise
+    except BaseException as exc:
+        sp.outcome = f"error: {exc}"[:200]
+        if device:
+            labels = (name, device, metrics.command_label(command))
+            metrics.DRIVER_ERRORS.inc(*labels)
+            if _is_timeout(exc):
+                metrics.DRIVER_TIMEOUTS.inc(*labels)
+        raise
+    else:
+        if sp.outcome is None:
+            sp.outcome = "ok"
+    finally:
+        sp.end = time.monotonic()
+        _current.reset(token)
+        if device:
+            metrics.DRIVER_SECONDS.observe(sp.end - sp.start, name, device, metrics.command_label(command))
+            if parent is None or not parent.device:
+                audit.record("cmd", device=device, action=command or name, outcome=sp.outcome or "ok",
+                             duration_s=sp.end - sp.start)
+        if parent is None and not _untraced.get():
+            with _lock:
+                _traces.append(sp)
+
+
+@contextmanager
+def untraced() -> Iterator[None]:
+    """Gli span radice aperti nel blocco non finiscono nel buffer delle tracce."""
+
+    token = _untraced.set(True)
+    try:
+        yield
+    finally:
+        _untraced.reset(token)
+
+
+def traced_scene(name: str):
+    """Decoratore per gli handler di scena: l'intera esecuzione è uno span radice."""
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name, kind="scene"):
+                return await fn(*args, **kwargs)
+
+        return wrapper
+
+    return deco
+
+
+def note_retry() -> None:
+    """Segnala un nuovo tentativo sullo span corrente."""
+
+    sp = _current.get()
+    if sp is not None:
+        sp.retries += 1
+        if sp.device:
+            metrics.DRIVER_RETRIES.inc(sp.name, sp.device)
+
+
+async def sleep(seconds: float, label: str) -> None:
+    """``asyncio.sleep`` tracciato, così le attese compaiono nel waterfall.
+
+    Se il budget della richiesta (``app.deadline``) non copre l'attesa si
+    fallisce subito invece di dormire inutilmente.
+    """
+
+    deadline.check(seconds, label)
+    with span(label, command="sleep"):
+        await asyncio.sleep(seconds)
+
+
+def recent_traces(n: int = 10, *, scenes_only: bool = True) -> list[Span]:
+    with _lock:
+        items = list(_traces)
+    if scenes_only:
+        items = [s for s in items if s.kind == "scene"]
+    return items[-n:] if n > 0 else []
+
+
+def _walk(sp: Span) -> Iterator[tuple[int, Span]]:
+    stack = [(0, sp)]
+    while stack:
+        depth, cur = stack.pop()
+        yield depth, cur
+        for child in reversed(cur.children):
+            stack.append((depth + 1, child))
+
+
+def _percentile(sorted_vals: list[float], p: float) -> float:
+    # nearest-rank: semplice e stabile anche con pochi campioni
+    idx = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100.0 * len(sorted_vals)) - 1))
+    return sorted_vals[idx]
+
+
+def step_percentiles() -> dict[str, dict]:
+    """Percentili di latenza (ms) per passo, su tutte le tracce nel buffer."""
+
+    with _lock:
+        items = list(_traces)
+    samples: dict[str, list[float]] = {}
+    for root in items:
+        for _, sp in _walk(root):
+            if sp.end is None:
+                continue
+            samples.setdefault(sp.key, []).append(sp.duration * 1000)
+    out: dict[str, dict] = {}
+    for key, vals in sorted(samples.items()):
+        vals.sort()
+        out[key] = {
+            "count": len(vals),
+            "p50_ms": round(_percentile(vals, 50), 1),
+            "p90_ms": round(_percentile(vals, 90), 1),
+            "p99_ms": round(_percentile(vals, 99), 1),
+            "max_ms": round(vals[-1], 1),
+        }
+    return out
+
+
+def waterfall(root: Span, width: int = 40) -> str:
+    """Vista testuale compatta di un albero di span (una riga per span)."""
+
+    total = max(root.duration, 1e-6)
+    lines = []
+    for depth, sp in _walk(root):
+        label = ("  " * depth + sp.key)[:44].ljust(44)
+        off = int((sp.start - root.start) / total * width)
+        length = max(1, int(sp.duration / total * width))
+        bar = (" " * off + "#" * length)[:width].ljust(width)
+        extra = f" r={sp.retries}" if sp.retries else ""
+        lines.append(f"{label} |{bar}| {sp.duration:8.3f}s {sp.outcome or 'running'}{extra}")
+    return "\n".join(lines)
@@ -1,159 +1,105 @@
 from datetime import datetime
-import subprocess
-from pathlib import Path
-from fastapi import APIRouter,Request,Depends,Form,HTTPException
+from fastapi import APIRouter,BackgroundTasks,Request,Depends,Form,HTTPException
 from fastapi.responses import HTMLResponse,RedirectResponse,JSONResponse
 from fastapi.templating import Jinja2Templates
-import httpx,os,asyncio,yaml
+import logging,asyncio
 from .auth import require_operator,login_with_pin,logout,get_token_from_cookie
-from .state import get_public_state,set_public_state
-from .config import devices
+from .state import get_public_state,set_text,update as update_state
+from . import config, deadline, snapshots
+from .services import dsp, projector, scenes, schedule, shelly, system
 router=APIRouter(); templates=Jinja2Templates(directory='app/templates')
-ROOMCTL_BASE=os.environ.get('ROOMCTL_BASE','http://127.0.0.1:8080')
-UI_CONFIG=os.environ.get('ROOMCTL_UI_CONFIG','/opt/roomctl/config/ui.yaml')
-CONFIG_DEV=os.environ.get('ROOMCTL_DEVICES','/opt/roomctl/config/devices.yaml')
-
-
-def _load_ui():
- try:
-  with open(UI_CONFIG,'r',encoding='utf-8') as f: return yaml.safe_load(f) or {}
- except FileNotFoundError: return {}
- except Exception: return {}
-
-def _save_ui(d):
- os.makedirs(os.path.dirname(UI_CONFIG),exist_ok=True)
- with open(UI_CONFIG,'w',encoding='utf-8') as f: yaml.safe_dump(d,f)
-
-def _get_show_combined()->bool: return bool(_load_ui().get('show_combined',True))
-
-def _set_show_combined(v:bool): cfg=_load_ui(); cfg['show_combined']=bool(v); _save_ui(cfg)
-
-def _load_devices_cfg():
- try:
-  with open(CONFIG_DEV,'r',encoding='utf-8') as f:
-   return yaml.safe_load(f) or {}
- except FileNotFoundError:
-  return {}
- except Exception:
-  return {}
-
-def _get_dsp_used()->dict:
- cfg=_load_devices_cfg()
- dsp=cfg.get('dsp',{})
- in_map=dsp.get('input',{}) or {}
- out_map=dsp.get('output',{}) or {}
- used={}
- for i in range(4):
-  used[f"in{i}"]=bool(in_map.get(str(i),True))
- for i in range(8):
-  used[f"out{i}"]=bool(out_map.get(str(i),True))
- return used
- 
-def _get_shelly_invert()->bool:
- cfg=_load_devices_cfg()
- return bool((cfg.get('shelly2') or {}).get('inverti_corsa', False))
-
-def _read_rtc_vbat() -> float | None:
-    """Legge la tensione batteria dell'RTC da sysfs, se disponibile.
-
-    Ritorna il valore in Volt oppure ``None`` se non rilevabile.
-	
-    candidates = [
-        Path("/sys/class/power_supply/rtc-battery/voltage_now"),
-        Path("/sys/class/power_supply/rtc-vbat/voltage_now"),
-        Path("/sys/class/power_supply/rtc/voltage_now"),
-    ]
-
-    for path in candidates:
-        try:
-            if not path.is_file():
-                continue
-            raw = path.read_text(encoding="utf-8").strip()
-            if not raw:
-                continue
-
-            value = float(raw)
-            # I driver di alimentazione riportano spesso microvolt/millivolt
-            if value > 10000:
-                value /= 1_000_000
-            elif value > 100:
-                value /= 1000
-            return value
-        except Exception:
-            continue
-
-    return None """
-	
-    output=subprocess.check_output("vcgencmd pmic_read_adc BATT_V", shell=True,text=True)
-    val_str=output.split('=')[1].replace('V','').strip()
-    val=float(val_str)
-    return round(val,3)
-
-
-async def _post(url: str, payload: dict | None = None):
-  timeout = httpx.Timeout(connect=8.0, read=120.0, write=10.0, pool=8.0)
-  try:
-        async with httpx.AsyncClient(timeout=timeout) as c:
-          r = await c.post(url, json=payload or {})
-  except httpx.TimeoutException:
-		#qui decidi cosa fare
-        raise HTTPException(status_code=504, detail=f"Timeout parlando con {url}")
-  except httpx.RequestError as e:
-        raise HTTPException(status_code=504, detail=f"Timeout di rete verso {url}: {e}")
-		# Se il backend accetta e prosegue in background → 202
-  if r.status_code >= 500:
-        raise HTTPException(status_code=502, detail=f"Backend error {r.status_code}	da {url}")
-  if "application/json" in r.headers.get("content-type",""):
-        return r.json()
-  return r.text
-		
-async def _get(url: str) -> dict:
-    # stesso timeout "rilassato" di _post
-    timeout = httpx.Timeout(connect=5.0, read=20.0, write=10.0, pool=5.0)
-    async with httpx.AsyncClient(timeout=timeout) as c:
-        r = await c.get(url)
-        r.raise_for_status()
-        return r.json()
+log=logging.getLogger(__name__)
+
+# oltre quest'età i valori in cache vengono riletti dopo il rendering
+DSP_LEVELS_MAX_AGE_S=30
+RTC_VBAT_MAX_AGE_S=300
+
+
+def _get_show_combined()->bool: return config.ui_config().show_combined
+
+def _set_show_combined(v:bool):
+ # salvataggio differito e atomico (app/config.py)
+ config.ui_file.update(lambda raw: raw.update(show_combined=bool(v)))
+
 
 def _token(req:Request): return get_token_from_cookie(req)
 
 def _set_state_text(message: str) -> dict:
-    state = get_public_state()
-    state["text"] = message
-    set_public_state(state)
-    return state
+    set_text(message)
+    return get_public_state()
+
 
+def _set_state(**fields) -> None:
+    # solo i campi indicati: le modifiche fatte nel frattempo dalle scene restano
+    update_state(lambda state: state.update(fields))
 
-async def _safe_post(
-    url: str,
-    payload: dict | None,
+
+async def _safe_call(
+    call,
     error_text: str,
     *,
     redirect: str = "/",
     state: dict | None = None,
 ):
-    """Invia un comando al backend intercettando errori di rete/dispositivo.
+    """Esegue un comando dei servizi intercettando errori di rete/dispositivo.
 
-    In caso di errore aggiorna lo stato pubblico con un messaggio breve senza
-    dettagli tecnici e torna subito al redirect richiesto.
+    ``call`` è l'awaitable restituito dal servizio (``app/services``), eseguito
+    nello stesso processo senza passare dall'API HTTP. In caso di errore
+    aggiorna lo stato pubblico con un messaggio breve senza dettagli tecnici e
+    torna subito al redirect richiesto.
     """
 
     state = state or get_public_state()
     try:
-        await _post(url, payload)
-    except HTTPException:
+        await call
+    except HTTPException as exc:
+        log.warning("%s: %s", error_text, exc.detail)
         _set_state_text(error_text)
         return RedirectResponse(url=redirect, status_code=303)
-    except Exception:
+    except Exception as exc:
+        log.warning("%s: %s", error_text, exc)
         _set_state_text(error_text)
         return RedirectResponse(url=redirect, status_code=303)
 
     return None
 
+def _wants_json(req: Request) -> bool:
+    # richieste dagli script della pagina (aggiornamento parziale)
+    return "application/json" in req.headers.get("accept", "")
+
+
+def _control_reply(req: Request, redirect: str = "/operator", **changed):
+    """Risposta di un controllo operatore: solo i valori cambiati (JSON) per
+    gli script della pagina, redirect classico per i form senza JavaScript."""
+
+    if _wants_json(req):
+        return JSONResponse({"ok": True, "text": get_public_state().get("text"), **changed})
+    return RedirectResponse(url=redirect, status_code=303)
+
+
+async def _control(req: Request, call, error_text: str, *, redirect: str = "/operator", changed=None):
+    """Esegue il comando di un controllo operatore e risponde con
+    ``_control_reply``; ``changed(risultato)`` dà i valori da restituire.
+
+    In caso di errore aggiorna lo stato pubblico come ``_safe_call`` e, in
+    JSON, risponde con lo stato HTTP dell'errore e il messaggio breve.
+    """
+
+    try:
+        result = await call
+    except Exception as exc:
+        log.warning("%s: %s", error_text, getattr(exc, "detail", None) or exc)
+        _set_state_text(error_text)
+        if _wants_json(req):
+            status = exc.status_code if isinstance(exc, HTTPException) else 504 if isinstance(exc, deadline.DeadlineExceeded) else 502
+            return JSONResponse({"ok": False, "error": error_text, "text": error_text}, status_code=status)
+        return RedirectResponse(url=redirect, status_code=303)
+    return _control_reply(req, redirect, **(changed(result) if changed else {}))
+
+
 async def _handle_dsp_recall(preset: str, *, state: dict, redirect: str):
-    error_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/dsp/recall",
-        {"preset": preset},
+    error_resp = await _safe_call(
+        dsp.recall(preset),
         "Errore richiamo preset DSP",
         state=state,
         redirect=redirect,
@@ -161,8 +107,7 @@ async def _handle_dsp_recall(preset: str, *, state: dict, redirect: str):
     if error_resp:
         return error_resp
 
-    state["volume_preset"] = preset
-    set_public_state(state)
+    _set_state(volume_preset=preset)
     return RedirectResponse(url=redirect, status_code=303)
 
 @router.get('/', response_class=HTMLResponse)
@@ -181,101 +126,57 @@ async def home(req: Request, pin_error: bool = False):
 @router.post('/ui/scene/avvio_semplice')
 async def ui_avvio_semplice():
     state = _set_state_text("Avvio lezione semplice in corso…")
-    error_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/scene/avvio_semplice",
-        {},
+    error_resp = await _safe_call(
+        scenes.avvio_semplice(lesson="semplice", preset="U02"),
         "Errore avvio lezione semplice",
         state=state,
     )
     if error_resp:
         return error_resp
 
-    preset_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/dsp/recall",
-        {"preset": "U02"},
-        "Errore richiamo preset DSP",
-        state=state,
-    )
-    if preset_resp:
-        return preset_resp
-
-    state["text"] = "Avviata lezione solo audio"
-    state["current_lesson"] = "semplice"
-    state["volume_preset"] = "U02"
-    set_public_state(state)
+    _set_state(text="Avviata lezione solo audio", current_lesson="semplice", volume_preset="U02")
     return RedirectResponse(url="/", status_code=303)
 
 
 @router.post('/ui/scene/avvio_video')
 async def ui_avvio_video():
     state = _set_state_text("Avvio lezione video in corso…")
-    error_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/scene/avvio_proiettore",
-        {},
+    error_resp = await _safe_call(
+        scenes.avvio_proiettore(lesson="video", preset="U02"),
         "Errore avvio lezione video",
         state=state,
     )
     if error_resp:
         return error_resp
 
-    preset_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/dsp/recall",
-        {"preset": "U02"},
-        "Errore richiamo preset DSP",
-        state=state,
-    )
-    if preset_resp:
-        return preset_resp
-
-    state["text"] = "Lezione video avviata"
-    state["current_lesson"] = "video"
-    state["volume_preset"] = "U02"
-    set_public_state(state)
+    _set_state(text="Lezione video avviata", current_lesson="video", volume_preset="U02")
     return RedirectResponse(url="/", status_code=303)
 
 
 @router.post('/ui/scene/avvio_video_combinata')
 async def ui_avvio_video_combinata():
     state = _set_state_text("Avvio lezione video combinata in corso…")
-    error_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/scene/avvio_proiettore",
-        {"source": "HDMI2"},
+    error_resp = await _safe_call(
+        scenes.avvio_proiettore(source="HDMI2", lesson="combinata", preset="U02"),
         "Errore avvio lezione combinata",
         state=state,
     )
     if error_resp:
         return error_resp
 
-    preset_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/dsp/recall",
-        {"preset": "U02"},
-        "Errore richiamo preset DSP",
-        state=state,
-    )
-    if preset_resp:
-        return preset_resp
-
-    state["text"] = "Lezione video combinata avviata"
-    state["current_lesson"] = "combinata"
-    state["volume_preset"] = "U02"
-    set_public_state(state)
+    _set_state(text="Lezione video combinata avviata", current_lesson="combinata", volume_preset="U02")
     return RedirectResponse(url="/", status_code=303)
 
    
 @router.post('/ui/scene/spegni_aula')
 async def ui_spegni_aula():
     state = _set_state_text("Arresto lezione e spegnimento aula in corso…")
-    error_resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/scene/spegni_aula", {}, "Errore spegnimento aula", state=state
-    )
+    error_resp = await _safe_call(scenes.spegni_aula(), "Errore spegnimento aula", state=state)
     if error_resp:
         return error_resp
 
-    state["text"] = "Aula spenta: sistema pronto"
-    # nessuna lezione attiva
-    state["current_lesson"] = None #state.pop("current_lesson", None) per rimuovere proprio la chiave
-    state["volume_preset"] = None
-    set_public_state(state)
+    # lezione e preset già azzerati dalla scena (passo "stato")
+    _set_state(text="Aula spenta: sistema pronto")
     return RedirectResponse(url="/", status_code=303)
 
 
@@ -299,8 +200,8 @@ async def ui_dsp_volume_step(
 
 
 @router.post('/auth/pin')
-async def auth_pin(pin: str = Form(...)):
-    t = await login_with_pin(pin)
+async def auth_pin(req: Request, pin: str = Form(...)):
+    t = await login_with_pin(pin, req.client.host if req.client else '?')
     if not t:
         # PIN errato: torna alla home con il flag pin_error
         return RedirectResponse('/?pin_error=1', status_code=303)
@@ -311,27 +212,27 @@ async def auth_pin(pin: str = Form(...)):
 
 @router.get("/operator", response_class=HTMLResponse)
 async def operator_get(req: Request, _=Depends(require_operator)):
-    state = get_public_state()
-    rtc_vbat = _read_rtc_vbat()
+    """Pagina operatore resa subito dagli ultimi valori noti (app/snapshots.py).
 
+    Livelli DSP troppo vecchi (o mai letti) vengono marcati come tali e
+    riletti in background; la pagina li chiede a ``/operator/snapshot``. Vbat
+    RTC e misure di sistema arrivano dal campionatore di app/telemetry.py.
+    """
+    state = get_public_state()
 
-    # di default nessun dato DSP (per gestire eventuali errori)
-    dsp_levels = None
-    try:
-        dsp_levels = await _get(f"{ROOMCTL_BASE}/api/dsp/state")
-    except Exception:
-        # se il DSP è spento / non raggiungibile, semplicemente
-        # lasciamo dsp_levels = None e il template mostrerà "—"
-        dsp_levels = None
+    dsp_snap = snapshots.get("dsp_levels")
+    if dsp_snap.is_stale(DSP_LEVELS_MAX_AGE_S):
+        snapshots.refresh("dsp_levels", dsp.levels)
+    rtc_snap = snapshots.get("rtc_vbat")
 
     # stato dei toggle DSP (input/output) letto da devices.yaml
     try:
-        dsp_used = _get_dsp_used()
+        dsp_used = dsp.used_channels()
     except Exception:
         dsp_used = None
 
     try:
-        power_schedule = await _get(f"{ROOMCTL_BASE}/api/power/schedule")
+        power_schedule = schedule.get()
     except Exception:
         power_schedule = None
 
@@ -341,66 +242,75 @@ async def operator_get(req: Request, _=Depends(require_operator)):
             "request": req,
             "state": state,
             "show_combined": _get_show_combined(),
-            "dsp_levels": dsp_levels,
+            "dsp_levels": dsp_snap.value,
+            "dsp_levels_age": dsp_snap.age(),
+            "dsp_levels_stale": dsp_snap.is_stale(DSP_LEVELS_MAX_AGE_S),
             "dsp_used": dsp_used,
-            "shelly2_invert": _get_shelly_invert(),
+            "shelly2_invert": shelly.is_inverted(),
             "power_schedule": power_schedule,
-            "rtc_vbat": rtc_vbat,
+            "rtc_vbat": rtc_snap.value,
+            "rtc_vbat_stale": rtc_snap.is_stale(RTC_VBAT_MAX_AGE_S),
 
         },
     )
 
 
+@router.get("/operator/snapshot")
+async def operator_snapshot(wait: float = 0.0, _=Depends(require_operator)):
+    """Valori lenti della pagina operatore con età e marcatura ``stale``.
+
+    Con ``wait`` > 0 attende (al più ``wait`` secondi) la rilettura dei valori
+    scaduti; altrimenti restituisce subito quelli in cache.
+    """
+    wait = max(0.0, min(wait, deadline.COMMAND_BUDGET_S))
+    dsp_snap = await snapshots.fresh("dsp_levels", dsp.levels, DSP_LEVELS_MAX_AGE_S, wait)
+    return {
+        "state": get_public_state(),
+        "dsp_levels": dsp_snap.to_dict(DSP_LEVELS_MAX_AGE_S),
+        # campionati in background (app/telemetry.py): qui solo la cache
+        "rtc_vbat": snapshots.get("rtc_vbat").to_dict(RTC_VBAT_MAX_AGE_S),
+        "system": snapshots.get("system").to_dict(RTC_VBAT_MAX_AGE_S),
+    }
+
+
 @router.post('/auth/logout')
 async def auth_logout(req:Request):
- resp=RedirectResponse('/',status_code=303); logout(resp); return resp
+ resp=RedirectResponse('/',status_code=303); logout(resp,_token(req)); return resp
 
 @router.post('/operator/toggle_combined')
-async def op_toggle_combined(value:bool=Form(...),_=Depends(require_operator)):
- _set_show_combined(value); return RedirectResponse('/operator',status_code=303)
+async def op_toggle_combined(req:Request,value:bool=Form(...),_=Depends(require_operator)):
+ _set_show_combined(value)
+ return _control_reply(req,show_combined=bool(value))
 
 @router.post('/operator/projector/power')
-async def op_proj_power(on:bool=Form(...),_=Depends(require_operator)):
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/projector/power",
-        {'on': bool(on)},
-        "Errore comando alimentazione proiettore",
-        redirect="/operator",
-    )
-    if resp:
-        return resp
-    return RedirectResponse('/operator',status_code=303)
+async def op_proj_power(req:Request,background:BackgroundTasks,on:bool=Form(...),_=Depends(require_operator)):
+    # come l'API: la sequenza (minuti) prosegue dopo la risposta
+    background.add_task(projector.power_background, bool(on))
+    return _control_reply(req, accepted=True, on=bool(on))
 
 @router.post('/operator/projector/input')
-async def op_proj_input(source:str=Form(...),_=Depends(require_operator)):
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/projector/input",
-        {'source': source},
+async def op_proj_input(req:Request,source:str=Form(...),_=Depends(require_operator)):
+    return await _control(
+        req,
+        projector.set_input(source),
         "Errore cambio sorgente proiettore",
-        redirect="/operator",
+        changed=lambda _: {"input": source.upper()},
     )
-    if resp:
-        return resp
-    return RedirectResponse('/operator',status_code=303)
 
 @router.post("/operator/dsp/mute_all")
-async def op_dsp_mute_all( on: bool = Form(...), _=Depends(require_operator),):
-    # operator.html usa name="on", ma l'API vuole "mute"
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/dsp/mute",
-        {"mute": bool(on)},
+async def op_dsp_mute_all(req: Request, on: bool = Form(...), _=Depends(require_operator),):
+    return await _control(
+        req,
+        dsp.mute(bool(on)),
         "Errore comando mute DSP",
-        redirect="/operator",
+        changed=lambda _: {"mute": bool(on)},
     )
-    if resp:
-        return resp
-    return RedirectResponse("/operator", status_code=303)
 
 @router.post("/operator/dsp/used")
 async def op_dsp_used(req: Request, _=Depends(require_operator)):
     """
     Gestisce i toggle IN/OUT del DSP (usano name="in0".."in3" / "out0".."out7").
-    Legge il primo campo presente nel form e lo inoltra all'API /api/dsp/used.
+    Legge il primo campo presente nel form e lo salva in devices.yaml.
     """
     form = await req.form()
     channel = None
@@ -411,22 +321,21 @@ async def op_dsp_used(req: Request, _=Depends(require_operator)):
             new_val = v
             break
 
-    if channel is not None and new_val is not None:
-        used = str(new_val).lower() in ("true", "1", "on", "yes")
-        resp = await _safe_post(
-            f"{ROOMCTL_BASE}/api/dsp/used",
-            {"channel": channel, "used": used},
-            "Errore aggiornamento canali DSP",
-            redirect="/operator",
-        )
-        if resp:
-            return resp
+    if channel is None or new_val is None:
+        return _control_reply(req)
 
-    return RedirectResponse("/operator", status_code=303)
+    used = str(new_val).lower() in ("true", "1", "on", "yes")
+    return await _control(
+        req,
+        dsp.set_used(channel, used),
+        "Errore aggiornamento canali DSP",
+        changed=lambda _: {"channel": channel, "used": used},
+    )
 
 
 @router.post("/operator/dsp/gain")
 async def op_dsp_gain(
+    req: Request,
     bus: str = Form(...),
     delta: int = Form(...),
     _=Depends(require_operator),
@@ -434,20 +343,17 @@ async def op_dsp_gain(
     """
     Handler per i pulsanti GAIN +/- (bus = in_a, out0..3).
     """
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/dsp/gain",
-        {"bus": bus, "delta": int(delta)},
+    return await _control(
+        req,
+        dsp.gain_step(bus, int(delta)),
         "Errore regolazione gain DSP",
-        redirect="/operator",
+        changed=lambda val: {"bus": bus, "gain_db": val},
     )
-    if resp:
-        return resp
-    # redirect per ricaricare pagina e label aggiornate
-    return RedirectResponse("/operator", status_code=303)
 
 
 @router.post("/operator/dsp/volume")
 async def op_dsp_volume(
+    req: Request,
     bus: str = Form(...),
     delta: int = Form(...),
     _=Depends(require_operator),
@@ -455,67 +361,63 @@ async def op_dsp_volume(
     """
     Handler per i pulsanti VOLUME +/- (bus = in_a, out0..3).
     """
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/dsp/volume",
-        {"bus": bus, "delta": int(delta)},
+    return await _control(
+        req,
+        dsp.volume_step(bus, int(delta)),
         "Errore regolazione volume DSP",
-        redirect="/operator",
+        changed=lambda val: {"bus": bus, "volume_db": val},
     )
-    if resp:
-        return resp
-    return RedirectResponse("/operator", status_code=303)
 
 
 @router.post("/operator/dsp/recall")
 async def op_dsp_recall(
+    req: Request,
     preset: str = Form(...),
     _=Depends(require_operator),
 ):
     """
     Handler per i pulsanti Recall preset (F00, U01, U02, U03).
     """
-    state = get_public_state()
-    return await _handle_dsp_recall(preset, state=state, redirect="/operator")
+    async def _recall():
+        await dsp.recall(preset)
+        _set_state(volume_preset=preset)
+
+    return await _control(
+        req,
+        _recall(),
+        "Errore richiamo preset DSP",
+        changed=lambda _: {"preset": preset},
+    )
 
 @router.post('/operator/shelly/set')
-async def op_shelly_set(sid:str=Form(...),on:bool=Form(...),_=Depends(require_operator)):
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/shelly/{sid}/set",
-        {'on': bool(on)},
+async def op_shelly_set(req:Request,sid:str=Form(...),on:bool=Form(...),_=Depends(require_operator)):
+    return await _control(
+        req,
+        shelly.set_output(sid, bool(on)),
         "Errore comando relè",
-        redirect="/operator",
+        changed=lambda _: {"sid": sid, "on": bool(on)},
     )
-    if resp:
-        return resp
-    return RedirectResponse('/operator',status_code=303)
 
 @router.post('/operator/shelly/pulse')
-async def op_shelly_pulse(sid:str=Form(...),_=Depends(require_operator)):
-    #await _post(f"{ROOMCTL_BASE}/api/shelly/{sid}/set",{'on':True}); import asyncio; await asyncio.sleep(0.8); await _post(f"{ROOMCTL_BASE}/api/shelly/{sid}/set",{'on':False}); return RedirectResponse('/operator',status_code=303)
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/shelly/{sid}/set",
-        {'on': True},
+async def op_shelly_pulse(req:Request,sid:str=Form(...),_=Depends(require_operator)):
+    return await _control(
+        req,
+        shelly.set_output(sid, True),
         "Errore impulso relè",
-        redirect="/operator",
+        changed=lambda _: {"sid": sid},
     )
-    if resp:
-        return resp
-    return RedirectResponse('/operator', status_code=303)
 
 @router.post('/operator/shelly/invert')
 async def op_shelly_invert(req: Request, _=Depends(require_operator)):
     form = await req.form()
     values = form.getlist('inverti_corsa') if hasattr(form, 'getlist') else [form.get('inverti_corsa', '')]
     invert_val = any(str(v).lower() in ('true', '1', 'on', 'yes') for v in values)
-    resp = await _safe_post(
-        f"{ROOMCTL_BASE}/api/shelly/inverti_corsa",
-        {'inverti_corsa': invert_val},
+    return await _control(
+        req,
+        shelly.set_invert(invert_val),
         "Errore aggiornamento inversione tende",
-        redirect="/operator",
+        changed=lambda _: {"inverti_corsa": invert_val},
     )
-    if resp:
-        return resp
-    return RedirectResponse('/operator', status_code=303)
 
 
 @router.post("/operator/power_schedule")
@@ -533,15 +435,17 @@ async def op_power_schedule(req: Request, _=Depends(require_operator)):
         "enabled": enabled,
     }
 
-    state = get_public_state()
-    try:
-        await _post(f"{ROOMCTL_BASE}/api/power/schedule", payload)
-        state["text"] = "Pianificazione alimentazione aggiornata"
-    except Exception:
-        state["text"] = "Errore salvataggio pianificazione"
-    set_public_state(state)
+    async def _save():
+        saved = schedule.save(payload)
+        _set_state_text("Pianificazione alimentazione aggiornata")
+        return saved
 
-    return RedirectResponse("/operator", status_code=303)
+    return await _control(
+        req,
+        _save(),
+        "Errore salvataggio pianificazione",
+        changed=lambda saved: {"schedule": saved},
+    )
 
 @router.post("/ui/special/set_datetime")
 async def ui_set_datetime(req: Request, _=Depends(require_operator)):
@@ -549,43 +453,30 @@ async def ui_set_datetime(req: Request, _=Depends(require_operator)):
     date_str = str(form.get("date", "")).strip()
     time_str = str(form.get("time", "")).strip()
 
-    state = get_public_state()
-
     if not date_str or not time_str:
-        state["text"] = "Inserisci data e ora valide"
-        set_public_state(state)
+        set_text("Inserisci data e ora valide")
         return RedirectResponse("/operator", status_code=303)
 
     try:
         dt = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
     except ValueError:
-        state["text"] = "Formato data/ora non valido"
-        set_public_state(state)
+        set_text("Formato data/ora non valido")
         return RedirectResponse("/operator", status_code=303)
 
     try:
-        await _post(
-            f"{ROOMCTL_BASE}/api/special/set_datetime",
-            {"datetime": dt.isoformat()},
-        )
-        state["text"] = "Data e ora aggiornate"
+        await system.set_datetime(dt)
+        set_text("Data e ora aggiornate")
     except Exception:
-        state["text"] = "Errore impostazione data/ora"
+        set_text("Errore impostazione data/ora")
 
-    set_public_state(state)
     return RedirectResponse("/operator", status_code=303)
 
 
 	
 
 @router.post('/ui/special/reboot_terminal')
-async def ui_reboot_terminal(_: bool = Depends(require_operator)):
-    state = get_public_state()
-    try:
-        # Adatta l’URL a come il backend espone il comando di reboot
-        await _post(f"{ROOMCTL_BASE}/api/special/reboot_terminal", {})
-        state["text"] = "Riavvio terminale richiesto..."
-    except Exception:
-        state["text"] = "Errore riavvio terminale"
-    set_public_state(state)
+async def ui_reboot_terminal(background: BackgroundTasks, _: bool = Depends(require_operator)):
+    # il reboot parte dopo l'invio della risposta
+    background.add_task(system.reboot)
+    set_text("Riavvio terminale richiesto...")
     return RedirectResponse('/', status_code=303)
@@ -62,6 +62,7 @@ install -d "$APP_DIR"
 rsync -a --delete \
   --exclude ".git" \
   --exclude ".venv" \
+  --exclude "data" \
   --exclude "config/*.yaml" \
   "${SCRIPT_DIR}/" "$APP_DIR/"
 chown -R "$SYSTEM_USER:$SYSTEM_USER" "$APP_DIR"
@@ -80,7 +81,8 @@ fi
   PyYAML \
   python-multipart \
   requests \
-  jinja2
+  jinja2 \
+  orjson
 
 copy_if_absent() {
   local src="$1" dst="$2"
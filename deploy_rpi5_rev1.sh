@@ -56,6 +56,7 @@ install -d "$APP_DIR"
 rsync -a --delete \
   --exclude ".git" \
   --exclude ".venv" \
+  --exclude "data" \
   --exclude "config/*.yaml" \
   --exclude "config/power_scheduler.py" \
   "${SCRIPT_DIR}/" "$APP_DIR/"